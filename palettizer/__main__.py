@@ -1,7 +1,13 @@
-from . quantize import quantize
+from . quantize import quantize, quantize_tiled, resize_image_if_too_large, KMEANS_PRESETS, DEFAULT_KMEANS_PRESET
+from . imgutils import image_to_bytes, write_png
 from . palette import Palette
 from . htmlview import image_and_palette_as_html
-from skimage import io
+from . batch import find_images, quantize_batch
+from . server import serve, DEFAULT_HOST, DEFAULT_PORT
+import asyncio
+import logging
+import os
+from pathlib import Path
 import sys
 
 
@@ -16,41 +22,140 @@ if __name__ != '__main__':
     print("The script isn't executed as main, terminating")
     exit(1)
 
-if len(sys.argv) < 4:
+# --full-resolution keeps the original size of the image instead of downscaling it
+full_resolution = "--full-resolution" in sys.argv[1:]
+# --indexed-png writes PNG images of up to 256 colors with a color palette, which makes them much smaller
+indexed_png = "--indexed-png" in sys.argv[1:]
+# --dither draws gradients by a pattern of the nearby colors instead of bands
+dither = "--dither" in sys.argv[1:]
+# --workers=N sets the number of worker processes of the batch mode
+workers = None
+# --memory-budget-mb=N downscales the images so that quantization of each takes up to N MB of memory
+memory_budget_bytes = None
+# --host=H and --port=N set the address of the server mode
+host = DEFAULT_HOST
+port = DEFAULT_PORT
+args = []
+for arg in sys.argv:
+    if arg.startswith("--workers="):
+        workers = int(arg[len("--workers="):])
+    elif arg.startswith("--memory-budget-mb="):
+        memory_budget_bytes = int(arg[len("--memory-budget-mb="):]) * 1024 * 1024
+    elif arg.startswith("--host="):
+        host = arg[len("--host="):]
+    elif arg.startswith("--port="):
+        port = int(arg[len("--port="):])
+    elif arg not in ("--full-resolution", "--indexed-png", "--dither"):
+        args.append(arg)
+
+# "serve" as the first argument starts the HTTP server instead of converting images
+if len(args) > 1 and args[1] == "serve":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        asyncio.run(serve(host, port, workers, memory_budget_bytes))
+    except KeyboardInterrupt:
+        pass
+    exit(0)
+
+# "compile" as the first argument saves the palettes in the binary format which is loaded much faster
+if len(args) > 1 and args[1] == "compile":
+    if len(args) < 4:
+        raise Exception('Expected 2 arguments: palette file paths and output file path')
+    palette_ids = nonempty_str(args[2]).split(",")
+    if all(p in Palette.PREDEFINED_PALETTES for p in palette_ids):
+        palette = Palette.from_predefined(palette_ids)
+    else:
+        palette = Palette.from_files(palette_ids)
+    palette.compile(nonempty_str(args[3]))
+    print('Compiled {} colors to {}'.format(palette.size(), args[3]))
+    exit(0)
+
+# "batch" as the first argument quantizes all images of a directory or a glob pattern
+batch = len(args) > 1 and args[1] == "batch"
+if batch:
+    args.pop(1)
+
+if len(args) < 4:
     raise Exception('Expected 3 arguments: input image path, palette file path and output image path')
-input_img = nonempty_str(sys.argv[1])
-palette = nonempty_str(sys.argv[2])
-output_img = nonempty_str(sys.argv[3])
+input_img = nonempty_str(args[1])
+palette = nonempty_str(args[2])
+output_img = nonempty_str(args[3])
 
 n_colors = 0
-if len(sys.argv) > 4:
-    n_colors = int(sys.argv[4])
+if len(args) > 4:
+    n_colors = int(args[4])
     if n_colors < 0:
         raise Exception("Number of colors should be >= 0")
 
+kmeans_preset = DEFAULT_KMEANS_PRESET
+if len(args) > 5:
+    kmeans_preset = args[5]
+    if kmeans_preset not in KMEANS_PRESETS:
+        raise Exception("K-Means preset should be one of: " + ", ".join(KMEANS_PRESETS))
+
 print('Parsing the palette from ' + palette + '...')
-palette = Palette.from_files(palette.split(","))
+palette_ids = palette.split(",")
+if all(p in Palette.PREDEFINED_PALETTES for p in palette_ids):
+    palette = Palette.from_predefined(palette_ids)
+else:
+    palette = Palette.from_files(palette_ids)
 print("Successfully parsed")
 
+if batch:
+    images = find_images(input_img)
+    if len(images) == 0:
+        raise Exception("No images found by " + input_img)
+    print('Quantizing {} images, saving the results to {}...'.format(len(images), output_img))
+    failed = quantize_batch(images, palette, output_img, n_colors, kmeans_preset, full_resolution, indexed_png,
+                            workers, memory_budget_bytes=memory_budget_bytes, dither=dither)
+    print('Finished, {} of {} images failed'.format(failed, len(images)))
+    exit(1 if failed > 0 else 0)
+
 print('Quantizing the image from file ' + input_img + '...')
-q_image = quantize(input_img, palette, n_colors)
+# the full resolution result is written to a memory-mapped file next to the output, so it doesn't take memory
+result_path = output_img + ".tmp.npy"
+if full_resolution:
+    q_image = quantize_tiled(input_img, palette, n_colors, kmeans_preset=kmeans_preset, out=result_path,
+                             dither=dither)
+else:
+    q_image = quantize(input_img, palette, n_colors, kmeans_preset=kmeans_preset,
+                       memory_budget_bytes=memory_budget_bytes, dither=dither)
 print('Quantization finished')
 
 print('Saving the quantized image to ' + output_img + '...')
-io.imsave(output_img, q_image.image)
+output_format = Path(output_img).suffix.lower().lstrip(".") or "png"
+if full_resolution and output_format == "png":
+    # encoded by blocks of rows, without a full-size copy of the image
+    image_bytes = None
+    write_png(output_img, q_image.image, indexed_png)
+else:
+    image_bytes = q_image.to_bytes(output_format, indexed_png)
+    with open(output_img, 'wb') as f:
+        f.write(image_bytes)
 print('Successfully saved')
 
 print("Palette colors usage:")
 colors_sorted = sorted(q_image.color_pixels.items(), key=lambda i: i[1], reverse=True)
-image_area = q_image.image.shape[0] * q_image.image.shape[1]
+image_area = q_image.shape[0] * q_image.shape[1]
 for item in colors_sorted:
     area_percentage = (item[1] / image_area) * 100
     print(f"Color: {item[0].name} {item[0].vendor}, area: {area_percentage} %")
 
 html_file = output_img + ".html"
 print("Saving results to HTML file " + html_file)
-html_result = image_and_palette_as_html(q_image)
+# the HTML report embeds a JPEG image, the output image is reused if it is a JPEG already
+if full_resolution:
+    # a full resolution image would make the report huge, it embeds a downscaled copy
+    html_result = image_and_palette_as_html(q_image, image_to_bytes(resize_image_if_too_large(q_image.image), "jpg"))
+elif output_format in ("jpg", "jpeg"):
+    html_result = image_and_palette_as_html(q_image, image_bytes, output_format)
+else:
+    html_result = image_and_palette_as_html(q_image)
 with open(html_file, 'w') as f:
     f.write(html_result)
 
+if full_resolution:
+    del q_image
+    os.remove(result_path)
+
 exit(0)
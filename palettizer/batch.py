@@ -0,0 +1,158 @@
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Union
+from . palette import Palette
+from . quantize import quantize, quantize_tiled, QuantizedImage, DEFAULT_KMEANS_PRESET
+from . htmlview import render_outputs
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+REPORT_FILE_NAME = "report.jsonl"
+
+# set once per worker process by __init_worker, so the palette is not sent along with every image
+__WORKER_PALETTE = None
+
+
+def find_images(input_path: str) -> list:
+    """List the image files of a directory, or the files matching a glob pattern"""
+    if os.path.isdir(input_path):
+        paths = [str(p) for p in Path(input_path).iterdir()
+                 if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES]
+    else:
+        paths = [p for p in glob.glob(input_path, recursive=True) if os.path.isfile(p)]
+    return sorted(paths)
+
+
+def quantize_batch(images: list,
+                   palette: Palette,
+                   output_dir: Union[str, Path],
+                   n_colors=0,
+                   kmeans_preset=DEFAULT_KMEANS_PRESET,
+                   full_resolution=False,
+                   indexed_png=False,
+                   workers: int = None,
+                   report_path: Union[str, Path] = None,
+                   memory_budget_bytes: int = None,
+                   dither=False) -> int:
+    """Quantize the images in a pool of worker processes.
+
+    The quantized image and the HTML report of every image are saved to output_dir, in the subdirectories
+    of the images relative to their common directory, and a JSON line
+    with the colors usage and timings of every image is appended to report_path (output_dir/report.jsonl
+    by default) as soon as the image is done. Returns the number of images which failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(images)))
+    # the workers share the CPU, so the native libraries of each one shouldn't use all the cores
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    report_path = Path(report_path) if report_path else output_dir.joinpath(REPORT_FILE_NAME)
+
+    output_paths = __get_output_paths(output_dir, images)
+    for directory in {p.parent for p in output_paths}:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    logging.info("Quantizing {} images with {} workers".format(len(images), workers))
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=get_context("spawn"),
+                             initializer=__init_worker,
+                             initargs=(palette, threads_per_worker)) as executor, \
+            open(report_path, mode='a', encoding='utf8') as report:
+        futures = [executor.submit(__process_image, str(image), str(output_path),
+                                   n_colors, kmeans_preset, full_resolution, indexed_png, memory_budget_bytes,
+                                   dither)
+                   for image, output_path in zip(images, output_paths)]
+        for future in as_completed(futures):
+            record = future.result()
+            if "error" in record:
+                failed += 1
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+    return failed
+
+
+def color_usage(q_image: QuantizedImage) -> list:
+    """Colors of the quantized image with their pixels and area percentage, the most used colors first"""
+    image_area = q_image.shape[0] * q_image.shape[1]
+    colors_sorted = sorted(q_image.color_pixels.items(), key=lambda i: i[1], reverse=True)
+    return [{"name": color.name,
+             "vendor": color.vendor,
+             "rgb": "{:02x}{:02x}{:02x}".format(color.r, color.g, color.b),
+             "pixels": int(pixels),
+             "percentage": pixels / image_area * 100}
+            for color, pixels in colors_sorted]
+
+
+def limit_native_threads(threads: int):
+    """Limit the threads of the native libraries, so several processes together don't oversubscribe the CPU"""
+    for env in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[env] = str(threads)
+    import cv2
+    import faiss
+    from threadpoolctl import threadpool_limits
+    cv2.setNumThreads(threads)
+    faiss.omp_set_num_threads(threads)
+    threadpool_limits(limits=threads)
+
+
+def __init_worker(palette: Palette, threads: int):
+    global __WORKER_PALETTE
+    __WORKER_PALETTE = palette
+    limit_native_threads(threads)
+
+
+def __process_image(image: str, output: str, n_colors: int, kmeans_preset: str,
+                    full_resolution: bool, indexed_png: bool, memory_budget_bytes: int, dither: bool) -> dict:
+    record = {"input": image, "output": output, "html": output + ".html"}
+    start = time.perf_counter()
+    try:
+        if full_resolution:
+            q_image = quantize_tiled(image, __WORKER_PALETTE, n_colors, kmeans_preset=kmeans_preset, dither=dither)
+        else:
+            q_image = quantize(image, __WORKER_PALETTE, n_colors, kmeans_preset=kmeans_preset,
+                               memory_budget_bytes=memory_budget_bytes, dither=dither)
+        record["quantize_seconds"] = time.perf_counter() - start
+
+        image_png, html = render_outputs(q_image, indexed_png)
+        with open(output, mode='wb') as f:
+            f.write(image_png)
+        with open(record["html"], mode='w', encoding='utf8') as f:
+            f.write(html)
+    except Exception as e:
+        logging.error(msg="Failed to quantize " + image, exc_info=e)
+        record["error"] = str(e)
+        record["seconds"] = time.perf_counter() - start
+        return record
+
+    record["seconds"] = time.perf_counter() - start
+    record["height"], record["width"] = q_image.shape[:2]
+    record.update(q_image.stats.as_dict())
+    record["colors"] = color_usage(q_image)
+    return record
+
+
+def __get_output_paths(output_dir: Path, images: list) -> list:
+    """The output paths keep the directories of the images relative to their common directory (e.g. of a recursive
+    glob pattern), the images with the same name but another extension get a number after the name"""
+    if not images:
+        return []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(image)) for image in images])
+    taken = set()
+    paths = []
+    for image in images:
+        relative = Path(os.path.relpath(os.path.abspath(image), root))
+        path = output_dir.joinpath(relative.parent, relative.stem + ".png")
+        number = 1
+        while path in taken:
+            number += 1
+            path = output_dir.joinpath(relative.parent, "{}-{}.png".format(relative.stem, number))
+        taken.add(path)
+        paths.append(path)
+    return paths
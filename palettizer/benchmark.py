@@ -0,0 +1,225 @@
+"""Benchmarks of quantize() on the bundled images.
+
+Run the benchmarks and save the results, the images are in palettizer/test/resources of the source tree:
+    python -m palettizer.benchmark run results.json [--images-dir path/to/images]
+Compare the results with a baseline saved earlier, exits with 1 if there are regressions:
+    python -m palettizer.benchmark compare baseline.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import numpy as np
+from . palette import Palette
+from . quantize import quantize, EUCLIDEAN_METRIC, DELTA_E_METRIC
+from . matching import FAISS_BACKEND, SKLEARN_BACKEND, DEFAULT_BACKEND
+from . htmlview import image_and_palette_as_html
+from . lookup import CACHE_DIR_ENV
+
+# the images aren't packaged, so this directory exists only in the source tree
+BENCHMARK_IMAGES_DIR = Path(os.path.realpath(__file__)).parent.joinpath("test", "resources")
+BENCHMARK_IMAGES = ["bliss.jpg", "october.jpg"]
+BENCHMARK_N_COLORS = 15
+DEFAULT_REPEAT = 3
+# a case is a regression if it is slower or takes more memory than the baseline by this fraction
+DEFAULT_THRESHOLD = 0.2
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    image: str
+    palette: str
+    n_colors: int
+    metric: str
+    backend: str = DEFAULT_BACKEND
+
+    def id(self) -> str:
+        case_id = "{}/{}/{}/{}".format(self.image, self.palette or "no-palette",
+                                       self.n_colors if self.n_colors > 0 else "unlimited", self.metric)
+        # the IDs of the default backend cases are kept, so they are compared with the older baselines
+        return case_id if self.backend == DEFAULT_BACKEND else "{}/{}".format(case_id, self.backend)
+
+
+def get_cases(images=None, palettes=None) -> list:
+    """All the branches of quantize(): without a palette, and for every palette with limited and unlimited
+    number of colors, with both metrics, the Euclidean one with both backends"""
+    images = images or BENCHMARK_IMAGES
+    palettes = palettes or Palette.PREDEFINED_PALETTES
+    cases = []
+    for image in images:
+        cases.append(BenchmarkCase(image, "", BENCHMARK_N_COLORS, EUCLIDEAN_METRIC))
+        for palette in palettes:
+            for n_colors in [BENCHMARK_N_COLORS, 0]:
+                for backend in [FAISS_BACKEND, SKLEARN_BACKEND]:
+                    cases.append(BenchmarkCase(image, palette, n_colors, EUCLIDEAN_METRIC, backend))
+                cases.append(BenchmarkCase(image, palette, n_colors, DELTA_E_METRIC))
+    return cases
+
+
+def run_case(case: BenchmarkCase, images_dir=BENCHMARK_IMAGES_DIR, repeat=DEFAULT_REPEAT) -> dict:
+    """Measure the time of the first run with empty caches, the time of every stage with the caches filled
+    (median of the repeats), the peak memory and the throughput.
+
+    The "quantize" stage is the total time of quantize(), the other stages are its parts and the HTML rendering.
+    """
+    path = str(Path(images_dir).joinpath(case.image))
+    palette = Palette.from_predefined(case.palette) if case.palette else None
+
+    # tracing the allocations slows the run down so it isn't timed
+    with __empty_cache_dir():
+        tracemalloc.start()
+        try:
+            __run_stages(path, palette, case)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    # the first run fills the caches on disk (e.g. the palette lookup tables), the repeats reuse them
+    with __empty_cache_dir():
+        cold_stages, pixels = __run_stages(path, palette, case)
+        runs = [__run_stages(path, palette, case) for _ in range(repeat)]
+    stages = {stage: statistics.median(run[0][stage] for run in runs) for stage in runs[0][0]}
+    total_times = [run[0]["quantize"] + run[0]["html"] for run in runs]
+    return {
+        "case": case.id(),
+        **asdict(case),
+        "pixels": pixels,
+        "stages": stages,
+        "cold_seconds": cold_stages["quantize"] + cold_stages["html"],
+        "seconds": statistics.median(total_times),
+        "min_seconds": min(total_times),
+        "peak_memory_mb": peak_memory / (1024 * 1024),
+        "megapixels_per_second": pixels / 1e6 / stages["quantize"]
+    }
+
+
+def run(output: str, images=None, palettes=None, repeat=DEFAULT_REPEAT, images_dir=BENCHMARK_IMAGES_DIR) -> dict:
+    if not Path(images_dir).is_dir():
+        raise Exception("The benchmark images directory {} is not found, the images are in palettizer/test/resources "
+                        "of the source tree".format(images_dir))
+    cases = get_cases(images, palettes)
+    results = []
+    for i, case in enumerate(cases):
+        print("[{}/{}] {}".format(i + 1, len(cases), case.id()), end="", flush=True)
+        result = run_case(case, images_dir, repeat)
+        print(": {:.3f} s cold, {:.3f} s, {:.1f} MB".format(result["cold_seconds"], result["seconds"],
+                                                           result["peak_memory_mb"]))
+        results.append(result)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }
+    with open(output, mode='w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def compare(baseline: dict, current: dict, threshold=DEFAULT_THRESHOLD) -> list:
+    """Find the cases which got slower or take more memory than in the baseline by more than threshold.
+
+    Returns a list of (case ID, measure, baseline value, current value).
+    """
+    baseline_results = {r["case"]: r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = baseline_results.get(result["case"])
+        if base is None:
+            continue
+        for measure in ["cold_seconds", "seconds", "peak_memory_mb"]:
+            # the baselines saved before the cold runs were measured have no cold_seconds
+            if measure in base and result[measure] > base[measure] * (1 + threshold):
+                regressions.append((result["case"], measure, base[measure], result[measure]))
+    return regressions
+
+
+def __print_comparison(baseline: dict, current: dict, regressions: list):
+    baseline_results = {r["case"]: r for r in baseline["results"]}
+    regressed_cases = {r[0] for r in regressions}
+    for result in current["results"]:
+        base = baseline_results.get(result["case"])
+        if base is None:
+            print("{}: {:.3f} s, not in the baseline".format(result["case"], result["seconds"]))
+            continue
+        print("{}{}: cold {:.3f} s -> {:.3f} s, {:.3f} s -> {:.3f} s ({:+.1f}%), {:.1f} MB -> {:.1f} MB".format(
+            "REGRESSION " if result["case"] in regressed_cases else "",
+            result["case"], base.get("cold_seconds", float("nan")), result["cold_seconds"],
+            base["seconds"], result["seconds"],
+            (result["seconds"] / base["seconds"] - 1) * 100,
+            base["peak_memory_mb"], result["peak_memory_mb"]))
+
+
+@contextmanager
+def __empty_cache_dir():
+    """Point the cache directory to a new empty one for the time of the context"""
+    previous = os.environ.get(CACHE_DIR_ENV)
+    with tempfile.TemporaryDirectory(prefix="palettizer-benchmark-") as cache_dir:
+        os.environ[CACHE_DIR_ENV] = cache_dir
+        try:
+            yield cache_dir
+        finally:
+            if previous is None:
+                del os.environ[CACHE_DIR_ENV]
+            else:
+                os.environ[CACHE_DIR_ENV] = previous
+
+
+def __run_stages(path: str, palette: Palette, case: BenchmarkCase) -> tuple:
+    q_image = quantize(path, palette, case.n_colors, case.metric, backend=case.backend)
+    stages = dict(q_image.stats.stages)
+    stages["quantize"] = q_image.stats.total_seconds()
+
+    start = time.perf_counter()
+    image_and_palette_as_html(q_image)
+    stages["html"] = time.perf_counter() - start
+    return stages, q_image.shape[0] * q_image.shape[1]
+
+
+def __main(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="python -m palettizer.benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and save the results to a JSON file")
+    run_parser.add_argument("output")
+    run_parser.add_argument("--images", help="comma-separated image file names, all bundled images by default")
+    run_parser.add_argument("--images-dir", default=BENCHMARK_IMAGES_DIR,
+                            help="directory of the images, palettizer/test/resources of the source tree by default")
+    run_parser.add_argument("--palettes", help="comma-separated palette IDs, all predefined palettes by default")
+    run_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    compare_parser = commands.add_parser("compare", help="compare the results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        run(args.output,
+            args.images.split(",") if args.images else None,
+            args.palettes.split(",") if args.palettes else None,
+            args.repeat,
+            args.images_dir)
+        return 0
+
+    with open(args.baseline, encoding='utf8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf8') as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    __print_comparison(baseline, current, regressions)
+    print("{} regressions found".format(len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(__main(sys.argv[1:]))
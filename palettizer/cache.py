@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+import numpy as np
+from . imgutils import np_image_to_flat_array, unique_colors, get_labels_dtype
+from . lookup import get_cache_dir
+from . matching import EUCLIDEAN_METRIC, DEFAULT_BACKEND
+from . palette import Palette, Color
+from . quantize import quantize, get_kmeans_preset, QuantizedImage, KMeansPreset, DEFAULT_KMEANS_PRESET
+from . stats import collect_stats, stage, count
+
+DEFAULT_MAX_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 2 * 1024 * 1024 * 1024
+# bump it whenever the key or the stored data changes, so the entries cached on disk are not reused
+CACHE_FORMAT_VERSION = 3
+
+
+class CachedResult:
+    """Compact form of a QuantizedImage: a label per pixel, the RGB codebook and the colors usage"""
+
+    def __init__(self, labels: np.ndarray, codebook: np.ndarray, color_pixels: list[tuple[Color, int]]):
+        self.labels = labels
+        self.codebook = codebook
+        self.color_pixels = color_pixels
+
+    def size_bytes(self) -> int:
+        return self.labels.nbytes + self.codebook.nbytes + 64 * len(self.color_pixels)
+
+    def to_quantized_image(self) -> QuantizedImage:
+        return QuantizedImage(None, dict(self.color_pixels), labels=self.labels, codebook=self.codebook)
+
+    @staticmethod
+    def from_quantized_image(q_image: QuantizedImage):
+        if q_image.labels is not None:
+            return CachedResult(q_image.labels, q_image.codebook, list(q_image.color_pixels.items()))
+        image = q_image.image
+        codebook, inverse = unique_colors(np_image_to_flat_array(image))
+        labels = inverse.astype(get_labels_dtype(codebook.shape[0])).reshape(image.shape[:2])
+        return CachedResult(labels, codebook, list(q_image.color_pixels.items()))
+
+
+class QuantizationCache:
+    """Cache of quantize() results keyed by the image content and the quantization parameters.
+
+    The results are kept in a memory LRU of up to max_memory_bytes and, if a directory is given,
+    on disk up to max_disk_bytes, the least recently used files are removed first.
+    """
+
+    def __init__(self, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+                 directory: Union[str, Path, None] = None,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = Path(directory) if directory is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict = OrderedDict()
+        self.__memory_bytes = 0
+
+    @staticmethod
+    def on_disk(max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """Cache with the disk tier in the default cache directory"""
+        return QuantizationCache(max_memory_bytes, get_cache_dir().joinpath("results"), max_disk_bytes)
+
+    def quantize(self, img: Union[str, bytes, bytearray],
+                 palette: Palette = None,
+                 n_colors=0,
+                 metric=EUCLIDEAN_METRIC,
+                 backend=DEFAULT_BACKEND,
+                 kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+                 memory_budget_bytes: int = None,
+                 dither=False,
+                 init_centroids: np.ndarray = None) -> QuantizedImage:
+        """Same as palettizer.quantize.quantize(), but returns the cached result when there is one"""
+        with collect_stats() as stats:
+            with stage("cache_lookup"):
+                key = QuantizationCache.get_key(img, palette, n_colors, metric, backend, kmeans_preset,
+                                                memory_budget_bytes, dither, init_centroids)
+                result = self.get(key)
+            count("cache_hit", result is not None)
+            if result is None:
+                result = quantize(img, palette, n_colors, metric, backend, kmeans_preset, memory_budget_bytes,
+                                  dither, init_centroids=init_centroids)
+                with stage("cache_store"):
+                    self.put(key, result)
+            result.stats = stats
+            return result
+
+    @staticmethod
+    def get_key(img: Union[str, bytes, bytearray],
+                palette: Palette,
+                n_colors: int,
+                metric: str,
+                backend: str,
+                kmeans_preset: Union[str, KMeansPreset],
+                memory_budget_bytes: int = None,
+                dither=False,
+                init_centroids: np.ndarray = None) -> str:
+        digest = hashlib.sha256()
+        if isinstance(img, str):
+            with open(img, 'rb') as f:
+                digest.update(f.read())
+        elif isinstance(img, (bytes, bytearray)):
+            digest.update(img)
+        else:
+            raise Exception(f"Cannot cache the image, expected a path or bytes array, but got {type(img)}")
+        digest.update(json.dumps({
+            "version": CACHE_FORMAT_VERSION,
+            "palette": None if palette is None else palette.digest(),
+            "n_colors": n_colors,
+            "metric": metric,
+            "backend": backend,
+            "kmeans_preset": repr(get_kmeans_preset(kmeans_preset)),
+            "memory_budget_bytes": memory_budget_bytes,
+            "dither": dither,
+            # K-means converges to slightly different colors from other initial centroids
+            "init_centroids": None if init_centroids is None else
+            hashlib.sha256(np.ascontiguousarray(init_centroids, dtype=np.float32).tobytes()).hexdigest()
+        }).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[QuantizedImage]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry.to_quantized_image()
+        entry = self.__load(key)
+        with self.__lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.__put_to_memory(key, entry)
+        return entry.to_quantized_image()
+
+    def put(self, key: str, q_image: QuantizedImage):
+        entry = CachedResult.from_quantized_image(q_image)
+        with self.__lock:
+            self.__put_to_memory(key, entry)
+        self.__save(key, entry)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.memory_hits + self.disk_hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.__entries),
+                "memory_bytes": self.__memory_bytes
+            }
+
+    def __put_to_memory(self, key: str, entry: CachedResult):
+        if key in self.__entries:
+            self.__memory_bytes -= self.__entries.pop(key).size_bytes()
+        if entry.size_bytes() > self.max_memory_bytes:
+            return
+        self.__entries[key] = entry
+        self.__memory_bytes += entry.size_bytes()
+        while self.__memory_bytes > self.max_memory_bytes:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__memory_bytes -= evicted.size_bytes()
+
+    def __get_path(self, key: str) -> Path:
+        return self.directory.joinpath(key + ".npz")
+
+    def __load(self, key: str) -> Optional[CachedResult]:
+        if self.directory is None:
+            return None
+        path = self.__get_path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                color_pixels = [(Color(*c[:5]), c[5]) for c in json.loads(str(data["color_pixels"]))]
+                entry = CachedResult(data["labels"], data["codebook"], color_pixels)
+            # the modification time is used to find the least recently used files
+            os.utime(path)
+            return entry
+        except Exception as e:
+            logging.warning("Failed to load the cached result from {}: {}".format(path, e))
+            return None
+
+    def __save(self, key: str, entry: CachedResult):
+        if self.directory is None:
+            return
+        path = self.__get_path(key)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            color_pixels = json.dumps([(c.r, c.g, c.b, c.name, c.vendor, n) for c, n in entry.color_pixels])
+            tmp_path = path.with_suffix(".tmp.npz")
+            np.savez_compressed(tmp_path, labels=entry.labels, codebook=entry.codebook,
+                                color_pixels=np.array(color_pixels))
+            os.replace(tmp_path, path)
+            self.__trim_disk()
+        except Exception as e:
+            logging.warning("Failed to save the result to cache {}: {}".format(path, e))
+
+    def __trim_disk(self):
+        files = [(f, f.stat()) for f in self.directory.glob("*.npz") if not f.name.endswith(".tmp.npz")]
+        total = sum(stat.st_size for _, stat in files)
+        for f, stat in sorted(files, key=lambda i: i[1].st_mtime):
+            if total <= self.max_disk_bytes:
+                break
+            f.unlink(missing_ok=True)
+            total -= stat.st_size
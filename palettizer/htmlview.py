@@ -1,20 +1,40 @@
 from jinja2 import Environment, FunctionLoader, select_autoescape
 import numpy as np
-from . imgutils import np_image_to_base64, to_hsv
-from . palette import Color
+from . imgutils import bytes_to_base64, flat_array_to_hsv
 from . quantize import QuantizedImage
+from . stats import stage
 from importlib import resources
 
+HTML_IMAGE_FORMAT = "jpg"
 
-def image_and_palette_as_html(q_image: QuantizedImage):
-    colors_sorted = sorted(q_image.color_pixels.items(), key=lambda i: __get_hue(i[0]), reverse=True)
-    colors_percentage = list(map(lambda i: __pixels_to_percentage(i, q_image.image), colors_sorted))
-    max_percentage = max(map(lambda i: i['percentage'], colors_percentage))
-    img_base64 = np_image_to_base64(q_image.image, "jpg")
-    return __render_template("template.html", {
-        "image": {"format": "jpg", "base64": img_base64},
-        "colors": colors_percentage,
-        "max_percentage": max_percentage})
+
+def image_and_palette_as_html(q_image: QuantizedImage, image_bytes: bytes = None, image_format=HTML_IMAGE_FORMAT):
+    """Render the HTML report, image_bytes is the image already encoded in image_format, if there is one"""
+    if image_bytes is None:
+        with stage("jpeg_encoding"):
+            image_bytes = q_image.to_bytes(image_format)
+    with stage("html_rendering"):
+        colors = list(q_image.color_pixels.keys())
+        pixels = np.fromiter(q_image.color_pixels.values(), dtype=np.float64, count=len(colors))
+        percentages = (pixels * 100.00) / (q_image.shape[0] * q_image.shape[1])
+        # the colors are sorted by hue, the hues of all colors are computed at once
+        hues = flat_array_to_hsv(np.array([(c.r, c.g, c.b) for c in colors], dtype=np.uint8))[:, 0]
+        order = np.argsort(-hues, kind="stable")
+        colors_percentage = [{'color': colors[i], 'percentage': float(percentages[i])} for i in order]
+        return __render_template("template.html", {
+            "image": {"format": image_format, "base64": bytes_to_base64(image_bytes)},
+            "colors": colors_percentage,
+            "max_percentage": float(percentages.max())})
+
+
+def render_outputs(q_image: QuantizedImage, indexed_png=False) -> tuple[bytes, str]:
+    """Encode the image as PNG and render the HTML report, every artifact is encoded once.
+
+    With indexed_png=True the PNG is written with a color palette if the image has up to 256 colors.
+    """
+    with stage("png_encoding"):
+        image_png = q_image.to_bytes(indexed=indexed_png)
+    return image_png, image_and_palette_as_html(q_image)
 
 
 def __load_template(name: str) -> str:
@@ -30,12 +50,3 @@ __ENV = Environment(loader=FunctionLoader(__load_template), autoescape=select_au
 def __render_template(template: str, variables: dict):
     template = __ENV.get_template(template)
     return template.render(variables)
-
-
-def __pixels_to_percentage(color_pixel: tuple[Color, int], img: np.ndarray) -> dict:
-    percentage = (color_pixel[1] * 100.00) / (img.shape[0] * img.shape[1])
-    return {'color': color_pixel[0], 'percentage': percentage}
-
-
-def __get_hue(c: Color):
-    return to_hsv(c.r, c.g, c.b)[0]
@@ -2,15 +2,38 @@ import numpy as np
 import imageio.v2 as imageio
 from skimage import io
 from skimage.util import img_as_ubyte
-from typing import Union
+from typing import Union, Optional
+import math
+from PIL import Image
 from io import BytesIO
 import base64
+import struct
+import zlib
 from skimage.color import rgb2hsv
 import cv2
 from colour import delta_E
 
+# zlib level of the PNG images, 3 is much faster than the default while the files are only a bit larger
+PNG_COMPRESSION_LEVEL = 3
+MAX_INDEXED_PNG_COLORS = 256
+# rows of a large image encoded at once by write_png()
+PNG_BLOCK_ROWS = 256
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# number of pixels processed at once when building inverse maps and histograms, bounds the temporary arrays
+INVERSE_CHUNK_SIZE = 1 << 20
+# size of the Bayer threshold matrix of the ordered dithering, a power of 2
+DITHER_MATRIX_SIZE = 8
 
-def read_rgb_image(path: Union[str, bytes, bytearray]) -> np.ndarray:
+
+def read_rgb_image(path: Union[str, bytes, bytearray], min_size: int = None) -> np.ndarray:
+    """Read an image as an RGB uint8 array.
+
+    If min_size is set, a large JPEG image is decoded at a reduced scale (1/2, 1/4 or 1/8)
+    with its longer side still not shorter than min_size.
+    """
+    img = __read_reduced_jpeg(path, min_size) if min_size is not None else None
+    if img is not None:
+        return img
     if isinstance(path, str):
         img = io.imread(path)
     elif isinstance(path, bytes):
@@ -30,19 +53,148 @@ def read_rgb_image(path: Union[str, bytes, bytearray]) -> np.ndarray:
     return img
 
 
-def image_to_bytes(img: np.ndarray, file_format='png') -> bytes:
+def read_large_rgb_image(path: Union[str, bytes, bytearray]) -> np.ndarray:
+    """Read an image as an RGB uint8 array decoded straight into it by OpenCV, without the temporary
+    copies made by read_rgb_image(), which take several times the size of a very large image.
+    The alpha channel and the EXIF orientation are ignored the same way as by read_rgb_image()."""
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if isinstance(path, str):
+        img = cv2.imread(path, flags)
+    elif isinstance(path, (bytes, bytearray)):
+        img = cv2.imdecode(np.frombuffer(path, dtype=np.uint8), flags)
+    else:
+        raise Exception(f"Cannot read image, expected a path or bytes array, but got {type(path)}")
+    if img is None:
+        raise Exception("Failed to decode the image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+
+def read_image_size(path: Union[str, bytes, bytearray]) -> Optional[tuple[int, int]]:
+    """Read height and width of an image from its header without decoding it, None if the format is unknown"""
+    try:
+        with Image.open(__as_file(path)) as img:
+            return img.size[1], img.size[0]
+    except Exception:
+        return None
+
+
+def __read_reduced_jpeg(path: Union[str, bytes, bytearray], min_size: int) -> Optional[np.ndarray]:
+    try:
+        with Image.open(__as_file(path)) as img:
+            if img.format != "JPEG" or img.mode != "RGB" or max(img.size) <= min_size:
+                return None
+            scale = min_size / max(img.size)
+            # JPEG decoder scales the image down while decoding (DCT scaling) keeping it not smaller than requested
+            img.draft("RGB", (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
+            return np.asarray(img.convert("RGB"))
+    except Exception:
+        return None
+
+
+def __as_file(path: Union[str, bytes, bytearray]):
+    if isinstance(path, (bytes, bytearray)):
+        return BytesIO(path)
+    return path
+
+
+def image_to_bytes(img: np.ndarray, file_format='png', indexed=False) -> bytes:
+    """Encode the image, with indexed=True a PNG image of up to 256 colors is written with a color palette"""
+    if file_format == 'png' and indexed:
+        image_bin = image_to_indexed_png(img)
+        if image_bin is not None:
+            return image_bin
+    if file_format == 'png':
+        ok, image_bin = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                                     [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION_LEVEL])
+        if not ok:
+            raise Exception("Failed to encode the image as PNG")
+        return image_bin.tobytes()
     with BytesIO() as buf:
         imageio.imwrite(buf, img, format=file_format)
         image_bin = buf.getvalue()
     return image_bin
 
 
-def np_image_to_base64(img: np.ndarray, img_format: str):
+def image_to_indexed_png(img: np.ndarray) -> Optional[bytes]:
+    """Encode the image as an 8-bit palette-indexed PNG, None if it has more than 256 colors"""
+    keys = color_keys(np_image_to_flat_array(img))
+    # np.unique without the inverse map is much faster, the indexes are found among the few unique colors
+    unique_keys = np.unique(keys)
+    if unique_keys.shape[0] > MAX_INDEXED_PNG_COLORS:
+        return None
+    indexes = np.searchsorted(unique_keys, keys).astype(np.uint8)
+    return labels_to_indexed_png(indexes.reshape(img.shape[:2]), keys_to_colors(unique_keys))
+
+
+def labels_to_indexed_png(labels: np.ndarray, codebook: np.ndarray) -> bytes:
+    """Encode an image given as a label per pixel and an RGB codebook of up to 256 colors as an indexed PNG"""
+    if codebook.shape[0] > MAX_INDEXED_PNG_COLORS:
+        raise Exception(f"Indexed PNG can have up to {MAX_INDEXED_PNG_COLORS} colors, but got {codebook.shape[0]}")
+    indexed_image = Image.fromarray(labels.astype(np.uint8, copy=False), mode="P")
+    indexed_image.putpalette(np.ascontiguousarray(codebook, dtype=np.uint8).tobytes())
     with BytesIO() as buf:
-        imageio.imwrite(buf, img, format=img_format)
-        image_bin = buf.getvalue()
-        image_b64 = base64.b64encode(image_bin).decode("utf-8")
-        return image_b64
+        indexed_image.save(buf, format="PNG", compress_level=PNG_COMPRESSION_LEVEL)
+        return buf.getvalue()
+
+
+def write_png(path: str, img: np.ndarray, indexed=False, block_rows=PNG_BLOCK_ROWS):
+    """Write the RGB image as PNG by blocks of rows, so no full-size copy of a large image is made,
+    e.g. of a memory-mapped one. With indexed=True the image is written with a color palette if it has
+    up to 256 colors, see image_to_bytes()."""
+    height, width = img.shape[:2]
+    palette_keys = __find_palette_keys(img, block_rows) if indexed else None
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        # bit depth 8, color type 3 (palette) or 2 (RGB), default compression, filtering and no interlace
+        __write_png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+                                                  2 if palette_keys is None else 3, 0, 0, 0))
+        if palette_keys is not None:
+            __write_png_chunk(f, b"PLTE", keys_to_colors(palette_keys).tobytes())
+        compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL)
+        for start in range(0, height, block_rows):
+            block = img[start:start + block_rows]
+            if palette_keys is not None:
+                pixels = np.searchsorted(palette_keys, color_keys(np_image_to_flat_array(block))).astype(np.uint8)
+            else:
+                pixels = block
+            # every row starts with the filter type, 0 means no filter
+            rows = np.zeros((block.shape[0], 1 + pixels.size // block.shape[0]), dtype=np.uint8)
+            rows[:, 1:] = pixels.reshape((block.shape[0], -1))
+            data = compressor.compress(rows.tobytes())
+            if data:
+                __write_png_chunk(f, b"IDAT", data)
+        __write_png_chunk(f, b"IDAT", compressor.flush())
+        __write_png_chunk(f, b"IEND", b"")
+
+
+def __find_palette_keys(img: np.ndarray, block_rows: int) -> Optional[np.ndarray]:
+    # the sorted keys of the colors of the image, None if there are too many of them for a palette
+    keys = np.empty(0, dtype=np.uint32)
+    for start in range(0, img.shape[0], block_rows):
+        keys = np.union1d(keys, color_keys(np_image_to_flat_array(img[start:start + block_rows])))
+        if keys.shape[0] > MAX_INDEXED_PNG_COLORS:
+            return None
+    return keys
+
+
+def __write_png_chunk(f, chunk_type: bytes, data: bytes):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+
+def np_image_to_base64(img: np.ndarray, img_format: str):
+    return bytes_to_base64(image_to_bytes(img, img_format))
+
+
+def bytes_to_base64(image_bin: bytes) -> str:
+    return base64.b64encode(image_bin).decode("utf-8")
+
+
+def get_labels_dtype(n_codes: int):
+    """The smallest unsigned integer type for the labels of a codebook of n_codes colors"""
+    return np.uint8 if n_codes <= 256 else np.uint16 if n_codes <= 65536 else np.uint32
 
 
 def np_image_to_flat_array(img: np.ndarray):
@@ -50,13 +202,123 @@ def np_image_to_flat_array(img: np.ndarray):
     return np.reshape(img, (w * h, d))
 
 
+def unique_colors(arr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Find unique colors of a flat uint8 RGB array.
+
+    Returns the unique colors as a flat uint8 RGB array and the inverse map: arr == unique[inverse].
+    """
+    unique_keys, inverse = np.unique(color_keys(arr), return_inverse=True)
+    # int32 is enough for up to 2^24 colors and takes half the memory of the int64 inverse map
+    inverse = inverse.reshape(-1).astype(np.int32)
+    return keys_to_colors(unique_keys), inverse
+
+
+def color_keys(arr: np.ndarray) -> np.ndarray:
+    """24-bit keys of the colors of a flat uint8 RGB array"""
+    return (arr[:, 0].astype(np.uint32) << 16) | (arr[:, 1].astype(np.uint32) << 8) | arr[:, 2]
+
+
+def keys_to_colors(keys: np.ndarray) -> np.ndarray:
+    """Flat uint8 RGB array of the colors of the 24-bit keys, see color_keys()"""
+    colors = np.empty((keys.shape[0], 3), dtype=np.uint8)
+    colors[:, 0] = keys >> 16
+    colors[:, 1] = (keys >> 8) & 0xff
+    colors[:, 2] = keys & 0xff
+    return colors
+
+
+def color_histogram(arr: np.ndarray, bits=8) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Group colors of a flat uint8 RGB array into bins keeping the given number of high bits per channel.
+
+    Returns the mean color of each non-empty bin as a flat float32 RGB array scaled to [0, 1],
+    the number of colors in each bin and the inverse map from the colors to the bins.
+    With 8 bits per channel the bins are the unique colors.
+    """
+    if bits >= 8:
+        unique, inverse = unique_colors(arr)
+        return unique.astype(np.float32) / 255, np.bincount(inverse, minlength=unique.shape[0]), inverse
+    shift = 8 - bits
+    keys = (((arr[:, 0] >> shift).astype(np.uint32) << (2 * bits))
+            | ((arr[:, 1] >> shift).astype(np.uint32) << bits)
+            | (arr[:, 2] >> shift))
+    # there are at most 2^15 or 2^18 bins for 5 or 6 bits, so a dense histogram is cheaper than sorting
+    dense_counts = np.bincount(keys, minlength=1 << (3 * bits))
+    nonempty = np.flatnonzero(dense_counts)
+    bin_indices = np.zeros(dense_counts.shape[0], dtype=np.int32)
+    bin_indices[nonempty] = np.arange(nonempty.shape[0])
+    inverse = bin_indices[keys]
+    counts = dense_counts[nonempty]
+    sums = np.zeros((nonempty.shape[0], 3), dtype=np.float64)
+    # bincount converts the weights to float64, so they are converted a chunk at a time
+    for start in range(0, arr.shape[0], INVERSE_CHUNK_SIZE):
+        chunk_inverse = inverse[start:start + INVERSE_CHUNK_SIZE]
+        for channel in range(3):
+            sums[:, channel] += np.bincount(chunk_inverse, weights=arr[start:start + INVERSE_CHUNK_SIZE, channel],
+                                            minlength=nonempty.shape[0])
+    means = (sums / counts[:, np.newaxis]).astype(np.float32)
+    return means / 255, counts, inverse
+
+
+def bayer_matrix(size=DITHER_MATRIX_SIZE) -> np.ndarray:
+    """Bayer threshold matrix of size x size, a permutation of 0 .. size^2 - 1"""
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def ordered_dither(img: np.ndarray, spread: float, row_offset=0) -> np.ndarray:
+    """Add the offsets of the Bayer threshold matrix, from -spread/2 to spread/2, to the uint8 RGB image.
+
+    The same offset is added to the 3 channels of a pixel. row_offset is the row of the image
+    the given rows start at, so the tiles of an image are dithered with the same pattern as the whole image.
+    """
+    matrix = bayer_matrix()
+    size = matrix.shape[0]
+    thresholds = np.rint(((matrix + 0.5) / (size * size) - 0.5) * spread).astype(np.int16)
+    rows = (np.arange(img.shape[0]) + row_offset) % size
+    cols = np.arange(img.shape[1]) % size
+    dithered = img.astype(np.int16)
+    dithered += thresholds[rows[:, np.newaxis], cols[np.newaxis, :]][:, :, np.newaxis]
+    np.clip(dithered, 0, 255, out=dithered)
+    return dithered.astype(np.uint8)
+
+
 def to_hsv(r: int, g: int, b: int) -> np.ndarray:
     return rgb2hsv(np.array([[[r, g, b]]], dtype=np.uint8))[0][0]
 
 
+def flat_array_to_hsv(arr: np.ndarray) -> np.ndarray:
+    """Convert a flat uint8 RGB array to HSV in one call"""
+    return rgb2hsv(np.asarray(arr, dtype=np.uint8).reshape((1, -1, 3)))[0]
+
+
 def rgb_flat_array_to_lab(arr: np.ndarray) -> np.ndarray:
     return cv2.cvtColor(np.array([arr]), cv2.COLOR_RGB2Lab)[0]
 
 
 def delta_e_2000(u, v):
     return delta_E(u, v, 'CIE 2000')
+
+
+# max number of (u, v) pairs evaluated at once by delta_e_2000_argmin, bounds the size of temporary arrays
+DELTA_E_BLOCK_PAIRS = 1 << 18
+
+
+def delta_e_2000_argmin(lab_u: np.ndarray, lab_v: np.ndarray, block_pairs=DELTA_E_BLOCK_PAIRS) -> np.ndarray:
+    """For each Lab color of lab_u find the index of the closest Lab color of lab_v by CIEDE2000.
+
+    The distances are computed for whole blocks of rows of lab_u at once, each block holds at most
+    block_pairs (u, v) pairs.
+    """
+    lab_u = np.asarray(lab_u, dtype=np.float64).reshape(-1, 3)
+    lab_v = np.asarray(lab_v, dtype=np.float64).reshape(-1, 3)
+    if lab_v.shape[0] == 0:
+        raise Exception("Cannot find the closest colors in an empty array")
+    block_rows = max(1, block_pairs // lab_v.shape[0])
+    indices = np.empty(lab_u.shape[0], dtype=np.int64)
+    for start in range(0, lab_u.shape[0], block_rows):
+        block = lab_u[start:start + block_rows]
+        distances = delta_E(block[:, np.newaxis, :], lab_v[np.newaxis, :, :], 'CIE 2000')
+        indices[start:start + block.shape[0]] = np.argmin(distances, axis=1)
+    return indices
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import numpy as np
+from . imgutils import unique_colors, color_keys, get_labels_dtype
+from . matching import closest_colors
+from . stats import count
+
+# a label for each of the 2^24 RGB colors, the colors are matched to the palette only when they are first seen
+TABLE_SIZE = 1 << 24
+# the table holds the label + 1, so the zeros of a new file mean that the color is not matched yet
+UNKNOWN_COLOR = 0
+# bump it whenever the way the tables are built changes, so the tables cached on disk are rebuilt
+TABLE_FORMAT_VERSION = 2
+MAX_TABLES_IN_MEMORY = 16
+CACHE_DIR_ENV = "PALETTIZER_CACHE_DIR"
+
+
+def get_cache_dir() -> Path:
+    """The directory for the data cached on disk, $PALETTIZER_CACHE_DIR or ~/.cache/palettizer"""
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    return Path(cache_dir) if cache_dir else Path.home().joinpath(".cache", "palettizer")
+
+
+class PaletteLookupTable:
+    """Maps any 24-bit RGB color to the index of the closest palette color.
+
+    The table has an entry for every RGB color, but a color is matched against the palette exactly only
+    the first time it is seen in an image, so the result is always the same as of the exact matching.
+    The table is a memory-mapped file in the cache directory, so the colors matched by one process are
+    reused by the other ones and after a restart; a new file is sparse and only takes the disk space
+    of the colors matched so far.
+    """
+
+    # the tables loaded to this process, by the path of the file, so the tables of another cache directory
+    # are not reused
+    __tables: dict = {}
+
+    def __init__(self, codebook: np.ndarray, metric: str, table: np.ndarray):
+        self.codebook = codebook
+        self.metric = metric
+        self.table = table
+
+    @staticmethod
+    def for_codebook(codebook: np.ndarray, metric: str):
+        """Get the table for the uint8 palette codebook, the table is created empty and filled lazily"""
+        path = PaletteLookupTable.__get_cache_path(PaletteLookupTable.__get_key(codebook, metric))
+        if path in PaletteLookupTable.__tables:
+            return PaletteLookupTable.__tables[path]
+
+        lookup_table = PaletteLookupTable(codebook, metric, PaletteLookupTable.__open(path, codebook.shape[0]))
+        if len(PaletteLookupTable.__tables) >= MAX_TABLES_IN_MEMORY:
+            PaletteLookupTable.__tables.pop(next(iter(PaletteLookupTable.__tables)))
+        PaletteLookupTable.__tables[path] = lookup_table
+        return lookup_table
+
+    def closest_colors(self, colors: np.ndarray) -> np.ndarray:
+        """Find the index of the closest palette color for each color of a flat uint8 RGB array"""
+        keys = color_keys(colors)
+        labels = self.table[keys]
+
+        unknown = np.flatnonzero(labels == UNKNOWN_COLOR)
+        misses = 0
+        if unknown.shape[0] > 0:
+            unique, inverse = unique_colors(colors[unknown])
+            misses = unique.shape[0]
+            logging.info("Matching {} colors not seen before to the palette".format(misses))
+            unique_labels = closest_colors(unique.astype(np.float32) / 255,
+                                           self.codebook.astype(np.float32) / 255,
+                                           self.metric) + 1
+            # the other processes write the same labels for the same colors, so there is no need to lock
+            self.table[color_keys(unique)] = unique_labels
+            labels[unknown] = unique_labels[inverse]
+        count("lookup_misses", misses)
+        return np.subtract(labels, 1, dtype=get_labels_dtype(self.codebook.shape[0]))
+
+    @staticmethod
+    def __get_key(codebook: np.ndarray, metric: str) -> str:
+        digest = hashlib.sha1(np.ascontiguousarray(codebook, dtype=np.uint8).tobytes())
+        digest.update("{}:{}".format(metric, TABLE_FORMAT_VERSION).encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def __get_cache_path(key: str) -> Path:
+        return get_cache_dir().joinpath("lookup", key + ".npy")
+
+    @staticmethod
+    def __open(path: Path, n_colors: int) -> np.ndarray:
+        # label + 1 has to fit, see UNKNOWN_COLOR
+        dtype = np.uint16 if n_colors < np.iinfo(np.uint16).max else np.uint32
+        if path.exists():
+            try:
+                return np.lib.format.open_memmap(path, mode='r+')
+            except Exception as e:
+                logging.warning("Failed to open the color lookup table {}: {}".format(path, e))
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".{}.tmp".format(os.getpid()))
+            # a new memory-mapped file is filled by zeros without writing them, see UNKNOWN_COLOR
+            np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(TABLE_SIZE,)).flush()
+            os.replace(tmp_path, path)
+            return np.lib.format.open_memmap(path, mode='r+')
+        except Exception as e:
+            logging.warning("Failed to create the color lookup table {}: {}".format(path, e))
+            # the colors are still matched only once per process
+            return np.zeros(TABLE_SIZE, dtype=dtype)
@@ -0,0 +1,133 @@
+import faiss
+import numpy as np
+from sklearn.metrics import pairwise_distances_argmin
+from colour import delta_E
+from . imgutils import rgb_flat_array_to_lab, delta_e_2000_argmin, get_labels_dtype, DELTA_E_BLOCK_PAIRS
+from . palette import Palette
+
+DELTA_E_METRIC = "delta_e"
+EUCLIDEAN_METRIC = "euclidean"
+# backends of the nearest color search by Euclidean metric, delta E is always computed by delta_e_2000_argmin
+FAISS_BACKEND = "faiss"
+SKLEARN_BACKEND = "sklearn"
+DEFAULT_BACKEND = FAISS_BACKEND
+# max number of colors searched in the faiss index at once
+FAISS_BATCH_SIZE = 1 << 18
+# number of the closest codebook colors by Euclidean distance in Lab used as the first guess by the delta E search
+DELTA_E_CANDIDATES = 8
+# smaller codebooks are searched by delta E exhaustively, the pruning doesn't pay off for them
+DELTA_E_MIN_PRUNED_CODEBOOK = 32
+# max value of the lightness weight S_L of CIEDE2000, reached at L = 0 and L = 100
+MAX_DELTA_E_2000_S_L = 1 + 0.015 * 50 ** 2 / np.sqrt(20 + 50 ** 2)
+
+
+def closest_colors(colors: np.ndarray, codebook: np.ndarray, metric: str, backend=DEFAULT_BACKEND) -> np.ndarray:
+    """For each RGB color find the index of the closest color of the codebook.
+
+    Both colors and codebook are flat arrays of RGB values scaled to [0, 1].
+    """
+    if metric == DELTA_E_METRIC:
+        return delta_e_2000_pruned_argmin(rgb_flat_array_to_lab(colors.astype(np.float32, copy=False)),
+                                          rgb_flat_array_to_lab(codebook.astype(np.float32, copy=False)))
+    return __euclidean_argmin(colors, codebook, metric, backend)
+
+
+def closest_palette_colors(colors: np.ndarray, palette: Palette, metric: str, backend=DEFAULT_BACKEND) -> np.ndarray:
+    """Same as closest_colors, but reuses the codebooks precomputed by the palette"""
+    if metric == DELTA_E_METRIC:
+        return delta_e_2000_pruned_argmin(rgb_flat_array_to_lab(colors.astype(np.float32, copy=False)),
+                                          palette.to_codebook_palette_lab())
+    return __euclidean_argmin(colors, palette.to_codebook_palette_float32(), metric, backend)
+
+
+def faiss_knn(queries: np.ndarray, codebook: np.ndarray, k=1, batch_size=FAISS_BATCH_SIZE,
+              scale: float = None) -> np.ndarray:
+    """Find indices of k nearest codebook vectors by Euclidean distance for each query vector.
+
+    Works in any color space (RGB, Lab), the search is done in float32 by a flat faiss index,
+    which uses all available threads, in batches of batch_size queries.
+    If scale is set, the queries are multiplied by it, so e.g. uint8 colors can be searched
+    in a codebook scaled to [0, 1] converting only a batch at a time.
+    The indices have the smallest unsigned type that fits the codebook size.
+    """
+    codebook = np.ascontiguousarray(codebook, dtype=np.float32)
+    index = faiss.IndexFlatL2(codebook.shape[1])
+    index.add(codebook)
+    k = min(k, codebook.shape[0])
+    indices = np.empty((queries.shape[0], k), dtype=get_labels_dtype(codebook.shape[0]))
+    for start in range(0, queries.shape[0], batch_size):
+        if scale is not None:
+            # always a copy, so the queries themselves are not scaled
+            batch = queries[start:start + batch_size].astype(np.float32)
+            batch *= scale
+        else:
+            batch = np.ascontiguousarray(queries[start:start + batch_size], dtype=np.float32)
+        indices[start:start + batch.shape[0]] = index.search(batch, k)[1]
+    return indices
+
+
+def delta_e_2000_pruned_argmin(lab_u: np.ndarray, lab_v: np.ndarray, candidates=DELTA_E_CANDIDATES,
+                               block_pairs=DELTA_E_BLOCK_PAIRS) -> np.ndarray:
+    """Same as delta_e_2000_argmin, but computes CIEDE2000 only for the codebook colors which can be the closest.
+
+    The distance to the best of the given number of candidates, the closest colors by Euclidean distance
+    in Lab, bounds the distance to the closest color. CIEDE2000 is not smaller than |L1 - L2| / S_L,
+    so only the codebook colors with the lightness close enough to the color are compared exactly.
+    The result is exact, the number of candidates only affects the speed.
+    """
+    lab_u = np.asarray(lab_u, dtype=np.float64).reshape(-1, 3)
+    lab_v = np.asarray(lab_v, dtype=np.float64).reshape(-1, 3)
+    if lab_v.shape[0] <= max(candidates, DELTA_E_MIN_PRUNED_CODEBOOK):
+        return delta_e_2000_argmin(lab_u, lab_v, block_pairs)
+
+    # the bound is the distance to the best candidate, the slack covers the rounding of the distances
+    bound = np.empty(lab_u.shape[0], dtype=np.float64)
+    knn = faiss_knn(lab_u, lab_v, candidates)
+    block_rows = max(1, block_pairs // candidates)
+    for start in range(0, lab_u.shape[0], block_rows):
+        block = lab_u[start:start + block_rows]
+        distances = delta_E(block[:, np.newaxis, :], lab_v[knn[start:start + block_rows]], 'CIE 2000')
+        bound[start:start + block.shape[0]] = distances.min(axis=1)
+    bound = bound * (1 + 1e-9) + 1e-9
+
+    # the codebook sorted by lightness, each color is compared with a window of it
+    order = np.argsort(lab_v[:, 0], kind="stable")
+    lightness = lab_v[order, 0]
+    window_start = np.searchsorted(lightness, lab_u[:, 0] - MAX_DELTA_E_2000_S_L * bound, side="left")
+    window_sizes = np.searchsorted(lightness, lab_u[:, 0] + MAX_DELTA_E_2000_S_L * bound, side="right") - window_start
+    pairs_end = np.cumsum(window_sizes)
+
+    indices = np.empty(lab_u.shape[0], dtype=np.int64)
+    start = 0
+    while start < lab_u.shape[0]:
+        # as many colors as their windows fit into block_pairs, but at least one
+        pairs_start = pairs_end[start - 1] if start > 0 else 0
+        end = max(start + 1, int(np.searchsorted(pairs_end, pairs_start + block_pairs, side="right")))
+        sizes = window_sizes[start:end]
+        u = np.repeat(np.arange(start, end), sizes)
+        v = order[np.arange(u.shape[0]) + np.repeat(window_start[start:end] - (np.cumsum(sizes) - sizes), sizes)]
+        # the window is too wide for the colors far from L = 0 or 100, S_L of each pair is smaller
+        mean_l = (lab_u[u, 0] + lab_v[v, 0]) / 2
+        s_l = 1 + 0.015 * (mean_l - 50) ** 2 / np.sqrt(20 + (mean_l - 50) ** 2)
+        close = np.abs(lab_u[u, 0] - lab_v[v, 0]) <= bound[u] * s_l
+        u = u[close]
+        v = v[close]
+
+        # the pairs are grouped by the color, every group has at least the best candidate
+        distances = delta_E(lab_u[u], lab_v[v], 'CIE 2000')
+        group_starts = np.flatnonzero(np.concatenate(([True], u[1:] != u[:-1])))
+        min_distances = np.minimum.reduceat(distances, group_starts)
+        groups = np.repeat(np.arange(group_starts.shape[0]), np.diff(np.append(group_starts, u.shape[0])))
+        # the smallest index of the closest colors, as np.argmin does
+        indices[u[group_starts]] = np.minimum.reduceat(
+            np.where(distances == min_distances[groups], v, lab_v.shape[0]), group_starts)
+        start = end
+    return indices
+
+
+def __euclidean_argmin(colors: np.ndarray, codebook: np.ndarray, metric: str, backend: str) -> np.ndarray:
+    if backend == FAISS_BACKEND and metric == EUCLIDEAN_METRIC:
+        return faiss_knn(colors, codebook, 1)[:, 0]
+    if backend not in (FAISS_BACKEND, SKLEARN_BACKEND):
+        raise Exception(f"Unknown matching backend {backend}")
+    return pairwise_distances_argmin(colors, codebook, metric=metric)
@@ -1,9 +1,17 @@
+import hashlib
 import json
+import logging
+import mmap
+import operator
+import struct
+from collections.abc import Sequence
 from pathlib import Path
 import os
 from typing import Union
 from dataclasses import dataclass
 import numpy as np
+import threading
+from . imgutils import rgb_flat_array_to_lab
 
 
 @dataclass(eq=True, frozen=True)
@@ -33,46 +41,251 @@ class Color:
         return r, g, b
 
 
+PALETTE_FILE_SUFFIX = "-palette.json"
+PREDEFINED_PALETTES_DIR = Path(os.path.realpath(__file__)).parent.absolute().joinpath("resources")
+# the order of the palettes offered to the users, the palettes added later follow them sorted by ID
+PREDEFINED_PALETTES_ORDER = ("mtnblack", "mtn94", "arton", "tikkurila")
+COMPILED_PALETTE_SUFFIX = ".palette"
+COMPILED_PALETTE_MAGIC = b"PLTZ"
+# bump it whenever the layout of the compiled palettes changes, so the files compiled before are rebuilt
+COMPILED_PALETTE_VERSION = 1
+# magic, version, number of colors, sizes of the strings table, of the name and of the url, content digest
+COMPILED_PALETTE_HEADER = struct.Struct("<4sIIIII32s")
+
+
+class CompiledColors(Sequence):
+    """Colors of a compiled palette, a Color object is created only when it is accessed"""
+
+    def __init__(self, rgb: np.ndarray, string_offsets: np.ndarray, strings: memoryview):
+        self.__rgb = rgb
+        self.__string_offsets = string_offsets
+        self.__strings = strings
+        self.__colors = [None] * rgb.shape[0]
+
+    def __len__(self):
+        return len(self.__colors)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        # the labels are often numpy uint8, the arithmetic on them below would overflow
+        i = operator.index(i)
+        color = self.__colors[i]
+        if color is None:
+            i %= len(self)
+            r, g, b = self.__rgb[i]
+            color = Color(int(r), int(g), int(b), self.__string(2 * i), self.__string(2 * i + 1))
+            self.__colors[i] = color
+        return color
+
+    def __string(self, i: int) -> str:
+        return bytes(self.__strings[self.__string_offsets[i]:self.__string_offsets[i + 1]]).decode("utf-8")
+
+    def __reduce__(self):
+        # the memory-mapped file can't be pickled, the colors are sent to other processes as a plain tuple
+        return tuple, (tuple(self),)
+
+
+class PaletteRegistry:
+    """Palettes found in a directory as <palette ID>-palette.json files.
+
+    The IDs listed in order go first in that order, the other IDs follow sorted.
+    Every file is parsed only once per process, the same Palette object is returned for the same IDs.
+    """
+
+    def __init__(self, directory: Union[str, Path], order: Union[list, tuple] = ()):
+        self.directory = Path(directory)
+        self.__lock = threading.Lock()
+        self.__palettes: dict = {}
+        found = {path.name[:-len(PALETTE_FILE_SUFFIX)] for path in self.directory.glob("*" + PALETTE_FILE_SUFFIX)}
+        self.__ids = tuple([i for i in order if i in found] + sorted(found.difference(order)))
+
+    def ids(self) -> tuple:
+        return self.__ids
+
+    def get(self, palette_ids: Union[list, tuple]) -> "Palette":
+        key = tuple(palette_ids)
+        with self.__lock:
+            if len(key) == 1:
+                return self.__get_single(key[0])
+            if key not in self.__palettes:
+                self.__palettes[key] = Palette.combine([self.__get_single(x) for x in key])
+            return self.__palettes[key]
+
+    def __get_single(self, palette_id: str) -> "Palette":
+        key = (palette_id,)
+        if key not in self.__palettes:
+            self.__palettes[key] = PaletteRegistry.__load(self.__get_palette_path(palette_id))
+        return self.__palettes[key]
+
+    @staticmethod
+    def __load(path: str) -> "Palette":
+        # the palette is compiled once into the cache directory and then memory-mapped by every process
+        from . lookup import get_cache_dir
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read())
+        digest.update(str(COMPILED_PALETTE_VERSION).encode("utf-8"))
+        compiled_path = get_cache_dir().joinpath("palettes", digest.hexdigest() + COMPILED_PALETTE_SUFFIX)
+        if compiled_path.exists():
+            try:
+                return Palette.from_compiled(str(compiled_path))
+            except Exception as e:
+                logging.warning("Failed to load the compiled palette {}: {}".format(compiled_path, e))
+        palette = Palette.from_file(path)
+        try:
+            compiled_path.parent.mkdir(parents=True, exist_ok=True)
+            # every process compiles to its own file, the complete file then replaces the compiled one atomically
+            tmp_path = compiled_path.with_suffix(".{}.tmp".format(os.getpid()))
+            palette.compile(str(tmp_path))
+            os.replace(tmp_path, compiled_path)
+        except Exception as e:
+            logging.warning("Failed to save the compiled palette to {}: {}".format(compiled_path, e))
+        return palette
+
+    def __get_palette_path(self, palette_id: str) -> str:
+        if palette_id not in self.__ids:
+            raise Exception(f"No palette found {palette_id}")
+        return str(self.directory.joinpath(palette_id + PALETTE_FILE_SUFFIX))
+
+
+PREDEFINED_PALETTES_REGISTRY = PaletteRegistry(PREDEFINED_PALETTES_DIR, PREDEFINED_PALETTES_ORDER)
+
+
 class Palette:
-    # TODO get palette names from the resources instead of hardcoding
-    PREDEFINED_PALETTES = ("mtnblack", "mtn94", "arton", "tikkurila")
+    """A set of colors, the palettes are immutable so the codebooks are computed once and then reused"""
+
+    PREDEFINED_PALETTES = PREDEFINED_PALETTES_REGISTRY.ids()
 
-    def __init__(self, colors: list[Color] = None, name="", url=""):
-        self.colors = [] if colors is None else colors
+    def __init__(self, colors: Union[list[Color], tuple, CompiledColors] = None, name="", url=""):
+        if colors is None:
+            colors = ()
+        self.colors = colors if isinstance(colors, CompiledColors) else tuple(colors)
         self.name = name
         self.url = url
+        self.__codebook_uint8 = None
+        self.__codebook_float32 = None
+        self.__codebook_lab = None
+        self.__digest = None
+        self.__strings = None
 
     def size(self):
         return len(self.colors)
 
+    def __getstate__(self):
+        # a compiled palette is backed by a memory-mapped file, it is pickled as plain colors and arrays
+        state = self.__dict__.copy()
+        state["colors"] = tuple(self.colors)
+        state["_Palette__strings"] = None
+        return state
+
     def to_codebook_palette_unit8(self) -> np.ndarray:
-        codebook_palette_uint8 = np.zeros((self.size(), 3), dtype=np.uint8)
-        i = 0
-        for clr in self.colors:
-            np.put(codebook_palette_uint8[i], [0, 1, 2], [clr.r, clr.g, clr.b])
-            i = i + 1
-        return codebook_palette_uint8
+        if self.__codebook_uint8 is None:
+            codebook_palette_uint8 = np.array([(c.r, c.g, c.b) for c in self.colors], dtype=np.uint8)
+            self.__codebook_uint8 = Palette.__read_only(codebook_palette_uint8.reshape((self.size(), 3)))
+        return self.__codebook_uint8
+
+    def to_codebook_palette_float32(self) -> np.ndarray:
+        """RGB values of the colors scaled to [0, 1]"""
+        if self.__codebook_float32 is None:
+            self.__codebook_float32 = Palette.__read_only(self.to_codebook_palette_unit8().astype(np.float32) / 255)
+        return self.__codebook_float32
+
+    def to_codebook_palette_lab(self) -> np.ndarray:
+        if self.__codebook_lab is None:
+            self.__codebook_lab = Palette.__read_only(rgb_flat_array_to_lab(self.to_codebook_palette_float32()))
+        return self.__codebook_lab
+
+    def digest(self) -> str:
+        """SHA-256 of the RGB values, names and vendors of the colors"""
+        if self.__digest is None:
+            self.__digest = hashlib.sha256(self.to_codebook_palette_unit8().tobytes()
+                                           + self.__get_strings()[1]).hexdigest()
+        return self.__digest
+
+    def compile(self, path: str):
+        """Save the palette in the binary format loaded by from_compiled().
+
+        The file holds the RGB and Lab codebooks, the names and vendors of the colors and the digest.
+        """
+        string_offsets, strings = self.__get_strings()
+        name = self.name.encode("utf-8")
+        url = self.url.encode("utf-8")
+        with open(path, 'wb') as f:
+            f.write(COMPILED_PALETTE_HEADER.pack(COMPILED_PALETTE_MAGIC, COMPILED_PALETTE_VERSION, self.size(),
+                                           len(strings), len(name), len(url), bytes.fromhex(self.digest())))
+            f.write(np.ascontiguousarray(self.to_codebook_palette_lab(), dtype=np.float32).tobytes())
+            f.write(string_offsets.tobytes())
+            f.write(self.to_codebook_palette_unit8().tobytes())
+            f.write(strings)
+            f.write(name)
+            f.write(url)
+
+    @staticmethod
+    def from_compiled(path: str):
+        """Load a palette saved by compile(), the file is memory-mapped and the colors are created lazily"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < COMPILED_PALETTE_HEADER.size:
+                raise Exception(f"{path} is not a compiled palette of version {COMPILED_PALETTE_VERSION}")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, strings_size, name_size, url_size, digest = COMPILED_PALETTE_HEADER.unpack_from(data)
+        if magic != COMPILED_PALETTE_MAGIC or version != COMPILED_PALETTE_VERSION:
+            raise Exception(f"{path} is not a compiled palette of version {COMPILED_PALETTE_VERSION}")
+        # Lab float32 and RGB uint8 codebooks, uint32 offsets of the names and vendors, the strings, name and URL
+        expected_size = COMPILED_PALETTE_HEADER.size + size * 3 * 4 + (2 * size + 1) * 4 + size * 3 \
+            + strings_size + name_size + url_size
+        if len(data) != expected_size:
+            raise Exception(f"{path} is truncated or corrupted, expected {expected_size} bytes, got {len(data)}")
+        # the arrays are read-only views of the mapped file, the float32 and uint32 arrays go first to be aligned
+        offset = COMPILED_PALETTE_HEADER.size
+        lab = np.frombuffer(data, dtype=np.float32, count=size * 3, offset=offset).reshape((size, 3))
+        offset += lab.nbytes
+        string_offsets = np.frombuffer(data, dtype=np.uint32, count=2 * size + 1, offset=offset)
+        offset += string_offsets.nbytes
+        rgb = np.frombuffer(data, dtype=np.uint8, count=size * 3, offset=offset).reshape((size, 3))
+        offset += rgb.nbytes
+        strings = memoryview(data)[offset:offset + strings_size]
+        offset += strings_size
+        name = data[offset:offset + name_size].decode("utf-8")
+        url = data[offset + name_size:offset + name_size + url_size].decode("utf-8")
+
+        palette = Palette(CompiledColors(rgb, string_offsets, strings), name, url)
+        palette.__codebook_uint8 = rgb
+        palette.__codebook_lab = lab
+        palette.__digest = digest.hex()
+        palette.__strings = (string_offsets, strings)
+        return palette
+
+    def __get_strings(self) -> tuple:
+        # names and vendors of all colors as one UTF-8 string and the offsets of each of them
+        if self.__strings is None:
+            encoded = [s.encode("utf-8") for c in self.colors for s in (c.name, c.vendor)]
+            string_offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+            np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+            self.__strings = (string_offsets, b"".join(encoded))
+        return self.__strings
+
+    @staticmethod
+    def combine(palettes: Union[list, tuple]):
+        colors = []
+        for palette in palettes:
+            colors.extend(palette.colors)
+        return Palette(Palette.__unique_rgb(colors),
+                       ' + '.join([p.name for p in palettes if p.name]),
+                       ', '.join([p.url for p in palettes if p.url]))
 
     @staticmethod
     def from_file(path: str):
-        return Palette.from_files([path])
+        with open(path, mode='r', encoding='utf8') as json_file:
+            data = json.load(json_file)
+        colors = [Color.from_hex_rgb(item['color'], item['name'], item['vendor']) for item in data['palette']]
+        return Palette(Palette.__unique_rgb(colors), data.get('name', ''), data.get('url', ''))
 
     @staticmethod
     def from_files(paths: Union[list, tuple]):
-        colors = []
-        palette_names = []
-        palette_urls = []
-        for file in paths:
-            with open(file, mode='r', encoding='utf8') as json_file:
-                data = json.load(json_file)
-                if 'name' in data:
-                    palette_names.append(data['name'])
-                if 'url' in data:
-                    palette_urls.append(data['url'])
-                arr = data['palette']
-                for item in arr:
-                    colors.append(Color.from_hex_rgb(item['color'], item['name'], item['vendor']))
-        return Palette(colors, ' + '.join(palette_names), ', '.join(palette_urls))
+        """Parse JSON palette files, or load compiled ones if their names end with .palette"""
+        palettes = [Palette.from_compiled(path) if path.endswith(COMPILED_PALETTE_SUFFIX) else Palette.from_file(path)
+                    for path in paths]
+        return palettes[0] if len(palettes) == 1 else Palette.combine(palettes)
 
     @staticmethod
     def from_predefined(palette_ids: Union[str, list, tuple]):
@@ -80,14 +293,20 @@ class Palette:
             return None
         if isinstance(palette_ids, str):
             palette_ids = [palette_ids]
-        palette_paths = [Palette.__get_palette_path(x) for x in palette_ids]
-        return Palette.from_files(palette_paths)
+        return PREDEFINED_PALETTES_REGISTRY.get(palette_ids)
 
     @staticmethod
-    def __get_palette_path(palette_id: str) -> str:
-        if palette_id not in Palette.PREDEFINED_PALETTES:
-            raise Exception(f"No palette found {palette_id}")
-        return str(
-            Path(os.path.realpath(__file__)).parent.absolute().joinpath(
-                f"resources/{palette_id}-palette.json")
-        )
+    def __unique_rgb(colors: list) -> list:
+        # only the first of the colors with the same RGB value can ever be the closest one
+        seen = set()
+        unique = []
+        for c in colors:
+            if (c.r, c.g, c.b) not in seen:
+                seen.add((c.r, c.g, c.b))
+                unique.append(c)
+        return unique
+
+    @staticmethod
+    def __read_only(arr: np.ndarray) -> np.ndarray:
+        arr.setflags(write=False)
+        return arr
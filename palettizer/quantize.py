@@ -1,28 +1,110 @@
 import faiss
 import numpy as np
-from sklearn.metrics import pairwise_distances_argmin
 import cv2
-from typing import Union
+from typing import Union, Optional
+from dataclasses import dataclass
 import logging
-from . imgutils import read_rgb_image, np_image_to_flat_array, rgb_flat_array_to_lab, delta_e_2000
+import math
+from pathlib import Path
+from . imgutils import read_rgb_image, read_large_rgb_image, read_image_size, np_image_to_flat_array, unique_colors, color_histogram, \
+    image_to_bytes, labels_to_indexed_png, get_labels_dtype, ordered_dither, MAX_INDEXED_PNG_COLORS
 from . palette import Palette, Color
+from . matching import closest_palette_colors, faiss_knn, DELTA_E_METRIC, EUCLIDEAN_METRIC, DEFAULT_BACKEND
+from . lookup import PaletteLookupTable
+from . stats import ProcessingStats, collect_stats, stage, count, log_stats
 
 DEFAULT_N_COLORS = 50
 MAX_K_MEANS = 150
 MAX_IMAGE_SIZE_PIXELS = 2000
 MAX_IMAGE_SIZE_MB = 30
 MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
-DELTA_E_METRIC = "delta_e"
-EUCLIDEAN_METRIC = "euclidean"
+# images with more pixels are rejected before decoding, as they would take too much memory
+MAX_IMAGE_MEGAPIXELS = 120
+# number of image rows mapped at once by quantize_tiled()
+DEFAULT_TILE_ROWS = 256
+# peak memory taken by quantize() per pixel of the processed image and regardless of the image size,
+# measured by tracemalloc for the bundled images, used to fit the image into a memory budget
+PEAK_BYTES_PER_PIXEL = 48
+BASE_MEMORY_BYTES = 32 * 1024 * 1024
+# K-Means can be trained either on all pixels of the image or on a color histogram of the image,
+# the histogram keeps the given number of bits per channel, 8 bits means the unique colors of the image
+KMEANS_ON_PIXELS = 0
+KMEANS_ON_UNIQUE_COLORS = 8
+KMEANS_SEED = 1234
+
+
+@dataclass(frozen=True)
+class KMeansPreset:
+    name: str
+    # see KMEANS_ON_PIXELS and KMEANS_ON_UNIQUE_COLORS
+    histogram_bits: int = KMEANS_ON_PIXELS
+    # when trained on pixels, faiss samples at most n_colors * max_points_per_centroid of them
+    max_points_per_centroid: int = 256
+    niter: int = 25
+    # K-Means is run nredo times with different initial centroids, the best result is kept
+    nredo: int = 1
+    seed: int = KMEANS_SEED
+
+
+# the time/quality tradeoff of the presets is described in README.md
+KMEANS_PRESETS = {
+    "fast": KMeansPreset("fast", histogram_bits=5, niter=10),
+    # the defaults of faiss, same as used before the presets were introduced
+    "balanced": KMeansPreset("balanced"),
+    "best": KMeansPreset("best", histogram_bits=7, niter=50, nredo=3),
+}
+DEFAULT_KMEANS_PRESET = "balanced"
 
 
 class QuantizedImage:
-    image: np.ndarray
+    """The result of quantization, the colors usage and the image itself.
+
+    The image is either an RGB array or a label per pixel with an RGB codebook, in the latter case
+    the RGB array is built when the image is accessed for the first time.
+    """
     color_pixels: dict[Color, int]
 
-    def __init__(self, image: np.ndarray, color_pixels: dict[Color, int]):
-        self.image = image
+    def __init__(self, image: Optional[np.ndarray], color_pixels: dict[Color, int], stats: ProcessingStats = None,
+                 labels: np.ndarray = None, codebook: np.ndarray = None):
+        if image is None and (labels is None or codebook is None):
+            raise Exception("Either the image or the labels and the codebook are required")
+        self.__image = image
+        # labels[y, x] is the index of the color of the pixel in the codebook
+        self.labels = labels
+        self.codebook = codebook
         self.color_pixels = color_pixels
+        # durations of the processing stages and sizes of the data, set by quantize()
+        self.stats = stats
+        # K-means centroids scaled to [0, 1] if the colors were reduced by K-means, they can warm-start
+        # the quantization of the same image at another resolution, see quantize(init_centroids=...)
+        self.centroids: Optional[np.ndarray] = None
+
+    @property
+    def image(self) -> np.ndarray:
+        if self.__image is None:
+            self.__image = self.codebook[self.labels]
+        return self.__image
+
+    @property
+    def shape(self) -> tuple:
+        if self.__image is not None:
+            return self.__image.shape
+        return self.labels.shape + self.codebook.shape[1:]
+
+    def nbytes(self) -> int:
+        """Memory taken by the image data"""
+        if self.__image is not None:
+            return self.__image.nbytes
+        return self.labels.nbytes + self.codebook.nbytes
+
+    def to_bytes(self, file_format='png', indexed=False) -> bytes:
+        """Encode the image, see imgutils.image_to_bytes(); the RGB array is not kept if it wasn't built yet"""
+        if self.__image is None and indexed and file_format == 'png' \
+                and self.codebook.shape[0] <= MAX_INDEXED_PNG_COLORS:
+            # the labels are the indexes of the PNG palette already
+            return labels_to_indexed_png(self.labels, self.codebook)
+        image = self.__image if self.__image is not None else self.codebook[self.labels]
+        return image_to_bytes(image, file_format, indexed)
 
     @staticmethod
     def from_codebook_labels(codebook: np.ndarray, labels: Union[np.ndarray, list],
@@ -30,24 +112,64 @@ class QuantizedImage:
                              palette: Palette = None):
         """Recreate the (compressed) image from the code book & labels"""
 
+        with stage("reconstruction"):
+            labels = np.asarray(labels).reshape(-1)
+            counts = np.bincount(labels, minlength=len(codebook))
+            labels = labels.astype(get_labels_dtype(codebook.shape[0]), copy=False).reshape((w, h))
+        return QuantizedImage(None, QuantizedImage.count_color_pixels(codebook, counts, palette),
+                              labels=labels, codebook=codebook)
+
+    @staticmethod
+    def count_color_pixels(codebook: np.ndarray, counts: np.ndarray, palette: Palette = None) -> dict[Color, int]:
+        """Convert pixel counts per code of the codebook to pixel counts per color"""
+
+        # the codebook might contain duplicated colors, so pixels are counted per code first
+        # and then merged by color
         color_pixels: dict[Color, int] = {}
         colors: list[Color] = palette.colors if palette is not None else [None] * len(codebook)
-
-        flat_image = np.ndarray(shape=(labels.shape[0], codebook.shape[1]), dtype=codebook.dtype)
-        for i in range(0, labels.shape[0]):
-            flat_image[i] = codebook[labels[i]]
-            color = colors[labels[i]]
+        for i in np.flatnonzero(counts):
+            color = colors[i]
             if color is None:
-                color = Color(codebook[labels[i]][0], codebook[labels[i]][1], codebook[labels[i]][2])
-                colors[labels[i]] = color
-            if color not in color_pixels:
-                color_pixels[color] = 1
-            else:
-                color_pixels[color] += 1
-
-        image = flat_image.reshape((w, h, codebook.shape[1]))
-
-        return QuantizedImage(image, color_pixels)
+                color = Color(int(codebook[i][0]), int(codebook[i][1]), int(codebook[i][2]))
+            color_pixels[color] = color_pixels.get(color, 0) + int(counts[i])
+        return color_pixels
+
+
+class ColorMapping:
+    """Maps any RGB color to a code of the codebook, learned from an image by learn_color_mapping()"""
+
+    def __init__(self, codebook: np.ndarray, palette: Optional[Palette],
+                 centroids: Optional[np.ndarray], metric: str, backend: str):
+        # codebook[code] is the RGB color of the code, palette.colors[code] is its Color if there is a palette
+        self.codebook = codebook
+        self.palette = palette
+        # if set, a color gets the code of the closest centroid, otherwise the code of the closest palette color
+        self.centroids = centroids
+        self.metric = metric
+        self.backend = backend
+
+    def map(self, colors: np.ndarray) -> np.ndarray:
+        """Find the codes for a flat uint8 RGB array"""
+        if self.centroids is not None:
+            with stage("kmeans_assignment"):
+                return faiss_knn(colors, self.centroids, 1, scale=1 / 255)[:, 0]
+        return match_to_palette(colors, self.palette, self.metric, self.backend)
+
+    def dither_spread(self) -> float:
+        """Amplitude of the ordered dithering, the median distance from a codebook color to the closest other one"""
+        colors = np.unique(self.codebook, axis=0).astype(np.float32)
+        if colors.shape[0] < 2:
+            return 0.0
+        # the closest color to a color is the color itself, the second one is the closest other color
+        closest = faiss_knn(colors, colors, 2)[:, 1]
+        distances = np.linalg.norm(colors - colors[closest], axis=1)
+        return float(min(np.median(distances), 255.0))
+
+    def map_dithered(self, image: np.ndarray, row_offset=0) -> np.ndarray:
+        """Find the codes for the pixels of a uint8 RGB image dithered by ordered_dither()"""
+        with stage("dithering"):
+            dithered = ordered_dither(image, self.dither_spread(), row_offset)
+        return self.map(np_image_to_flat_array(dithered))
 
 
 class InvalidImageException(Exception):
@@ -57,122 +179,370 @@ class InvalidImageException(Exception):
 def quantize(img: Union[str, bytes, bytearray],
              palette: Palette = None,
              n_colors=0,
-             metric=EUCLIDEAN_METRIC) -> QuantizedImage:
-
-    if (isinstance(img, bytes) or isinstance(img, bytearray)) and len(img) > MAX_IMAGE_SIZE_BYTES:
-        raise InvalidImageException("The file is too large, please, provide a file not bigger than {} MB"
-                                    .format(MAX_IMAGE_SIZE_MB))
-
-    image = __resize_image_if_too_large(read_rgb_image(img))
-
-    # Case 1: palette not set
+             metric=EUCLIDEAN_METRIC,
+             backend=DEFAULT_BACKEND,
+             kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+             memory_budget_bytes: int = None,
+             dither=False,
+             max_image_size=MAX_IMAGE_SIZE_PIXELS,
+             init_centroids: np.ndarray = None) -> QuantizedImage:
+    """Convert the colors of the image to the palette or to n_colors colors if there's no palette.
+
+    The image is downscaled to max_image_size pixels on the longer side.
+    If memory_budget_bytes is set, the image is downscaled further so that the quantization
+    takes no more memory than that (not counting the decoding of the image file).
+    With dither=True the image is dithered by a Bayer matrix before its colors are mapped,
+    so gradients are drawn by a pattern of the nearby colors instead of bands.
+    init_centroids are the initial K-means centroids, e.g. the centroids of a quantized preview
+    of the image, K-means then runs once from them instead of from the random ones.
+    """
+
+    with collect_stats() as stats:
+        image_size = __check_image_size(img)
+        kmeans_preset = get_kmeans_preset(kmeans_preset)
+        max_size = __get_max_image_size(image_size, memory_budget_bytes, max_image_size)
+        image = __decode_image(img, max_size)
+        with stage("resize"):
+            image = resize_image_if_too_large(image, max_size)
+        count("pixels", image.shape[0] * image.shape[1])
+
+        # the colors are learned the same way in all the cases, only the mapping of the pixels differs
+        if dither:
+            mapping = learn_color_mapping(image, palette, n_colors, metric, backend, kmeans_preset, init_centroids)
+            q_image = QuantizedImage.from_codebook_labels(mapping.codebook, mapping.map_dithered(image),
+                                                          image.shape[0], image.shape[1], mapping.palette)
+            q_image.centroids = mapping.centroids
+
+        # Case 1: palette not set
+        elif palette is None or palette.size() == 0:
+            q_image = quantize_to_n_colors(image, n_colors, kmeans_preset, init_centroids)
+
+        # Case 2: colors count is limited
+        elif n_colors > 0:
+            q_image = quantize_to_n_colors_with_palette(image, palette, metric, n_colors,
+                                                        backend, kmeans_preset, init_centroids)
+
+        # Case 3: colors count is not limited
+        else:
+            q_image = quantize_with_palette(image, palette, metric, backend)
+
+        return __finish_stats(q_image, stats)
+
+
+def quantize_tiled(img: Union[str, bytes, bytearray],
+                   palette: Palette = None,
+                   n_colors=0,
+                   metric=EUCLIDEAN_METRIC,
+                   backend=DEFAULT_BACKEND,
+                   kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+                   out: Union[np.ndarray, str, Path] = None,
+                   tile_rows=DEFAULT_TILE_ROWS,
+                   dither=False) -> QuantizedImage:
+    """Same as quantize(), but the result has the original resolution of the image.
+
+    The color mapping is learned from a copy of the image downscaled to MAX_IMAGE_SIZE_PIXELS,
+    then the image is mapped by tiles of tile_rows rows, so besides the decoded image and the result
+    only the temporary arrays of a single tile are kept in memory.
+    The result is written to out if given: an array of the image shape, or a path of a .npy file
+    which is created and memory-mapped, then the result doesn't take memory.
+    The decoded image itself is always held in memory, which takes 3 bytes per pixel,
+    so the memory is bounded only by MAX_IMAGE_MEGAPIXELS.
+    """
+    with collect_stats() as stats:
+        __check_image_size(img)
+        with stage("decode"):
+            image = read_large_rgb_image(img)
+        count("pixels", image.shape[0] * image.shape[1])
+        with stage("resize"):
+            resized_image = resize_image_if_too_large(image)
+        mapping = learn_color_mapping(resized_image, palette, n_colors, metric, backend, kmeans_preset)
+        del resized_image
+
+        logging.info("Mapping the image of {}x{} by tiles of {} rows"
+                     .format(image.shape[0], image.shape[1], tile_rows))
+        if out is None:
+            out = np.empty(image.shape, dtype=np.uint8)
+        elif isinstance(out, (str, Path)):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.uint8, shape=image.shape)
+        elif out.shape != image.shape:
+            raise Exception(f"Expected the output array of shape {image.shape}, but got {out.shape}")
+        counts = np.zeros(mapping.codebook.shape[0], dtype=np.int64)
+        for start in range(0, image.shape[0], tile_rows):
+            tile = image[start:start + tile_rows]
+            if dither:
+                labels = mapping.map_dithered(tile, start)
+            else:
+                labels = mapping.map(np_image_to_flat_array(tile))
+            with stage("reconstruction"):
+                out[start:start + tile.shape[0]] = mapping.codebook[labels].reshape(tile.shape)
+                counts += np.bincount(labels, minlength=counts.shape[0])
+        # the unique colors are counted per tile, which says nothing about the whole image
+        stats.counters.pop("unique_colors", None)
+        count("tiles", (image.shape[0] + tile_rows - 1) // tile_rows)
+
+        q_image = QuantizedImage(out, QuantizedImage.count_color_pixels(mapping.codebook, counts, mapping.palette))
+        return __finish_stats(q_image, stats)
+
+
+def learn_color_mapping(image: np.ndarray,
+                        palette: Palette = None,
+                        n_colors=0,
+                        metric=EUCLIDEAN_METRIC,
+                        backend=DEFAULT_BACKEND,
+                        kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+                        init_centroids: np.ndarray = None) -> ColorMapping:
+    """Learn how quantize() would map the colors of the image, the cases are the same as in quantize()"""
+    preset = get_kmeans_preset(kmeans_preset)
+    if palette is not None:
+        count("palette_size", palette.size())
     if palette is None or palette.size() == 0:
-        return quantize_to_n_colors(image, n_colors)
+        n_colors = min(DEFAULT_N_COLORS if n_colors <= 0 else n_colors, MAX_K_MEANS)
+        _, kmeans_palette = __apply_kmeans_to_image(image, n_colors, preset, init_centroids)
+        return ColorMapping((kmeans_palette * 255.0).astype(np.uint8), None, kmeans_palette, metric, backend)
 
-    # Case 2: colors count is limited
     if n_colors > 0:
-        return quantize_to_n_colors_with_palette(image, palette, metric, n_colors)
+        _, kmeans_palette = __apply_kmeans_to_image(image, min(n_colors, MAX_K_MEANS), preset, init_centroids)
+        codebook, colors = __map_kmeans_to_palette(kmeans_palette, palette, metric, backend)
+        return ColorMapping(codebook, Palette(colors=colors, name=palette.name, url=palette.url),
+                            kmeans_palette, metric, backend)
 
-    # Case 3: colors count is not limited
-    if metric == DELTA_E_METRIC:
-        # unlimited colors with delta E would take too long time
-        logging.info("Can't process an image using Delta E metric with unlimited colors" +
-                     ", taking {} as max colors count".format(str(MAX_K_MEANS)))
-        return quantize_to_n_colors_with_palette(image, palette, metric, MAX_K_MEANS)
+    return ColorMapping(palette.to_codebook_palette_unit8(), palette, None, metric, backend)
 
-    return quantize_with_palette(image, palette, metric)
 
-
-def quantize_to_n_colors(image: np.ndarray, n_colors: int):
+def quantize_to_n_colors(image: np.ndarray, n_colors: int,
+                         kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+                         init_centroids: np.ndarray = None):
     n_colors = DEFAULT_N_COLORS if n_colors <= 0 else n_colors
     n_colors = min(n_colors, MAX_K_MEANS)
 
     logging.info("Quantizing image to {} colors".format(str(n_colors)))
 
-    image_array = np_image_to_flat_array(np.array(image, dtype=np.float64) / 255)
-    kmeans_labels, kmeans_palette = __apply_kmeans_to_flat_array(image_array, n_colors)
+    kmeans_labels, kmeans_palette = __apply_kmeans_to_image(image, n_colors, get_kmeans_preset(kmeans_preset),
+                                                            init_centroids)
 
-    return QuantizedImage.from_codebook_labels((kmeans_palette * 255.0).astype(np.uint8),
-                                               kmeans_labels,
-                                               image.shape[0], image.shape[1])
+    q_image = QuantizedImage.from_codebook_labels((kmeans_palette * 255.0).astype(np.uint8),
+                                                  kmeans_labels,
+                                                  image.shape[0], image.shape[1])
+    q_image.centroids = kmeans_palette
+    return q_image
 
 
 def quantize_to_n_colors_with_palette(image: np.ndarray,
                                       palette: Palette,
                                       metric: str,
-                                      n_colors: int):
+                                      n_colors: int,
+                                      backend=DEFAULT_BACKEND,
+                                      kmeans_preset: Union[str, KMeansPreset] = DEFAULT_KMEANS_PRESET,
+                                      init_centroids: np.ndarray = None):
     n_colors = min(n_colors, MAX_K_MEANS)
 
     logging.info("Converting image colors using palette {}, up to {} colors and metric {}"
                  .format(palette.name, str(n_colors), metric))
+    count("palette_size", palette.size())
 
     # first, perform K-means in order to reduce color space to N colors
     # then the palette will be matched with the vector of K-means colors instead of the whole image
-    image_array = np_image_to_flat_array(np.array(image, dtype=np.float64) / 255)
-    kmeans_labels, kmeans_palette = __apply_kmeans_to_flat_array(image_array, n_colors)
+    kmeans_labels, kmeans_palette = __apply_kmeans_to_image(image, n_colors, get_kmeans_preset(kmeans_preset),
+                                                            init_centroids)
 
     logging.info("Converting " + str(n_colors) + " image colors to the palette")
-    codebook_palette_uint8 = palette.to_codebook_palette_unit8()
-    codebook_palette_float32 = codebook_palette_uint8.astype(dtype=np.float32) / 255
-
-    # find the closest color from the original palette for each from the K-means palette
-    # if j = closest_codebook_for_kmeans[i] then codebook_palette_uint8[j] is the closest to kmeans_palette[i]
-    if metric == DELTA_E_METRIC:
-        closest_codebook_for_kmeans = pairwise_distances_argmin(rgb_flat_array_to_lab(kmeans_palette),
-                                                                rgb_flat_array_to_lab(codebook_palette_float32),
-                                                                metric=delta_e_2000)
-    else:
-        closest_codebook_for_kmeans = pairwise_distances_argmin(kmeans_palette,
-                                                                codebook_palette_float32,
-                                                                metric=metric)
-
-    # the K-means palette colors are mapped to the closest colors from the original palette
-    # n_colors_codebook_palette_uint8 and colors might contain duplicates!
-    n_colors_codebook_palette_uint8 = np.zeros(shape=kmeans_palette.shape, dtype=np.uint8)
-    colors = []
-    for i in range(0, kmeans_palette.shape[0]):
-        n_colors_codebook_palette_uint8[i] = codebook_palette_uint8[closest_codebook_for_kmeans[i]]
-        colors.append(palette.colors[closest_codebook_for_kmeans[i]])
+    n_colors_codebook_palette_uint8, colors = __map_kmeans_to_palette(kmeans_palette, palette, metric, backend)
 
     # ordering of the mapped colors is the same as in K-means palette, so kmeans_labels can be used as indexes
-    return QuantizedImage.from_codebook_labels(n_colors_codebook_palette_uint8, kmeans_labels,
-                                               image.shape[0], image.shape[1],
-                                               Palette(colors=colors, name=palette.name, url=palette.url))
+    q_image = QuantizedImage.from_codebook_labels(n_colors_codebook_palette_uint8, kmeans_labels,
+                                                  image.shape[0], image.shape[1],
+                                                  Palette(colors=colors, name=palette.name, url=palette.url))
+    q_image.centroids = kmeans_palette
+    return q_image
 
 
 def quantize_with_palette(image: np.ndarray,
                           palette: Palette,
-                          metric: str):
+                          metric: str,
+                          backend=DEFAULT_BACKEND):
     logging.info("Converting image colors using palette {} and metric {}".format(palette.name, metric))
-
-    image_array = np_image_to_flat_array(np.array(image, dtype=np.float64) / 255)
+    count("palette_size", palette.size())
 
     codebook_palette_uint8 = palette.to_codebook_palette_unit8()
-    codebook_palette_float32 = codebook_palette_uint8.astype(dtype=np.float32) / 255
-    # delta E metric is not supported here because it would be too slow
-    labels_palette = pairwise_distances_argmin(image_array, codebook_palette_float32, metric=metric)
+    labels_palette = match_to_palette(np_image_to_flat_array(image), palette, metric, backend)
 
     return QuantizedImage.from_codebook_labels(codebook_palette_uint8, labels_palette,
                                                image.shape[0], image.shape[1],
                                                palette)
 
 
-def __resize_image_if_too_large(image: np.ndarray):
-    if image.shape[0] > MAX_IMAGE_SIZE_PIXELS or image.shape[1] > MAX_IMAGE_SIZE_PIXELS:
+def get_kmeans_preset(preset: Union[str, KMeansPreset]) -> KMeansPreset:
+    if isinstance(preset, KMeansPreset):
+        return preset
+    if preset not in KMEANS_PRESETS:
+        raise Exception(f"Unknown K-Means preset {preset}, expected one of {', '.join(KMEANS_PRESETS)}")
+    return KMEANS_PRESETS[preset]
+
+
+def match_to_palette(colors: np.ndarray, palette: Palette, metric: str, backend: str) -> np.ndarray:
+    """Find the closest palette color for each color of a flat uint8 RGB array"""
+    with stage("palette_matching"):
+        if metric == DELTA_E_METRIC:
+            # delta E is slow, so every color is matched only once and then looked up for the next images
+            lookup_table = PaletteLookupTable.for_codebook(palette.to_codebook_palette_unit8(), metric)
+            return lookup_table.closest_colors(colors)
+        # photos have much fewer distinct colors than pixels, so only the unique colors are matched
+        unique, inverse = unique_colors(colors)
+        logging.info("Matching {} unique colors of the image to the palette".format(unique.shape[0]))
+        count("unique_colors", unique.shape[0])
+        return closest_palette_colors(unique / 255, palette, metric, backend)[inverse]
+
+
+def __map_kmeans_to_palette(kmeans_palette: np.ndarray, palette: Palette, metric: str, backend: str):
+    """Replace each K-means color by the closest palette color, returns the RGB codebook and the colors"""
+    codebook_palette_uint8 = palette.to_codebook_palette_unit8()
+
+    # find the closest color from the original palette for each from the K-means palette
+    # if j = closest_codebook_for_kmeans[i] then codebook_palette_uint8[j] is the closest to kmeans_palette[i]
+    with stage("palette_matching"):
+        closest_codebook_for_kmeans = closest_palette_colors(kmeans_palette, palette, metric, backend)
+
+    # the K-means palette colors are mapped to the closest colors from the original palette
+    # the codebook and colors might contain duplicates!
+    return (codebook_palette_uint8[closest_codebook_for_kmeans],
+            [palette.colors[i] for i in closest_codebook_for_kmeans])
+
+
+def __decode_image(img: Union[str, bytes, bytearray], min_size: int = None) -> np.ndarray:
+    with stage("decode"):
+        return read_rgb_image(img, min_size)
+
+
+def __finish_stats(q_image: QuantizedImage, stats: ProcessingStats) -> QuantizedImage:
+    count("result_colors", len(q_image.color_pixels))
+    q_image.stats = stats
+    log_stats("Quantization stats", stats)
+    return q_image
+
+
+def __check_image_size(img: Union[str, bytes, bytearray]) -> Optional[tuple[int, int]]:
+    if (isinstance(img, bytes) or isinstance(img, bytearray)) and len(img) > MAX_IMAGE_SIZE_BYTES:
+        raise InvalidImageException("The file is too large, please, provide a file not bigger than {} MB"
+                                    .format(MAX_IMAGE_SIZE_MB))
+
+    image_size = read_image_size(img)
+    if image_size is not None and image_size[0] * image_size[1] > MAX_IMAGE_MEGAPIXELS * 1000000:
+        raise InvalidImageException("The image is too large, please, provide an image not bigger than {} megapixels"
+                                    .format(MAX_IMAGE_MEGAPIXELS))
+    return image_size
+
+
+def __get_max_image_size(image_size: Optional[tuple[int, int]], memory_budget_bytes: Optional[int],
+                         max_image_size=MAX_IMAGE_SIZE_PIXELS) -> int:
+    if memory_budget_bytes is None or image_size is None:
+        return max_image_size
+    max_pixels = (memory_budget_bytes - BASE_MEMORY_BYTES) // PEAK_BYTES_PER_PIXEL
+    if max_pixels <= 0:
+        raise Exception("The memory budget should be more than {} MB".format(BASE_MEMORY_BYTES // (1024 * 1024)))
+    h, w = image_size
+    k = min(1.0, max_image_size / max(h, w))
+    if h * w * k * k <= max_pixels:
+        return max_image_size
+    max_size = int(max(h, w) * math.sqrt(max_pixels / (h * w)))
+    logging.info("Limiting the image size to {} pixels to fit into {} MB of memory"
+                 .format(max_size, memory_budget_bytes // (1024 * 1024)))
+    return max_size
+
+
+def resize_image_if_too_large(image: np.ndarray, max_size=MAX_IMAGE_SIZE_PIXELS):
+    """Downscale the image so that its longer side is at most max_size pixels"""
+    if image.shape[0] > max_size or image.shape[1] > max_size:
         logging.info("The image is too big: {}x{}".format(image.shape[0], image.shape[1]))
-        k = MAX_IMAGE_SIZE_PIXELS / max(image.shape[0], image.shape[1])
+        k = max_size / max(image.shape[0], image.shape[1])
         new_size = (int(image.shape[1] * k), int(image.shape[0] * k))
         logging.info("Resizing the image to {}x{}".format(new_size[0], new_size[1]))
-        return cv2.resize(image, dsize=new_size, interpolation=cv2.INTER_CUBIC)
+        return cv2.resize(image, dsize=new_size, interpolation=cv2.INTER_AREA)
     return image
 
 
-def __apply_kmeans_to_flat_array(image_array: np.ndarray, n_colors: int):
+def __apply_kmeans_to_image(image: np.ndarray, n_colors: int, preset: KMeansPreset,
+                            init_centroids: np.ndarray = None):
+    with stage("kmeans"):
+        return __apply_kmeans(image, n_colors, preset, init_centroids)
+
+
+def __apply_kmeans(image: np.ndarray, n_colors: int, preset: KMeansPreset, init_centroids: np.ndarray = None):
+    if preset.histogram_bits <= KMEANS_ON_PIXELS:
+        count("clusters", n_colors)
+        init_centroids = __get_init_centroids(init_centroids, n_colors)
+        return __apply_kmeans_to_pixels(np_image_to_flat_array(image), n_colors, preset, init_centroids)
+
+    # K-Means is trained on the histogram bins weighted by their pixel counts,
+    # then each pixel gets the label of its bin
+    bins, counts, inverse = color_histogram(np_image_to_flat_array(image), preset.histogram_bits)
+    logging.info("Color histogram of the image has {} bins".format(bins.shape[0]))
+    count("histogram_bins", bins.shape[0])
+    n_colors = min(n_colors, bins.shape[0])
+    count("clusters", n_colors)
+    weights = counts.astype(np.float32)
+    init_centroids = __get_init_centroids(init_centroids, n_colors)
+    if init_centroids is not None:
+        bins_labels, kmeans_palette, _ = __apply_weighted_kmeans(bins, n_colors, preset, weights, init_centroids)
+        return bins_labels.astype(get_labels_dtype(n_colors))[inverse], kmeans_palette
+
+    best_labels, best_palette, best_objective = None, None, None
+    # faiss would reuse the same initial centroids on every redo, so the redos are done here
+    for redo in range(preset.nredo):
+        init_centroids = __kmeans_plus_plus(bins, weights, n_colors, preset.seed + redo)
+        bins_labels, kmeans_palette, objective = __apply_weighted_kmeans(bins, n_colors, preset,
+                                                                         weights, init_centroids)
+        if best_objective is None or objective < best_objective:
+            best_labels, best_palette, best_objective = bins_labels, kmeans_palette, objective
+    return best_labels.astype(get_labels_dtype(n_colors))[inverse], best_palette
+
+
+def __apply_kmeans_to_pixels(pixels: np.ndarray, n_colors: int, preset: KMeansPreset,
+                             init_centroids: np.ndarray = None):
+    # a single float32 copy of the pixels, faiss trains on a subsample of it and searches it without copying
+    pixels_32 = np.divide(pixels, 255, dtype=np.float32)
+    logging.info("Running K-Means: reducing color space of the image to " + str(n_colors) + " colors")
+    # restarts from random centroids are useless when the initial centroids are given
+    kmeans = faiss.Kmeans(d=pixels.shape[1], k=n_colors, niter=preset.niter,
+                          nredo=preset.nredo if init_centroids is None else 1,
+                          seed=preset.seed, max_points_per_centroid=preset.max_points_per_centroid)
+    kmeans.train(pixels_32, init_centroids=init_centroids)
+    return faiss_knn(pixels_32, kmeans.centroids, 1)[:, 0], kmeans.centroids
+
+
+def __get_init_centroids(init_centroids: Optional[np.ndarray], n_colors: int) -> Optional[np.ndarray]:
+    # the centroids of a preview can't be used if its K-means had fewer clusters, e.g. a small image had fewer colors
+    if init_centroids is None:
+        return None
+    if init_centroids.shape != (n_colors, 3):
+        count("kmeans_warm_start", False)
+        return None
+    count("kmeans_warm_start", True)
+    return np.ascontiguousarray(init_centroids, dtype=np.float32)
+
+
+def __kmeans_plus_plus(points: np.ndarray, weights: np.ndarray, n_centroids: int, seed: int) -> np.ndarray:
+    """Pick initial centroids by k-means++ taking the weights of the points into account"""
+    rng = np.random.default_rng(seed)
+    weights = weights.astype(np.float64)
+    centroids = np.empty((n_centroids, points.shape[1]), dtype=np.float32)
+    centroids[0] = points[rng.choice(points.shape[0], p=weights / weights.sum())]
+    distances = ((points - centroids[0]) ** 2).sum(axis=1)
+    for i in range(1, n_centroids):
+        probabilities = weights * distances
+        centroids[i] = points[rng.choice(points.shape[0], p=probabilities / probabilities.sum())]
+        distances = np.minimum(distances, ((points - centroids[i]) ** 2).sum(axis=1))
+    return centroids
+
+
+def __apply_weighted_kmeans(points: np.ndarray, n_colors: int, preset: KMeansPreset,
+                            weights: np.ndarray, init_centroids: np.ndarray):
     logging.info("Running K-Means: reducing color space of the image to " + str(n_colors) + " colors")
-    kmeans = faiss.Kmeans(d=image_array.shape[1], k=n_colors)
-    image_array_32 = image_array.astype(np.float32)
-    kmeans.train(image_array_32)
+    # faiss subsamples the training set uniformly, which would not respect the weights
+    kmeans = faiss.Kmeans(d=points.shape[1], k=n_colors, niter=preset.niter, seed=preset.seed,
+                          max_points_per_centroid=points.shape[0])
+    points_32 = points.astype(np.float32, copy=False)
+    kmeans.train(points_32, weights=weights, init_centroids=init_centroids)
     kmeans_palette = kmeans.centroids
-    kmeans_labels = kmeans.index.search(image_array_32, 1)[1]
+    kmeans_labels = kmeans.index.search(points_32, 1)[1]
     kmeans_labels = kmeans_labels[:, 0]
-    return kmeans_labels, kmeans_palette
+    return kmeans_labels, kmeans_palette, kmeans.obj[-1]
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from multiprocessing import get_context
+from typing import Optional, Union
+from urllib.parse import urlsplit, parse_qs
+from . palette import Palette
+from . quantize import quantize, InvalidImageException, KMEANS_PRESETS, DEFAULT_KMEANS_PRESET, MAX_IMAGE_SIZE_BYTES
+from . matching import EUCLIDEAN_METRIC, DELTA_E_METRIC
+from . htmlview import image_and_palette_as_html
+from . batch import color_usage, limit_native_threads
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_THREADS_PER_WORKER = 1
+# the request line and the headers together, longer requests are rejected
+MAX_HEADER_BYTES = 16 * 1024
+# time to receive a whole request
+REQUEST_TIMEOUT_SECONDS = 60
+OUTPUT_FORMATS = ("png", "json", "html")
+METRICS = (EUCLIDEAN_METRIC, DELTA_E_METRIC)
+
+
+class HttpResponse:
+    def __init__(self, status: HTTPStatus, body: bytes, content_type="application/json", headers: dict = None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @staticmethod
+    def json(status: HTTPStatus, value) -> "HttpResponse":
+        return HttpResponse(status, json.dumps(value).encode("utf-8"))
+
+    @staticmethod
+    def error(status: HTTPStatus, message: str, headers: dict = None) -> "HttpResponse":
+        response = HttpResponse.json(status, {"error": message})
+        response.headers.update(headers or {})
+        return response
+
+
+class BadRequestException(Exception):
+    pass
+
+
+class QuantizationServer:
+    """HTTP API of quantize(), the requests are handled by asyncio and the images are quantized
+    in a pool of worker processes.
+
+    GET /health returns the state of the pool. POST /quantize takes the image file as the request body
+    and the parameters in the query string: palette (comma-separated IDs of predefined palettes),
+    n_colors, metric, kmeans_preset, dither (0 or 1) and format (png, json or html).
+    At most workers + queue_size images are accepted at once, the rest are answered with 503.
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = None, threads_per_worker=DEFAULT_THREADS_PER_WORKER,
+                 max_body_bytes=MAX_IMAGE_SIZE_BYTES, memory_budget_bytes: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size if queue_size is not None else 2 * self.workers
+        self.threads_per_worker = threads_per_worker
+        self.max_body_bytes = max_body_bytes
+        self.memory_budget_bytes = memory_budget_bytes
+        self.pending = 0
+        self.__executor: Optional[ProcessPoolExecutor] = None
+        self.__server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT) -> int:
+        """Start the worker processes, wait until they are ready and start listening, returns the port"""
+        self.__executor = ProcessPoolExecutor(max_workers=self.workers,
+                                              mp_context=get_context("spawn"),
+                                              initializer=_init_worker,
+                                              initargs=(self.threads_per_worker,))
+        loop = asyncio.get_running_loop()
+        # the pool starts a process per submitted job until all workers are started
+        await asyncio.gather(*[loop.run_in_executor(self.__executor, _warm_up) for _ in range(self.workers)])
+        self.__server = await asyncio.start_server(self.__handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        port = self.__server.sockets[0].getsockname()[1]
+        logger.info("Serving on http://{}:{} with {} workers".format(host, port, self.workers))
+        return port
+
+    async def serve_forever(self):
+        await self.__server.serve_forever()
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+
+    async def handle(self, method: str, target: str, body: bytes) -> HttpResponse:
+        """Handle a request which is already read, target is the path with the query string"""
+        url = urlsplit(target)
+        if url.path == "/health":
+            if method != "GET":
+                return HttpResponse.error(HTTPStatus.METHOD_NOT_ALLOWED, "GET expected")
+            return HttpResponse.json(HTTPStatus.OK, {"status": "ok", "workers": self.workers,
+                                                     "pending": self.pending, "queue_size": self.queue_size})
+        if url.path != "/quantize":
+            return HttpResponse.error(HTTPStatus.NOT_FOUND, "Unknown path " + url.path)
+        if method != "POST":
+            return HttpResponse.error(HTTPStatus.METHOD_NOT_ALLOWED, "POST expected")
+        try:
+            params = QuantizationServer.__parse_params(url.query)
+        except BadRequestException as e:
+            return HttpResponse.error(HTTPStatus.BAD_REQUEST, str(e))
+        if len(body) == 0:
+            return HttpResponse.error(HTTPStatus.BAD_REQUEST, "The image is expected as the request body")
+        if self.pending >= self.workers + self.queue_size:
+            return HttpResponse.error(HTTPStatus.SERVICE_UNAVAILABLE, "Too many images are being processed",
+                                      {"Retry-After": "1"})
+
+        self.pending += 1
+        try:
+            content_type, result = await asyncio.get_running_loop().run_in_executor(
+                self.__executor, _process_image, body, *params, self.memory_budget_bytes)
+        except (InvalidImageException, BadRequestException) as e:
+            return HttpResponse.error(HTTPStatus.BAD_REQUEST, str(e))
+        except Exception as e:
+            logger.error(msg="Failed to quantize the image", exc_info=e)
+            return HttpResponse.error(HTTPStatus.INTERNAL_SERVER_ERROR, "Failed to quantize the image")
+        finally:
+            self.pending -= 1
+        return HttpResponse(HTTPStatus.OK, result, content_type)
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # only receiving the request is limited in time, not the quantization
+            request = await asyncio.wait_for(self.__read_request(reader, writer), REQUEST_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            request = HttpResponse.error(HTTPStatus.REQUEST_TIMEOUT, "The request took too long")
+        except asyncio.LimitOverrunError:
+            request = HttpResponse.error(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "The headers are too large")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        response = request if isinstance(request, HttpResponse) else await self.handle(*request)
+        try:
+            await QuantizationServer.__write_response(writer, response)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def __read_request(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Union[tuple, HttpResponse]:
+        """Read the method, the target and the body of a request, or return the error response"""
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        request_line = head[0].split(" ")
+        if len(request_line) != 3:
+            return HttpResponse.error(HTTPStatus.BAD_REQUEST, "Malformed request line")
+        method, target, _ = request_line
+        headers = {}
+        for line in head[1:]:
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+
+        if "transfer-encoding" in headers:
+            return HttpResponse.error(HTTPStatus.LENGTH_REQUIRED, "Chunked requests are not supported")
+        try:
+            length = int(headers.get("content-length", "0"))
+            if length < 0:
+                raise ValueError()
+        except ValueError:
+            return HttpResponse.error(HTTPStatus.BAD_REQUEST, "Malformed Content-Length")
+        # the body is not read at all if it is too large
+        if length > self.max_body_bytes:
+            return HttpResponse.error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                      "The file is too large, the limit is {} bytes".format(self.max_body_bytes))
+        if length > 0 and headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        body = await reader.readexactly(length) if length > 0 else b""
+        return method, target, body
+
+    @staticmethod
+    async def __write_response(writer: asyncio.StreamWriter, response: HttpResponse):
+        lines = ["HTTP/1.1 {} {}".format(response.status.value, response.status.phrase),
+                 "Content-Type: " + response.content_type,
+                 "Content-Length: {}".format(len(response.body)),
+                 "Connection: close"]
+        lines.extend("{}: {}".format(name, value) for name, value in response.headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        writer.write(response.body)
+        await writer.drain()
+
+    @staticmethod
+    def __parse_params(query: str) -> tuple:
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        palette_ids = [p for p in params.get("palette", "").split(",") if p]
+        unknown = [p for p in palette_ids if p not in Palette.PREDEFINED_PALETTES]
+        if unknown:
+            raise BadRequestException("Unknown palettes: " + ", ".join(unknown))
+        try:
+            n_colors = int(params.get("n_colors", "0"))
+        except ValueError:
+            raise BadRequestException("n_colors should be an integer")
+        if n_colors < 0:
+            raise BadRequestException("n_colors should be >= 0")
+        metric = params.get("metric", EUCLIDEAN_METRIC)
+        if metric not in METRICS:
+            raise BadRequestException("metric should be one of: " + ", ".join(METRICS))
+        kmeans_preset = params.get("kmeans_preset", DEFAULT_KMEANS_PRESET)
+        if kmeans_preset not in KMEANS_PRESETS:
+            raise BadRequestException("kmeans_preset should be one of: " + ", ".join(KMEANS_PRESETS))
+        dither = params.get("dither", "0")
+        if dither not in ("0", "1"):
+            raise BadRequestException("dither should be 0 or 1")
+        output_format = params.get("format", "png")
+        if output_format not in OUTPUT_FORMATS:
+            raise BadRequestException("format should be one of: " + ", ".join(OUTPUT_FORMATS))
+        return tuple(palette_ids), n_colors, metric, kmeans_preset, dither == "1", output_format
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers: int = None, memory_budget_bytes: int = None):
+    server = QuantizationServer(workers, memory_budget_bytes=memory_budget_bytes)
+    await server.start(host, port)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+# the functions run in the worker processes are referred to from the class, so they can't be name-mangled
+def _init_worker(threads: int):
+    limit_native_threads(threads)
+
+
+def _warm_up() -> int:
+    # the palettes are parsed once per process, so the first requests don't pay for it
+    for palette_id in Palette.PREDEFINED_PALETTES:
+        Palette.from_predefined([palette_id])
+    return os.getpid()
+
+
+def _process_image(image: bytes, palette_ids: tuple, n_colors: int, metric: str, kmeans_preset: str, dither: bool,
+                   output_format: str, memory_budget_bytes: Optional[int]) -> tuple[str, bytes]:
+    palette = Palette.from_predefined(list(palette_ids)) if palette_ids else None
+    q_image = quantize(image, palette, n_colors, metric, kmeans_preset=kmeans_preset,
+                       memory_budget_bytes=memory_budget_bytes, dither=dither)
+    if output_format == "json":
+        result = {"height": q_image.shape[0], "width": q_image.shape[1], "colors": color_usage(q_image)}
+        result.update(q_image.stats.as_dict())
+        return "application/json", json.dumps(result).encode("utf-8")
+    if output_format == "html":
+        return "text/html; charset=utf-8", image_and_palette_as_html(q_image).encode("utf-8")
+    return "image/png", q_image.to_bytes(indexed=True)
@@ -0,0 +1,86 @@
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class ProcessingStats:
+    """Durations of the processing stages in seconds and sizes of the data, such as pixels or clusters"""
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+
+    def add_stage(self, name: str, seconds: float):
+        # a stage might be run several times, e.g. for every tile, so the durations are summed up
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set_counter(self, name: str, value: int):
+        self.counters[name] = int(value)
+
+    def total_seconds(self) -> float:
+        return sum(self.stages.values())
+
+    def as_dict(self) -> dict:
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+    @staticmethod
+    def from_dict(data: dict):
+        stats = ProcessingStats()
+        stats.stages.update(data.get("stages", {}))
+        stats.counters.update(data.get("counters", {}))
+        return stats
+
+
+# the stats being collected in the current thread or task, set by collect_stats()
+__CURRENT_STATS = contextvars.ContextVar("palettizer_current_stats", default=None)
+
+
+@contextmanager
+def collect_stats():
+    """Collect the stats of the stages run inside the block.
+
+    If the stats are already being collected by an outer block, its stats are reused,
+    so e.g. the stages of quantize() and of encoding its result end up together.
+    """
+    stats = __CURRENT_STATS.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = ProcessingStats()
+    token = __CURRENT_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        __CURRENT_STATS.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """Measure the duration of the block as a stage of the stats being collected, if any"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = __CURRENT_STATS.get()
+        if stats is not None:
+            stats.add_stage(name, time.perf_counter() - start)
+
+
+def count(name: str, value: int):
+    """Set a counter of the stats being collected, if any"""
+    stats = __CURRENT_STATS.get()
+    if stats is not None:
+        stats.set_counter(name, value)
+
+
+def current_stats() -> Optional[ProcessingStats]:
+    return __CURRENT_STATS.get()
+
+
+def log_stats(message: str, stats: ProcessingStats):
+    """Log the stats as JSON, they are also attached to the record as the "stats" attribute"""
+    stats_dict = stats.as_dict()
+    logging.info("{}: {}".format(message, json.dumps(stats_dict)), extra={"stats": stats_dict})
@@ -0,0 +1,10 @@
+import pytest
+
+from palettizer.lookup import CACHE_DIR_ENV
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # the compiled palettes, lookup tables and results are written to a fresh directory instead of ~/.cache
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path))
+    return tmp_path
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+
+from palettizer.batch import find_images, quantize_batch
+from palettizer.palette import Palette, Color
+from testutils import get_test_resource
+
+
+RED = Color(255, 0, 0, name='red', vendor='ABC Paints')
+YELLOW = Color(255, 255, 0, name='yellow', vendor='ABC Paints')
+GREEN = Color(0, 255, 0, name='green', vendor='ABC Paints')
+BLUE = Color(0, 0, 255, name='blue', vendor='ABC Paints')
+PALETTE_4_COLORS = Palette([RED, YELLOW, GREEN, BLUE])
+
+
+def test_find_images():
+    images = find_images(str(get_test_resource("")))
+    assert str(get_test_resource("4_squares.png")) in images
+    assert str(get_test_resource("bliss.jpg")) in images
+    assert not any(i.endswith(".json") for i in images)
+
+    assert find_images(str(get_test_resource("*_squares.png"))) == [str(get_test_resource("2_squares.png")),
+                                                                   str(get_test_resource("4_squares.png"))]
+
+
+def test_quantize_batch(tmp_path):
+    images = [str(get_test_resource("2_squares.png")), str(get_test_resource("4_squares.png")),
+              str(get_test_resource("missing.png"))]
+
+    failed = quantize_batch(images, PALETTE_4_COLORS, tmp_path, workers=2)
+
+    assert failed == 1
+    assert tmp_path.joinpath("2_squares.png").exists()
+    assert tmp_path.joinpath("4_squares.png.html").exists()
+    with open(tmp_path.joinpath("report.jsonl")) as f:
+        records = {r["input"]: r for r in map(json.loads, f)}
+    assert len(records) == 3
+    assert "error" in records[images[2]]
+    record = records[images[1]]
+    assert sum(c["pixels"] for c in record["colors"]) == record["height"] * record["width"]
+    assert {c["rgb"] for c in record["colors"]} == {"ff0000", "ffff00", "00ff00", "0000ff"}
+    assert record["seconds"] >= record["quantize_seconds"] > 0
+
+
+def test_quantize_batch__same_names(tmp_path):
+    input_dir = tmp_path.joinpath("input")
+    input_dir.joinpath("nested").mkdir(parents=True)
+    shutil.copy(get_test_resource("2_squares.png"), input_dir.joinpath("squares.png"))
+    shutil.copy(get_test_resource("4_squares.png"), input_dir.joinpath("squares.bmp"))
+    shutil.copy(get_test_resource("4_squares.png"), input_dir.joinpath("nested", "squares.png"))
+    images = find_images(str(input_dir.joinpath("**", "squares.*")))
+    output_dir = tmp_path.joinpath("output")
+
+    failed = quantize_batch(images, PALETTE_4_COLORS, output_dir, workers=2)
+
+    assert failed == 0
+    with open(output_dir.joinpath("report.jsonl")) as f:
+        outputs = {r["input"]: r["output"] for r in map(json.loads, f)}
+    # the images are sorted, so the name is taken by the first one
+    assert outputs == {
+        str(input_dir.joinpath("nested", "squares.png")): str(output_dir.joinpath("nested", "squares.png")),
+        str(input_dir.joinpath("squares.bmp")): str(output_dir.joinpath("squares.png")),
+        str(input_dir.joinpath("squares.png")): str(output_dir.joinpath("squares-2.png"))}
+    assert all(os.path.exists(output) and os.path.exists(output + ".html") for output in outputs.values())
@@ -0,0 +1,67 @@
+import json
+import os
+
+import pytest
+
+from palettizer import benchmark
+from palettizer.benchmark import BenchmarkCase, get_cases, run_case, run, compare
+from palettizer.lookup import CACHE_DIR_ENV
+from palettizer.matching import SKLEARN_BACKEND
+from palettizer.quantize import EUCLIDEAN_METRIC, DELTA_E_METRIC
+from testutils import get_test_resource
+
+
+def test_get_cases():
+    cases = get_cases(["bliss.jpg"], ["mtnblack"])
+    assert len(cases) == 7
+    assert BenchmarkCase("bliss.jpg", "", 15, EUCLIDEAN_METRIC) in cases
+    assert BenchmarkCase("bliss.jpg", "mtnblack", 0, DELTA_E_METRIC) in cases
+    assert BenchmarkCase("bliss.jpg", "mtnblack", 0, EUCLIDEAN_METRIC, SKLEARN_BACKEND) in cases
+    assert len({c.id() for c in cases}) == 7
+
+
+def test_id():
+    assert BenchmarkCase("bliss.jpg", "mtnblack", 0, EUCLIDEAN_METRIC).id() == "bliss.jpg/mtnblack/unlimited/euclidean"
+    assert BenchmarkCase("bliss.jpg", "mtnblack", 15, EUCLIDEAN_METRIC, SKLEARN_BACKEND).id() == \
+        "bliss.jpg/mtnblack/15/euclidean/sklearn"
+
+
+def test_run_case():
+    result = run_case(BenchmarkCase("4_squares.png", "mtnblack", 4, EUCLIDEAN_METRIC),
+                      get_test_resource(""), repeat=2)
+    assert result["case"] == "4_squares.png/mtnblack/4/euclidean"
+    assert {"decode", "kmeans", "palette_matching", "reconstruction", "quantize", "html"} <= set(result["stages"])
+    assert result["seconds"] >= result["min_seconds"] > 0
+    assert result["cold_seconds"] > 0
+    assert result["peak_memory_mb"] > 0
+    assert result["megapixels_per_second"] > 0
+    json.dumps(result)
+
+
+def test_run_case__empty_cache_dir(cache_dir):
+    run_case(BenchmarkCase("4_squares.png", "mtnblack", 0, EUCLIDEAN_METRIC), get_test_resource(""), repeat=1)
+
+    # the lookup tables are built in a directory of the case, which is removed afterwards
+    assert os.environ[CACHE_DIR_ENV] == str(cache_dir)
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_run__images_dir_not_found(tmp_path):
+    with pytest.raises(Exception, match="not found"):
+        run(str(tmp_path.joinpath("results.json")), images_dir=tmp_path.joinpath("images"))
+
+
+def test_compare():
+    baseline = {"results": [{"case": "a", "seconds": 1.0, "peak_memory_mb": 100.0},
+                            {"case": "b", "seconds": 1.0, "peak_memory_mb": 100.0}]}
+    current = {"results": [{"case": "a", "seconds": 1.1, "peak_memory_mb": 150.0},
+                           {"case": "b", "seconds": 1.5, "peak_memory_mb": 90.0},
+                           {"case": "c", "seconds": 9.0, "peak_memory_mb": 900.0}]}
+    assert compare(baseline, current) == [("a", "peak_memory_mb", 100.0, 150.0), ("b", "seconds", 1.0, 1.5)]
+    assert compare(baseline, current, threshold=1.0) == []
+
+
+def test_compare__cold_seconds():
+    baseline = {"results": [{"case": "a", "cold_seconds": 2.0, "seconds": 1.0, "peak_memory_mb": 100.0}]}
+    current = {"results": [{"case": "a", "cold_seconds": 3.0, "seconds": 1.0, "peak_memory_mb": 100.0}]}
+    assert compare(baseline, current) == [("a", "cold_seconds", 2.0, 3.0)]
@@ -0,0 +1,82 @@
+import numpy as np
+
+from palettizer.cache import QuantizationCache
+from palettizer.palette import Palette, Color
+from testutils import get_test_resource
+
+
+IMAGE_4_SQUARES = str(get_test_resource("4_squares.png"))
+IMAGE_2_SQUARES = str(get_test_resource("2_squares.png"))
+
+RED = Color(255, 0, 0, name='red', vendor='ABC Paints')
+YELLOW = Color(255, 255, 0, name='yellow', vendor='ABC Paints')
+GREEN = Color(0, 255, 0, name='green', vendor='ABC Paints')
+BLUE = Color(0, 0, 255, name='blue', vendor='ABC Paints')
+PALETTE_4_COLORS = Palette([RED, YELLOW, GREEN, BLUE])
+
+
+def test_quantize__memory_hit():
+    cache = QuantizationCache()
+
+    first = cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+    second = cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+
+    assert np.array_equal(first.image, second.image)
+    assert first.color_pixels == second.color_pixels
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_quantize__different_parameters_miss():
+    cache = QuantizationCache()
+
+    cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+    cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 2)
+    cache.quantize(IMAGE_4_SQUARES, Palette([RED, YELLOW]), 0)
+
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["hits"] == 0
+
+
+def test_quantize__disk_hit(tmp_path):
+    first = QuantizationCache(directory=tmp_path).quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+
+    cache = QuantizationCache(directory=tmp_path)
+    second = cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+
+    assert cache.stats()["disk_hits"] == 1
+    assert np.array_equal(first.image, second.image)
+    assert second.color_pixels == {RED: 400, YELLOW: 400, GREEN: 400, BLUE: 400}
+
+
+def test_quantize__memory_limit():
+    # a 40x40 result takes 1600 bytes of labels
+    cache = QuantizationCache(max_memory_bytes=2000)
+
+    cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+    cache.quantize(IMAGE_2_SQUARES, PALETTE_4_COLORS, 0)
+    cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["memory_entries"] == 1
+
+
+def test_quantize__disk_limit(tmp_path):
+    cache = QuantizationCache(directory=tmp_path, max_disk_bytes=1)
+
+    cache.quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, 0)
+    cache.quantize(IMAGE_2_SQUARES, PALETTE_4_COLORS, 0)
+
+    assert len(list(tmp_path.glob("*.npz"))) == 0
+
+
+def test_quantize__init_centroids_are_part_of_key():
+    cache = QuantizationCache()
+    centroids = np.array([[1, 0, 0], [0, 0, 1]], dtype=np.float32)
+
+    cache.quantize(IMAGE_4_SQUARES, None, 2)
+    cache.quantize(IMAGE_4_SQUARES, None, 2, init_centroids=centroids)
+    cache.quantize(IMAGE_4_SQUARES, None, 2, init_centroids=centroids.copy())
+
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["memory_hits"] == 1
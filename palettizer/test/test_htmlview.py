@@ -1,4 +1,6 @@
-from palettizer.htmlview import image_and_palette_as_html
+import numpy as np
+
+from palettizer.htmlview import image_and_palette_as_html, render_outputs
 from palettizer.imgutils import read_rgb_image
 from palettizer.quantize import quantize
 from palettizer.palette import Palette, Color
@@ -49,3 +51,24 @@ def test_image_and_palette_as_html__with_quantize():
     assert "<td><div class=\"color-block\" style=\"background-color: rgb(0, 0, 255)\"></div></td>" in rendered_html
     assert "<td>green</td>" in rendered_html
     assert "<td>blue</td>" in rendered_html
+
+
+def test_image_and_palette_as_html__sorted_by_hue():
+    img = read_rgb_image(IMAGE_PATH)
+    area = (img.shape[0] * img.shape[1]) // 4
+    q_image = QuantizedImage(img, {RED: area, GREEN: area, BLUE: area, YELLOW: area})
+
+    rendered_html = image_and_palette_as_html(q_image)
+
+    positions = [rendered_html.index("<td>" + c.name + "</td>") for c in [BLUE, GREEN, YELLOW, RED]]
+    assert positions == sorted(positions)
+
+
+def test_render_outputs():
+    q_image = quantize(IMAGE_PATH, PALETTE)
+
+    image_png, rendered_html = render_outputs(q_image)
+
+    assert image_png.startswith(b"\x89PNG")
+    assert np.array_equal(read_rgb_image(image_png), q_image.image)
+    assert "data:image/jpg;base64," in rendered_html
@@ -1,10 +1,16 @@
+from io import BytesIO
 import numpy as np
 import pytest
-from palettizer.imgutils import read_rgb_image
+from PIL import Image
+from sklearn.metrics import pairwise_distances_argmin
+from palettizer.imgutils import read_rgb_image, read_image_size, rgb_flat_array_to_lab, delta_e_2000, delta_e_2000_argmin, \
+    unique_colors, color_histogram, to_hsv, flat_array_to_hsv, image_to_bytes, image_to_indexed_png, \
+    bayer_matrix, ordered_dither, write_png, read_large_rgb_image
 from testutils import get_test_resource
 
 
 IMAGE_PATH = str(get_test_resource("4_squares.png"))
+IMAGE_OCTOBER = str(get_test_resource("october.jpg"))
 
 
 def test_read_rgb_image__from_path():
@@ -26,6 +32,159 @@ def test_read_rgb_image__from_binary():
     assert img.dtype == np.uint8
 
 
+def test_read_rgb_image__reduced_jpeg():
+    with open(IMAGE_OCTOBER, 'rb') as f:
+        image_bin = f.read()
+
+    img = read_rgb_image(image_bin, min_size=2000)
+
+    assert img.shape == (1560, 2080, 3)
+    assert img.dtype == np.uint8
+
+
+def test_read_rgb_image__not_reduced():
+    assert read_rgb_image(IMAGE_OCTOBER, min_size=5000).shape == (3120, 4160, 3)
+    assert read_rgb_image(IMAGE_PATH, min_size=10).shape == (40, 40, 3)
+
+
+def test_read_image_size():
+    with open(IMAGE_OCTOBER, 'rb') as f:
+        image_bin = f.read()
+
+    assert read_image_size(IMAGE_OCTOBER) == (3120, 4160)
+    assert read_image_size(image_bin) == (3120, 4160)
+    assert read_image_size(b"not an image") is None
+
+
 def test_read_rgb_image__unknown_format():
     with pytest.raises(Exception):
         read_rgb_image(123)
+
+
+@pytest.mark.parametrize("block_pairs", [1, 100, 1 << 20])
+def test_delta_e_2000_argmin__same_as_pairwise(block_pairs):
+    rng = np.random.default_rng(42)
+    lab_u = rgb_flat_array_to_lab(rng.random((60, 3), dtype=np.float32))
+    lab_v = rgb_flat_array_to_lab(rng.random((40, 3), dtype=np.float32))
+
+    indices = delta_e_2000_argmin(lab_u, lab_v, block_pairs=block_pairs)
+
+    assert indices.shape == (60,)
+    assert np.array_equal(indices, pairwise_distances_argmin(lab_u, lab_v, metric=delta_e_2000))
+
+
+def test_unique_colors():
+    arr = np.array([[255, 0, 0], [0, 0, 255], [255, 0, 0], [1, 2, 3], [0, 0, 255]], dtype=np.uint8)
+
+    unique, inverse = unique_colors(arr)
+
+    assert unique.dtype == np.uint8
+    assert unique.shape == (3, 3)
+    assert np.array_equal(unique[inverse], arr)
+
+
+def test_color_histogram__unique_colors():
+    arr = np.array([[255, 0, 0], [0, 0, 255], [255, 0, 0], [1, 2, 3]], dtype=np.uint8)
+
+    bins, counts, inverse = color_histogram(arr, 8)
+
+    assert bins.dtype == np.float32
+    assert np.array_equal(np.rint(bins[inverse] * 255), arr)
+    assert np.array_equal(counts[inverse], [2, 1, 2, 1])
+
+
+def test_color_histogram__binned():
+    arr = np.array([[250, 0, 0], [0, 0, 255], [254, 6, 2], [1, 2, 3]], dtype=np.uint8)
+
+    bins, counts, inverse = color_histogram(arr, 5)
+
+    assert bins.shape == (3, 3)
+    assert inverse[0] == inverse[2]
+    assert counts[inverse[0]] == 2
+    assert np.allclose(bins[inverse[0]] * 255, [252, 3, 1])
+    assert np.allclose(bins[inverse[3]] * 255, [1, 2, 3])
+
+
+def test_flat_array_to_hsv():
+    colors = np.array([[255, 0, 0], [0, 255, 0], [10, 20, 200], [0, 0, 0]], dtype=np.uint8)
+    hsv = flat_array_to_hsv(colors)
+    assert hsv.shape == (4, 3)
+    for i, c in enumerate(colors):
+        assert np.allclose(hsv[i], to_hsv(*c))
+
+
+def test_image_to_bytes_indexed_png():
+    img = read_rgb_image(IMAGE_PATH)
+
+    image_png = image_to_bytes(img, indexed=True)
+
+    with Image.open(BytesIO(image_png)) as png:
+        assert png.mode == "P"
+    assert np.array_equal(read_rgb_image(image_png), img)
+
+
+def test_image_to_bytes_indexed_png_falls_back_to_rgb_for_many_colors():
+    img = np.zeros((10, 30, 3), dtype=np.uint8)
+    img[:, :, 0] = np.arange(300).reshape((10, 30)) % 256
+    img[:, :, 1] = np.arange(300).reshape((10, 30)) // 256
+
+    assert image_to_indexed_png(img) is None
+    image_png = image_to_bytes(img, indexed=True)
+
+    with Image.open(BytesIO(image_png)) as png:
+        assert png.mode == "RGB"
+    assert np.array_equal(read_rgb_image(image_png), img)
+
+
+@pytest.mark.parametrize("n_colors, indexed, mode", [(8, True, "P"), (300, True, "RGB"), (8, False, "RGB")])
+def test_write_png(tmp_path, n_colors, indexed, mode):
+    rng = np.random.default_rng(5)
+    codebook = rng.integers(0, 256, size=(n_colors, 3), dtype=np.uint8)
+    img = codebook[rng.integers(0, n_colors, size=(103, 41))]
+    path = str(tmp_path.joinpath("image.png"))
+
+    write_png(path, img, indexed, block_rows=10)
+
+    with Image.open(path) as png:
+        assert png.mode == mode
+    assert np.array_equal(read_rgb_image(path), img)
+
+
+def test_read_large_rgb_image():
+    with open(IMAGE_PATH, 'rb') as f:
+        image_bytes = f.read()
+    assert np.array_equal(read_large_rgb_image(IMAGE_PATH), read_rgb_image(IMAGE_PATH))
+    assert np.array_equal(read_large_rgb_image(image_bytes), read_rgb_image(IMAGE_PATH))
+    with pytest.raises(Exception):
+        read_large_rgb_image(b"not an image")
+
+
+def test_bayer_matrix():
+    matrix = bayer_matrix(8)
+
+    assert matrix.shape == (8, 8)
+    assert np.array_equal(np.sort(matrix.reshape(-1)), np.arange(64))
+    assert np.array_equal(bayer_matrix(2), [[0, 2], [3, 1]])
+
+
+def test_ordered_dither():
+    img = np.full((16, 24, 3), 128, dtype=np.uint8)
+
+    dithered = ordered_dither(img, 64)
+
+    assert dithered.dtype == np.uint8
+    assert 96 <= dithered.min() and dithered.max() <= 160
+    assert abs(dithered.astype(np.float64).mean() - 128) < 1
+    assert np.array_equal(dithered[:, :, 0], dithered[:, :, 2])
+    assert np.array_equal(ordered_dither(img, 0), img)
+    # the tiles starting at the given rows get the same pattern as the whole image
+    assert np.array_equal(ordered_dither(img[5:], 64, row_offset=5), dithered[5:])
+
+
+def test_ordered_dither_clips_values():
+    img = np.zeros((8, 8, 3), dtype=np.uint8)
+    img[:, :4] = 255
+
+    dithered = ordered_dither(img, 255)
+
+    assert dithered[:, :4].min() >= 127 and dithered[:, 4:].max() <= 128
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from palettizer.imgutils import read_rgb_image
+from palettizer.matching import DELTA_E_METRIC
+from palettizer.palette import PaletteRegistry, CompiledColors, PREDEFINED_PALETTES_DIR
+from palettizer.stats import ProcessingStats
+from palettizerbot.jobs import JobPool, QueueFullException, process_picture
+from testutils import get_test_resource
+
+
+@pytest.fixture(scope="module")
+def job_pool():
+    pool = JobPool(workers=1, queue_size=1)
+    yield pool
+    pool.shutdown()
+
+
+def read_picture(name: str) -> bytes:
+    with open(get_test_resource(name), 'rb') as f:
+        return f.read()
+
+
+def test_submit__queue_full(job_pool):
+    done = threading.Semaphore(0)
+
+    positions = [job_pool.submit(lambda f: done.release(), time.sleep, 0.5) for _ in range(2)]
+    with pytest.raises(QueueFullException):
+        job_pool.submit(lambda f: done.release(), time.sleep, 0)
+    # a forced job continues one which was accepted, so it is not rejected
+    positions.append(job_pool.submit(lambda f: done.release(), time.sleep, 0, force=True))
+
+    assert positions == [0, 1, 2]
+    assert job_pool.pending() == 3
+    for _ in range(3):
+        assert done.acquire(timeout=60)
+    assert job_pool.pending() == 0
+
+
+def test_submit__on_done_errors_are_not_propagated(job_pool):
+    done = threading.Event()
+
+    def on_done(f):
+        done.set()
+        raise Exception("failed to send the result")
+
+    job_pool.submit(on_done, time.sleep, 0)
+
+    assert done.wait(timeout=60)
+    job_pool.submit(lambda f: None, time.sleep, 0)
+
+
+def test_submit__results_handled_concurrently(job_pool):
+    threads = set()
+    done = threading.Semaphore(0)
+
+    def on_done(f):
+        # stands for a slow upload of the result to the chat
+        time.sleep(0.5)
+        threads.add(threading.current_thread().name)
+        done.release()
+
+    start = time.perf_counter()
+    for _ in range(2):
+        # forced, the queue limit is not tested here
+        job_pool.submit(on_done, time.sleep, 0, force=True)
+    for _ in range(2):
+        assert done.acquire(timeout=60)
+
+    assert len(threads) == 2
+    assert time.perf_counter() - start < 1.0
+
+
+def test_process_picture__compiled_palette(job_pool):
+    # the second registry loads the palette compiled by the first one, it has to be sent to the worker
+    PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["mtnblack"])
+    palette = PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["mtnblack"])
+    assert isinstance(palette.colors, CompiledColors)
+    futures = []
+    done = threading.Event()
+
+    job_pool.submit(lambda f: (futures.append(f), done.set()), process_picture, read_picture("bliss.jpg"),
+                    palette, 5, DELTA_E_METRIC, "fast", time.time())
+
+    assert done.wait(timeout=120)
+    image_png, response_html, stats = futures[0].result()
+    assert len({tuple(c) for c in read_rgb_image(image_png).reshape(-1, 3)}) <= 5
+    assert "BLK " in response_html
+    assert isinstance(stats, ProcessingStats)
+    assert "queue_wait" in stats.stages
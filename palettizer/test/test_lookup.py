@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from palettizer.imgutils import unique_colors
+from palettizer.lookup import PaletteLookupTable
+from palettizer.matching import closest_colors, EUCLIDEAN_METRIC, DELTA_E_METRIC
+from palettizer.palette import Palette
+from palettizer.stats import collect_stats
+from testutils import get_test_resource
+
+
+PALETTE_MTN_BLACK = Palette.from_file(str(get_test_resource("mtnblack-palette.json")))
+CODEBOOK_4_COLORS = np.array([[255, 0, 0], [255, 255, 0], [0, 255, 0], [0, 0, 255]], dtype=np.uint8)
+
+
+@pytest.mark.parametrize("metric", [EUCLIDEAN_METRIC, DELTA_E_METRIC])
+def test_closest_colors__same_as_exact_matching(metric):
+    colors = np.random.default_rng(42).integers(0, 256, size=(5000, 3), dtype=np.uint8)
+
+    lookup_table = PaletteLookupTable.for_codebook(CODEBOOK_4_COLORS, metric)
+    labels = lookup_table.closest_colors(colors)
+
+    expected = closest_colors(colors.astype(np.float32) / 255, CODEBOOK_4_COLORS.astype(np.float32) / 255, metric)
+    assert np.array_equal(labels, expected)
+
+
+def test_closest_colors__real_palette():
+    codebook = PALETTE_MTN_BLACK.to_codebook_palette_unit8()
+    colors = np.random.default_rng(7).integers(0, 256, size=(2000, 3), dtype=np.uint8)
+
+    lookup_table = PaletteLookupTable.for_codebook(codebook, EUCLIDEAN_METRIC)
+    labels = lookup_table.closest_colors(colors)
+
+    expected = closest_colors(colors.astype(np.float32) / 255, codebook.astype(np.float32) / 255, EUCLIDEAN_METRIC)
+    assert np.array_equal(labels, expected)
+
+
+def test_for_codebook__cached(cache_dir):
+    codebook = CODEBOOK_4_COLORS[::-1].copy()
+
+    lookup_table = PaletteLookupTable.for_codebook(codebook, EUCLIDEAN_METRIC)
+
+    assert PaletteLookupTable.for_codebook(codebook, EUCLIDEAN_METRIC) is lookup_table
+    assert len(list(cache_dir.glob("lookup/*.npy"))) == 1
+
+
+def test_closest_colors__only_new_colors_matched(cache_dir):
+    colors = np.random.default_rng(3).integers(0, 256, size=(3000, 3), dtype=np.uint8)
+    lookup_table = PaletteLookupTable.for_codebook(CODEBOOK_4_COLORS[::-1].copy(), DELTA_E_METRIC)
+
+    with collect_stats() as first:
+        labels = lookup_table.closest_colors(colors[:2000])
+    with collect_stats() as second:
+        assert np.array_equal(lookup_table.closest_colors(colors[:2000]), labels)
+        lookup_table.closest_colors(colors)
+
+    assert first.counters["lookup_misses"] == unique_colors(colors[:2000])[0].shape[0]
+    assert second.counters["lookup_misses"] == unique_colors(colors)[0].shape[0] - first.counters["lookup_misses"]
+    # the matched colors are saved to the file shared by all processes
+    saved = np.load(next(cache_dir.glob("lookup/*.npy")))
+    assert np.count_nonzero(saved) == unique_colors(colors)[0].shape[0]
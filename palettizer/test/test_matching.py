@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from palettizer.matching import closest_colors, closest_palette_colors, faiss_knn, delta_e_2000_pruned_argmin, \
+    EUCLIDEAN_METRIC, DELTA_E_METRIC, FAISS_BACKEND, SKLEARN_BACKEND
+from palettizer.imgutils import rgb_flat_array_to_lab, delta_e_2000_argmin
+from palettizer.palette import Palette
+from testutils import get_test_resource
+
+
+PALETTE_MTN_BLACK = Palette.from_file(str(get_test_resource("mtnblack-palette.json")))
+
+
+def squared_distances(colors: np.ndarray, codebook: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    return ((colors - codebook[labels]) ** 2).sum(axis=1)
+
+
+def test_closest_palette_colors__faiss_same_as_sklearn():
+    colors = np.random.default_rng(42).random((10000, 3), dtype=np.float32)
+    codebook = PALETTE_MTN_BLACK.to_codebook_palette_float32()
+
+    faiss_labels = closest_palette_colors(colors, PALETTE_MTN_BLACK, EUCLIDEAN_METRIC, FAISS_BACKEND)
+    sklearn_labels = closest_palette_colors(colors, PALETTE_MTN_BLACK, EUCLIDEAN_METRIC, SKLEARN_BACKEND)
+
+    # the backends may break ties between equally close colors differently
+    assert np.allclose(squared_distances(colors, codebook, faiss_labels),
+                       squared_distances(colors, codebook, sklearn_labels), atol=1e-6)
+
+
+@pytest.mark.parametrize("metric", [EUCLIDEAN_METRIC, DELTA_E_METRIC])
+def test_closest_colors__same_as_closest_palette_colors(metric):
+    colors = np.random.default_rng(7).random((500, 3), dtype=np.float32)
+
+    labels = closest_colors(colors, PALETTE_MTN_BLACK.to_codebook_palette_float32(), metric)
+
+    assert np.array_equal(labels, closest_palette_colors(colors, PALETTE_MTN_BLACK, metric))
+
+
+def test_faiss_knn__batches():
+    codebook = np.array([[0, 0, 0], [1, 1, 1], [2, 2, 2]], dtype=np.float32)
+    queries = np.array([[0.1, 0, 0], [2, 2, 1.9], [1.2, 1, 1], [0.9, 1, 1], [1.6, 1.6, 1.6]])
+
+    indices = faiss_knn(queries, codebook, k=2, batch_size=2)
+
+    assert indices.shape == (5, 2)
+    assert np.array_equal(indices, [[0, 1], [2, 1], [1, 2], [1, 0], [2, 1]])
+
+
+def test_closest_colors__unknown_backend():
+    with pytest.raises(Exception):
+        closest_colors(np.zeros((1, 3)), np.zeros((1, 3)), EUCLIDEAN_METRIC, "unknown")
+
+
+def test_faiss_knn__scaled_uint8_queries():
+    colors = np.random.default_rng(3).integers(0, 256, (5000, 3), dtype=np.uint8)
+    original = colors.copy()
+    codebook = PALETTE_MTN_BLACK.to_codebook_palette_float32()
+
+    labels = faiss_knn(colors, codebook, 1, batch_size=1000, scale=1 / 255)
+
+    assert labels.dtype == np.uint8
+    assert np.array_equal(colors, original)
+    expected = faiss_knn(colors.astype(np.float32) / 255, codebook, 1)
+    # scaling by a multiplication may round differently from a division and break ties otherwise
+    assert np.allclose(squared_distances(colors / 255, codebook, labels[:, 0]),
+                       squared_distances(colors / 255, codebook, expected[:, 0]), atol=1e-6)
+
+
+@pytest.mark.parametrize("candidates, block_pairs", [(8, 1 << 18), (1, 1000)])
+def test_delta_e_2000_pruned_argmin__same_as_exhaustive(candidates, block_pairs):
+    colors = rgb_flat_array_to_lab(np.random.default_rng(5).random((3000, 3), dtype=np.float32))
+    codebook = Palette.from_predefined("tikkurila").to_codebook_palette_lab()
+
+    labels = delta_e_2000_pruned_argmin(colors, codebook, candidates, block_pairs)
+
+    assert np.array_equal(labels, delta_e_2000_argmin(colors, codebook))
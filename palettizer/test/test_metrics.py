@@ -0,0 +1,86 @@
+from http.client import HTTPConnection
+
+from palettizer.stats import ProcessingStats
+from palettizerbot.metrics import Metrics, Histogram, METRICS_PORT_ENV
+
+
+def stats_of(stages: dict, counters: dict) -> ProcessingStats:
+    return ProcessingStats.from_dict({"stages": stages, "counters": counters})
+
+
+def test_histogram__cumulative_buckets():
+    histogram = Histogram((1, 10, 100))
+
+    for value in (0.5, 5, 50, 500):
+        histogram.observe(value)
+
+    assert histogram.bucket_counts == [1, 2, 3]
+    assert histogram.count == 4
+    assert histogram.sum == 555.5
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.observe(stats_of({"kmeans": 0.2, "decode": 0.03}, {"pixels": 5000}))
+    metrics.observe(stats_of({"kmeans": 3}, {"pixels": 50}))
+    metrics.count_job("ok")
+    metrics.count_job("ok")
+    metrics.count_job("error")
+    metrics.add_gauge("pending_jobs", lambda: 7)
+
+    lines = metrics.render().splitlines()
+
+    assert 'palettizer_jobs_total{result="error"} 1' in lines
+    assert 'palettizer_jobs_total{result="ok"} 2' in lines
+    assert 'palettizer_stage_seconds_bucket{stage="kmeans",le="0.25"} 1' in lines
+    assert 'palettizer_stage_seconds_bucket{stage="kmeans",le="5"} 2' in lines
+    assert 'palettizer_stage_seconds_bucket{stage="kmeans",le="+Inf"} 2' in lines
+    assert 'palettizer_stage_seconds_sum{stage="kmeans"} 3.2' in lines
+    assert 'palettizer_stage_seconds_count{stage="decode"} 1' in lines
+    assert 'palettizer_stage_seconds_count{stage="total"} 2' in lines
+    assert 'palettizer_size_bucket{counter="pixels",le="100"} 1' in lines
+    assert 'palettizer_size_count{counter="pixels"} 2' in lines
+    assert "# TYPE palettizer_pending_jobs gauge" in lines
+    assert "palettizer_pending_jobs 7" in lines
+
+
+def test_serve():
+    metrics = Metrics()
+    metrics.count_job("ok")
+    server = metrics.serve(port=0)
+    try:
+        connection = HTTPConnection("127.0.0.1", server.server_port, timeout=10)
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-Type").startswith("text/plain")
+        assert 'palettizer_jobs_total{result="ok"} 1' in response.read().decode("utf-8")
+
+        connection.request("GET", "/unknown")
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 404
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_from_env__port_taken(monkeypatch):
+    server = Metrics().serve(port=0)
+    try:
+        monkeypatch.setenv(METRICS_PORT_ENV, str(server.server_port))
+
+        metrics, taken_port_server = Metrics.from_env()
+
+        assert isinstance(metrics, Metrics)
+        assert taken_port_server is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_from_env__disabled(monkeypatch):
+    monkeypatch.setenv(METRICS_PORT_ENV, "0")
+    _, server = Metrics.from_env()
+    assert server is None
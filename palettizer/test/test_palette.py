@@ -1,6 +1,10 @@
+import pickle
+import shutil
+
 import numpy as np
+import pytest
 
-from palettizer.palette import Palette, Color
+from palettizer.palette import Palette, Color, PaletteRegistry, CompiledColors, PREDEFINED_PALETTES_DIR
 from testutils import get_test_resource
 
 
@@ -46,7 +50,8 @@ def test_get_predefined_palette__single_file():
     palette = Palette.from_predefined(['mtnblack'])
 
     assert palette is not None
-    assert len(palette.colors) == 185
+    # the file lists ffffff twice, only the first one is kept
+    assert len(palette.colors) == 184
     assert Color(252, 249, 151, name="BLK 1005 Smash137's Potato", vendor="Montana Black") in palette.colors
     assert Color(255, 229, 112, name='BLK 1010 Easter yellow', vendor="Montana Black") in palette.colors
     assert Color(255, 220, 20, name='BLK 1025 Kicking yellow', vendor="Montana Black") in palette.colors
@@ -56,7 +61,7 @@ def test_get_predefined_palette__multiple_files():
     palette = Palette.from_predefined(['mtnblack', 'mtn94'])
 
     assert palette is not None
-    assert len(palette.colors) == (185 + 136)
+    assert len(palette.colors) == (184 + 136 - 1)
     assert Color(252, 249, 151, name="BLK 1005 Smash137's Potato", vendor="Montana Black") in palette.colors
     assert Color(255, 229, 112, name='BLK 1010 Easter yellow', vendor="Montana Black") in palette.colors
     assert Color(107, 99, 15, name="RV-112 Mission Green", vendor="MTN 94") in palette.colors
@@ -80,3 +85,137 @@ def test_to_codebook_palette():
     assert codebook_palette[2][0] == 0
     assert codebook_palette[2][1] == 0
     assert codebook_palette[2][2] == 255
+
+
+def test_get_predefined_palette__cached():
+    palette = Palette.from_predefined('mtnblack')
+
+    assert palette is Palette.from_predefined(['mtnblack'])
+    assert Palette.from_predefined(['mtnblack', 'mtn94']) is Palette.from_predefined(['mtnblack', 'mtn94'])
+    assert not palette.to_codebook_palette_unit8().flags.writeable
+
+
+def test_palette_registry__ids_discovered():
+    registry = PaletteRegistry(PREDEFINED_PALETTES_DIR)
+
+    assert registry.ids() == ("arton", "mtn94", "mtnblack", "tikkurila")
+    # the predefined palettes are offered in the order they were added
+    assert Palette.PREDEFINED_PALETTES == ("mtnblack", "mtn94", "arton", "tikkurila")
+
+
+def test_palette_registry__ordered_ids_first(tmp_path):
+    for palette_id in ["new", "arton", "mtnblack", "another"]:
+        shutil.copy(PALETTE_4, tmp_path.joinpath(palette_id + "-palette.json"))
+
+    registry = PaletteRegistry(tmp_path, order=("mtnblack", "mtn94", "arton"))
+
+    assert registry.ids() == ("mtnblack", "arton", "another", "new")
+
+
+def test_to_codebook_palette__float32_and_lab():
+    palette = Palette().from_file(PALETTE_1)
+
+    codebook_float32 = palette.to_codebook_palette_float32()
+    codebook_lab = palette.to_codebook_palette_lab()
+
+    assert codebook_float32.dtype == np.float32
+    assert np.array_equal(codebook_float32, [[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    assert codebook_lab.shape == (3, 3)
+    assert 50 < codebook_lab[0][0] < 55
+
+
+def test_combine__duplicated_rgb_removed():
+    palette = Palette.combine([Palette.from_file(PALETTE_1), Palette.from_file(PALETTE_1), Palette.from_file(PALETTE_2),
+                               Palette([Color(255, 0, 0, name='Other red', vendor='XYZ Paints')])])
+
+    assert palette.size() == 6
+    assert Color(255, 0, 0, name='Red', vendor='ABC Paints') in palette.colors
+    assert Color(255, 0, 0, name='Other red', vendor='XYZ Paints') not in palette.colors
+
+
+def test_compile__same_as_parsed(tmp_path):
+    parsed = Palette.from_file(PALETTE_4)
+    path = str(tmp_path.joinpath("test" + ".palette"))
+    parsed.compile(path)
+
+    compiled = Palette.from_compiled(path)
+
+    assert isinstance(compiled.colors, CompiledColors)
+    assert list(compiled.colors) == list(parsed.colors)
+    assert compiled.colors[-1] == parsed.colors[-1]
+    assert compiled.colors[1:] == list(parsed.colors[1:])
+    assert (compiled.name, compiled.url) == (parsed.name, parsed.url)
+    assert compiled.digest() == parsed.digest()
+    assert np.array_equal(compiled.to_codebook_palette_unit8(), parsed.to_codebook_palette_unit8())
+    assert np.array_equal(compiled.to_codebook_palette_lab(), parsed.to_codebook_palette_lab())
+    assert not compiled.to_codebook_palette_lab().flags.writeable
+    assert Palette.from_files([path]).digest() == parsed.digest()
+
+
+@pytest.mark.parametrize("size", [0, 10, -1])
+def test_from_compiled__truncated(tmp_path, size):
+    path = tmp_path.joinpath("test.palette")
+    Palette.from_file(PALETTE_4).compile(str(path))
+    with open(path, 'r+b') as f:
+        f.truncate(size if size >= 0 else path.stat().st_size + size)
+
+    with pytest.raises(Exception, match="compiled palette|truncated"):
+        Palette.from_compiled(str(path))
+
+
+def test_palette_registry__truncated_compiled_palette_replaced(cache_dir):
+    PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["arton"])
+    compiled_path = next(cache_dir.joinpath("palettes").iterdir())
+    with open(compiled_path, 'r+b') as f:
+        f.truncate(100)
+
+    palette = PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["arton"])
+
+    assert palette.digest() == Palette.from_predefined("arton").digest()
+    assert [p.name for p in cache_dir.joinpath("palettes").iterdir()] == [compiled_path.name]
+    assert Palette.from_compiled(str(compiled_path)).digest() == palette.digest()
+
+
+def test_compile__indexed_by_numpy_labels(tmp_path):
+    parsed = Palette.from_predefined("mtnblack")
+    path = str(tmp_path.joinpath("mtnblack.palette"))
+    parsed.compile(path)
+
+    compiled = Palette.from_compiled(path)
+
+    assert parsed.size() > 128
+    for i in np.arange(128, parsed.size(), dtype=np.uint8):
+        assert compiled.colors[i] == parsed.colors[int(i)]
+
+
+def test_digest__depends_on_colors_and_names():
+    assert Palette.from_file(PALETTE_1).digest() == Palette.from_file(PALETTE_4).digest()
+    assert Palette.from_file(PALETTE_1).digest() != Palette.from_file(PALETTE_2).digest()
+    renamed = Palette([Color(c.r, c.g, c.b, c.name + "!", c.vendor) for c in Palette.from_file(PALETTE_1).colors])
+    assert renamed.digest() != Palette.from_file(PALETTE_1).digest()
+
+
+def test_palette_registry__compiled_palettes_reused(cache_dir):
+    parsed = PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["arton"])
+    compiled = PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["arton"])
+
+    assert len(list(cache_dir.joinpath("palettes").iterdir())) == 1
+    assert not isinstance(parsed.colors, CompiledColors)
+    assert isinstance(compiled.colors, CompiledColors)
+    assert list(compiled.colors) == list(parsed.colors)
+    assert compiled.digest() == parsed.digest()
+
+
+def test_pickle__compiled_palette(cache_dir):
+    PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["mtnblack"])
+    compiled = PaletteRegistry(PREDEFINED_PALETTES_DIR).get(["mtnblack"])
+    assert isinstance(compiled.colors, CompiledColors)
+
+    unpickled = pickle.loads(pickle.dumps(compiled))
+
+    assert list(unpickled.colors) == list(compiled.colors)
+    assert (unpickled.name, unpickled.url) == (compiled.name, compiled.url)
+    assert unpickled.digest() == compiled.digest()
+    assert np.array_equal(unpickled.to_codebook_palette_unit8(), compiled.to_codebook_palette_unit8())
+    assert np.array_equal(unpickled.to_codebook_palette_lab(), compiled.to_codebook_palette_lab())
+    assert pickle.loads(pickle.dumps(compiled.colors)) == tuple(compiled.colors)
@@ -1,8 +1,11 @@
 import numpy as np
 
-from palettizer.quantize import quantize
-from palettizer.quantize import EUCLIDEAN_METRIC, DELTA_E_METRIC
+from palettizer import quantize as quantize_module
+from palettizer.quantize import quantize, quantize_tiled, QuantizedImage, InvalidImageException
+from palettizer.quantize import EUCLIDEAN_METRIC, DELTA_E_METRIC, KMEANS_ON_PIXELS, KMEANS_ON_UNIQUE_COLORS, \
+    KMEANS_PRESETS, KMeansPreset, PEAK_BYTES_PER_PIXEL, BASE_MEMORY_BYTES
 from palettizer.palette import Palette, Color
+from palettizer.imgutils import read_rgb_image, image_to_bytes
 from testutils import get_test_resource
 
 import pytest
@@ -87,8 +90,9 @@ def test_quantize__4_colors_palette__max_2_colors(metric):
     assert result.color_pixels[YELLOW] == 400
 
 
-@pytest.mark.parametrize("metric", [EUCLIDEAN_METRIC, DELTA_E_METRIC])
-def test_quantize__large_image__4_colors_palette(metric):
+# the dark pixel at (1019, 477) is closer to red in RGB space but to blue by Delta E
+@pytest.mark.parametrize("metric,dark_pixel", [(EUCLIDEAN_METRIC, RED_PIXEL), (DELTA_E_METRIC, BLUE_PIXEL)])
+def test_quantize__large_image__4_colors_palette(metric, dark_pixel):
     result = quantize(img=IMAGE_BLISS,
                       palette=PALETTE_4_COLORS,
                       n_colors=0,
@@ -100,7 +104,7 @@ def test_quantize__large_image__4_colors_palette(metric):
     assert np.array_equal(result.image[221][779], BLUE_PIXEL)
     assert np.array_equal(result.image[411][1503], YELLOW_PIXEL)
     assert np.array_equal(result.image[737][1175], GREEN_PIXEL)
-    assert np.array_equal(result.image[1019][477], RED_PIXEL)
+    assert np.array_equal(result.image[1019][477], dark_pixel)
 
     assert result.color_pixels is not None
     assert len(result.color_pixels.keys()) == 4
@@ -131,6 +135,21 @@ def test_quantize__large_image__real_palette(n_colors, metric):
     assert 0.05 * IMAGE_BLISS_AREA < result.color_pixels[BLK_6725] < 0.3 * IMAGE_BLISS_AREA
 
 
+@pytest.mark.parametrize("kmeans_preset", [KMeansPreset("pixels", histogram_bits=KMEANS_ON_PIXELS),
+                                           *KMEANS_PRESETS.keys()])
+def test_quantize__large_image__kmeans_presets(kmeans_preset):
+    result = quantize(img=IMAGE_BLISS,
+                      palette=PALETTE_MTN_BLACK,
+                      n_colors=15,
+                      metric=EUCLIDEAN_METRIC,
+                      kmeans_preset=kmeans_preset)
+
+    assert result.image.shape == (IMAGE_BLISS_HGT, IMAGE_BLISS_WDT, 3)
+    assert np.array_equal(result.image[441][327], BLK_4320_PIXEL)
+    assert np.array_equal(result.image[799][1761], BLK_6725_PIXEL)
+    assert sum(result.color_pixels.values()) == IMAGE_BLISS_AREA
+
+
 @pytest.mark.parametrize("metric", [EUCLIDEAN_METRIC, DELTA_E_METRIC])
 def test_quantize__large_image__resize(metric):
     result = quantize(img=IMAGE_OCTOBER,
@@ -168,10 +187,14 @@ def test_quantize__image_as_bytes():
     assert result.color_pixels[BLUE] == 400
 
 
-def test_quantize__no_palette():
+@pytest.mark.parametrize("kmeans_preset", [KMeansPreset("pixels", histogram_bits=KMEANS_ON_PIXELS),
+                                           KMeansPreset("unique colors", histogram_bits=KMEANS_ON_UNIQUE_COLORS),
+                                           *KMEANS_PRESETS.keys()])
+def test_quantize__no_palette(kmeans_preset):
     result = quantize(img=IMAGE_4_SQUARES,
                       palette=None,
-                      n_colors=4)
+                      n_colors=4,
+                      kmeans_preset=kmeans_preset)
 
     assert result.image is not None
     assert result.image.shape == (40, 40, 3)
@@ -197,3 +220,161 @@ def test_quantize__no_palette():
     assert len(result.color_pixels.keys()) == 4
     for k in result.color_pixels:
         assert result.color_pixels[k] == 400
+
+
+def test_from_codebook_labels__duplicated_colors():
+    codebook = np.array([RED_PIXEL, BLUE_PIXEL, RED_PIXEL], dtype=np.uint8)
+    labels = np.array([0, 1, 2, 2, 0, 2], dtype=np.int64)
+
+    result = QuantizedImage.from_codebook_labels(codebook, labels, 2, 3, Palette([RED, BLUE, RED]))
+
+    assert result.image.shape == (2, 3, 3)
+    assert np.array_equal(result.image[0][1], BLUE_PIXEL)
+    assert np.array_equal(result.image[1][2], RED_PIXEL)
+    assert len(result.color_pixels.keys()) == 2
+    assert result.color_pixels[RED] == 5
+    assert result.color_pixels[BLUE] == 1
+
+
+def test_quantize__unknown_kmeans_preset():
+    with pytest.raises(Exception):
+        quantize(img=IMAGE_4_SQUARES, palette=None, n_colors=4, kmeans_preset="unknown")
+
+
+def test_quantize__too_many_pixels(monkeypatch):
+    monkeypatch.setattr(quantize_module, "MAX_IMAGE_MEGAPIXELS", 0.001)
+
+    with pytest.raises(InvalidImageException):
+        quantize(img=IMAGE_4_SQUARES, palette=None, n_colors=4)
+
+
+def test_quantize_tiled__full_resolution():
+    q_image = quantize_tiled(IMAGE_OCTOBER, Palette.from_predefined(["mtnblack"]), n_colors=10, tile_rows=500)
+    assert q_image.image.shape == (3120, 4160, 3)
+    assert sum(q_image.color_pixels.values()) == 3120 * 4160
+    assert len(q_image.color_pixels) <= 10
+
+
+def test_quantize_tiled__same_as_quantize_for_small_image():
+    expected = quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS)
+    q_image = quantize_tiled(IMAGE_4_SQUARES, PALETTE_4_COLORS, tile_rows=100)
+    assert np.array_equal(q_image.image, expected.image)
+    assert q_image.color_pixels == expected.color_pixels
+
+
+def test_quantize_tiled__memory_mapped_result(tmp_path):
+    path = tmp_path.joinpath("result.npy")
+
+    q_image = quantize_tiled(IMAGE_4_SQUARES, PALETTE_4_COLORS, out=path, tile_rows=7)
+
+    assert isinstance(q_image.image, np.memmap)
+    assert np.array_equal(np.load(path), quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS).image)
+
+
+def test_quantize__stats():
+    q_image = quantize(IMAGE_BLISS, Palette.from_predefined(["mtnblack"]), n_colors=10)
+
+    assert {"decode", "resize", "kmeans", "palette_matching", "reconstruction"} <= set(q_image.stats.stages)
+    assert q_image.stats.counters["pixels"] == IMAGE_BLISS_AREA
+    assert q_image.stats.counters["clusters"] == 10
+    assert q_image.stats.counters["palette_size"] == Palette.from_predefined(["mtnblack"]).size()
+    assert q_image.stats.counters["result_colors"] == len(q_image.color_pixels)
+
+
+def test_quantize__labels_kept_until_image_is_accessed():
+    q_image = quantize(IMAGE_BLISS, Palette.from_predefined(["mtnblack"]), n_colors=10)
+
+    assert q_image.labels.dtype == np.uint8
+    assert q_image.shape == (IMAGE_BLISS_HGT, IMAGE_BLISS_WDT, 3)
+    assert q_image.nbytes() < IMAGE_BLISS_AREA * 3 / 2
+
+    image_png = q_image.to_bytes(indexed=True)
+    assert q_image.nbytes() < IMAGE_BLISS_AREA * 3 / 2
+    assert np.array_equal(read_rgb_image(image_png), q_image.image)
+    assert q_image.image.shape == q_image.shape
+    assert q_image.nbytes() == IMAGE_BLISS_AREA * 3
+
+
+def test_quantized_image__no_image_or_labels():
+    with pytest.raises(Exception):
+        QuantizedImage(None, {}, labels=np.zeros((2, 2), dtype=np.uint8))
+
+
+def test_quantize__memory_budget_downscales_image():
+    max_pixels = 500_000
+    q_image = quantize(IMAGE_BLISS, PALETTE_MTN_BLACK, n_colors=10,
+                       memory_budget_bytes=BASE_MEMORY_BYTES + max_pixels * PEAK_BYTES_PER_PIXEL)
+
+    height, width = q_image.shape[:2]
+    assert height * width <= max_pixels
+    assert abs(width / height - IMAGE_BLISS_WDT / IMAGE_BLISS_HGT) < 0.01
+    assert sum(q_image.color_pixels.values()) == height * width
+
+
+def test_quantize__memory_budget_too_small():
+    with pytest.raises(Exception):
+        quantize(IMAGE_BLISS, PALETTE_MTN_BLACK, n_colors=10, memory_budget_bytes=BASE_MEMORY_BYTES)
+
+
+BLACK_AND_WHITE = Palette([Color(0, 0, 0, name='black'), Color(255, 255, 255, name='white')])
+
+
+def test_quantize__dither_mixes_palette_colors():
+    gray = image_to_bytes(np.full((64, 64, 3), 64, dtype=np.uint8))
+
+    plain = quantize(gray, BLACK_AND_WHITE)
+    dithered = quantize(gray, BLACK_AND_WHITE, dither=True)
+
+    assert plain.color_pixels == {BLACK_AND_WHITE.colors[0]: 64 * 64}
+    # a quarter of the pixels are white to keep the level of gray
+    assert dithered.color_pixels == {BLACK_AND_WHITE.colors[0]: 64 * 64 * 3 // 4,
+                                     BLACK_AND_WHITE.colors[1]: 64 * 64 // 4}
+    assert "dithering" in dithered.stats.stages
+
+
+@pytest.mark.parametrize("palette, n_colors", [(None, 8), (PALETTE_MTN_BLACK, 8), (PALETTE_MTN_BLACK, 0)])
+def test_quantize__dither_all_cases(palette, n_colors):
+    plain = quantize(IMAGE_BLISS, palette, n_colors, kmeans_preset="fast")
+    dithered = quantize(IMAGE_BLISS, palette, n_colors, kmeans_preset="fast", dither=True)
+
+    assert dithered.shape == plain.shape
+    assert sum(dithered.color_pixels.values()) == IMAGE_BLISS_AREA
+    assert len(dithered.color_pixels) <= (n_colors or palette.size())
+    assert not np.array_equal(dithered.image, plain.image)
+
+
+def test_quantize_tiled__dither_same_as_quantize_for_small_image():
+    expected = quantize(IMAGE_4_SQUARES, PALETTE_4_COLORS, dither=True)
+    q_image = quantize_tiled(IMAGE_4_SQUARES, PALETTE_4_COLORS, tile_rows=5, dither=True)
+    assert np.array_equal(q_image.image, expected.image)
+    assert q_image.color_pixels == expected.color_pixels
+
+
+def test_quantize__max_image_size():
+    q_image = quantize(IMAGE_BLISS, PALETTE_MTN_BLACK, n_colors=10, kmeans_preset="fast", max_image_size=400)
+
+    assert max(q_image.shape[:2]) == 400
+    assert sum(q_image.color_pixels.values()) == q_image.shape[0] * q_image.shape[1]
+
+
+@pytest.mark.parametrize("palette, kmeans_preset", [(None, "fast"), (PALETTE_MTN_BLACK, "balanced"),
+                                                    (PALETTE_MTN_BLACK, "best")])
+def test_quantize__warm_start_from_preview(palette, kmeans_preset):
+    preview = quantize(IMAGE_BLISS, palette, 10, kmeans_preset="fast", max_image_size=400)
+    assert preview.centroids.shape == (10, 3)
+
+    q_image = quantize(IMAGE_BLISS, palette, 10, kmeans_preset=kmeans_preset, init_centroids=preview.centroids)
+
+    assert q_image.stats.counters["kmeans_warm_start"]
+    assert q_image.shape[:2] == (IMAGE_BLISS_HGT, IMAGE_BLISS_WDT)
+    assert sum(q_image.color_pixels.values()) == IMAGE_BLISS_AREA
+    assert 0 < len(q_image.color_pixels) <= 10
+
+
+def test_quantize__warm_start_ignores_other_number_of_centroids():
+    preview = quantize(IMAGE_BLISS, None, 5, kmeans_preset="fast", max_image_size=400)
+
+    q_image = quantize(IMAGE_BLISS, None, 10, kmeans_preset="fast", init_centroids=preview.centroids)
+
+    assert not q_image.stats.counters["kmeans_warm_start"]
+    assert len(q_image.color_pixels) == 10
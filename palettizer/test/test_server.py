@@ -0,0 +1,127 @@
+import asyncio
+import json
+import socket
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+from palettizer.imgutils import read_rgb_image
+from palettizer.lookup import CACHE_DIR_ENV
+from palettizer.server import QuantizationServer
+from testutils import get_test_resource
+
+
+MAX_BODY_BYTES = 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def server_port(tmp_path_factory):
+    # the workers are started before the cache directory of each test is set, so they get their own one
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path_factory.mktemp("cache")))
+        loop = asyncio.new_event_loop()
+        server = QuantizationServer(workers=1, queue_size=1, max_body_bytes=MAX_BODY_BYTES)
+        port = loop.run_until_complete(server.start(port=0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield port
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def request(port: int, method: str, path: str, body: bytes = None) -> tuple:
+    connection = HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        return response.status, response.getheader("Content-Type"), response.read()
+    finally:
+        connection.close()
+
+
+def read_image(name: str) -> bytes:
+    with open(get_test_resource(name), 'rb') as f:
+        return f.read()
+
+
+def test_health(server_port):
+    status, _, body = request(server_port, "GET", "/health")
+    assert status == 200
+    assert json.loads(body)["status"] == "ok"
+    assert json.loads(body)["workers"] == 1
+
+
+def test_quantize_png(server_port):
+    status, content_type, body = request(server_port, "POST", "/quantize?n_colors=2", read_image("4_squares.png"))
+    assert status == 200
+    assert content_type == "image/png"
+    image = read_rgb_image(body)
+    assert image.shape == read_rgb_image(read_image("4_squares.png")).shape
+    assert len({tuple(c) for c in image.reshape(-1, 3)}) == 2
+
+
+def test_quantize_json(server_port):
+    status, content_type, body = request(server_port, "POST", "/quantize?palette=mtnblack&n_colors=5&format=json",
+                                         read_image("bliss.jpg"))
+    assert status == 200
+    assert content_type == "application/json"
+    result = json.loads(body)
+    assert 0 < len(result["colors"]) <= 5
+    assert all(c["vendor"] == "Montana Black" for c in result["colors"])
+    assert sum(c["pixels"] for c in result["colors"]) == result["height"] * result["width"]
+
+
+def test_quantize_html(server_port):
+    status, content_type, body = request(server_port, "POST", "/quantize?palette=mtnblack&format=html",
+                                         read_image("2_squares.png"))
+    assert status == 200
+    assert content_type.startswith("text/html")
+    assert b"<html" in body
+
+
+def test_quantize_dithered(server_port):
+    status, _, body = request(server_port, "POST", "/quantize?palette=mtnblack&dither=1&format=json",
+                              read_image("bliss.jpg"))
+    assert status == 200
+    assert "dithering" in json.loads(body)["stages"]
+
+
+def test_concurrent_requests(server_port):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        request(server_port, "POST", "/quantize?format=json&n_colors=2", read_image("4_squares.png"))[0]))
+        for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [200, 200]
+
+
+@pytest.mark.parametrize("path, expected_status", [
+    ("/quantize?palette=unknown", 400),
+    ("/quantize?n_colors=-1", 400),
+    ("/quantize?metric=manhattan", 400),
+    ("/quantize?format=gif", 400),
+    ("/quantize?dither=yes", 400),
+    ("/unknown", 404)
+])
+def test_bad_requests(server_port, path, expected_status):
+    status, _, body = request(server_port, "POST", path, read_image("2_squares.png"))
+    assert status == expected_status
+    assert "error" in json.loads(body)
+
+
+def test_not_an_image(server_port):
+    status, _, _ = request(server_port, "POST", "/quantize", b"not an image")
+    assert status >= 400
+
+
+def test_too_large_body_is_not_read(server_port):
+    with socket.create_connection(("127.0.0.1", server_port), timeout=60) as s:
+        s.sendall("POST /quantize HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(MAX_BODY_BYTES + 1).encode())
+        response = s.recv(1024)
+    assert response.startswith(b"HTTP/1.1 413")
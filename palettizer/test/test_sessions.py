@@ -0,0 +1,108 @@
+import time
+import uuid
+
+from palettizerbot.sessions import PictureStore, DIR_ENV
+
+
+PICTURE = b"x" * 100
+
+
+def test_put_and_get(tmp_path):
+    store = PictureStore(max_memory_bytes=1000, ttl_seconds=60, directory=tmp_path)
+
+    key = store.put(bytearray(PICTURE))
+
+    assert store.get(key) == PICTURE
+    assert store.get("unknown") is None
+    assert store.footprint() == {"pictures": 1, "memory_bytes": 100, "disk_bytes": 0}
+
+
+def test_least_recently_used_pictures_spilled_to_disk(tmp_path):
+    store = PictureStore(max_memory_bytes=250, ttl_seconds=60, directory=tmp_path)
+
+    first = store.put(b"1" * 100)
+    second = store.put(b"2" * 100)
+    # the first picture is used more recently than the second one
+    store.get(first)
+    third = store.put(b"3" * 100)
+
+    assert store.footprint() == {"pictures": 3, "memory_bytes": 200, "disk_bytes": 100}
+    assert [p.name for p in tmp_path.iterdir()] == [second]
+    assert store.get(first) == b"1" * 100
+    assert store.get(second) == b"2" * 100
+    assert store.get(third) == b"3" * 100
+
+
+def test_remove(tmp_path):
+    store = PictureStore(max_memory_bytes=150, ttl_seconds=60, directory=tmp_path)
+    spilled = store.put(PICTURE)
+    kept = store.put(PICTURE)
+
+    store.remove(spilled)
+    store.remove(kept)
+    store.remove("unknown")
+
+    assert store.get(spilled) is None
+    assert store.get(kept) is None
+    assert store.footprint() == {"pictures": 0, "memory_bytes": 0, "disk_bytes": 0}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_expire(tmp_path):
+    store = PictureStore(max_memory_bytes=150, ttl_seconds=0.2, directory=tmp_path)
+    store.put(PICTURE)
+    store.put(PICTURE)
+    time.sleep(0.3)
+    kept = store.put(PICTURE)
+
+    store.expire()
+
+    assert store.footprint() == {"pictures": 1, "memory_bytes": 100, "disk_bytes": 0}
+    assert list(tmp_path.iterdir()) == []
+    assert store.get(kept) == PICTURE
+
+
+def test_get_prolongs_picture(tmp_path):
+    store = PictureStore(max_memory_bytes=1000, ttl_seconds=0.3, directory=tmp_path)
+    key = store.put(PICTURE)
+
+    time.sleep(0.2)
+    assert store.get(key) == PICTURE
+    time.sleep(0.2)
+
+    assert store.get(key) == PICTURE
+
+
+def test_pictures_of_previous_run_removed(tmp_path):
+    stale = tmp_path.joinpath(uuid.uuid4().hex)
+    stale.write_bytes(PICTURE)
+    other = tmp_path.joinpath("notes.txt")
+    other.write_bytes(PICTURE)
+
+    PictureStore(max_memory_bytes=1000, ttl_seconds=60, directory=tmp_path)
+
+    assert list(tmp_path.iterdir()) == [other]
+
+
+def test_close(tmp_path):
+    store = PictureStore(max_memory_bytes=150, ttl_seconds=60, directory=tmp_path)
+    spilled = store.put(PICTURE)
+    store.put(PICTURE)
+
+    store.close()
+
+    assert store.get(spilled) is None
+    assert store.footprint() == {"pictures": 0, "memory_bytes": 0, "disk_bytes": 0}
+    # the directory isn't owned by the store
+    assert tmp_path.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_close__temporary_directory_removed(monkeypatch):
+    monkeypatch.delenv(DIR_ENV, raising=False)
+    store = PictureStore.from_env()
+    store.put(PICTURE)
+
+    store.close()
+
+    assert not store.directory.exists()
@@ -0,0 +1,44 @@
+import logging
+
+from palettizer.stats import ProcessingStats, collect_stats, stage, count, current_stats, log_stats
+
+
+def test_stages_and_counters_are_collected_inside_the_block():
+    with collect_stats() as stats:
+        with stage("a"):
+            pass
+        with stage("a"):
+            pass
+        count("pixels", 100)
+        assert current_stats() is stats
+
+    assert current_stats() is None
+    assert list(stats.stages) == ["a"]
+    assert stats.stages["a"] > 0
+    assert stats.counters == {"pixels": 100}
+
+
+def test_nested_blocks_share_stats():
+    with collect_stats() as outer:
+        with collect_stats() as inner:
+            count("pixels", 1)
+        assert inner is outer
+        assert current_stats() is outer
+    assert outer.counters == {"pixels": 1}
+
+
+def test_nothing_is_collected_outside_the_block():
+    with stage("a"):
+        count("pixels", 1)
+    assert current_stats() is None
+
+
+def test_log_stats(caplog):
+    stats = ProcessingStats.from_dict({"stages": {"decode": 0.5}, "counters": {"pixels": 10}})
+    assert stats.total_seconds() == 0.5
+
+    with caplog.at_level(logging.INFO):
+        log_stats("Stats", stats)
+
+    assert caplog.records[-1].stats == {"stages": {"decode": 0.5}, "counters": {"pixels": 10}}
+    assert '"pixels": 10' in caplog.records[-1].getMessage()
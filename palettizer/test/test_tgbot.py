@@ -0,0 +1,109 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from palettizer.imgutils import read_rgb_image
+from palettizer.matching import DELTA_E_METRIC, EUCLIDEAN_METRIC
+from palettizer.palette import Palette
+from palettizer.quantize import MAX_IMAGE_SIZE_BYTES
+from palettizerbot import tgbot
+from palettizerbot.jobs import JobPool, process_preview, PREVIEW_SIZE_PIXELS
+from palettizerbot.metrics import Metrics
+from palettizerbot.sessions import PictureStore
+from testutils import get_test_resource
+
+
+class FakeBot:
+    """Records the messages sent to the chat, done is set by the final message"""
+
+    def __init__(self):
+        self.sent = []
+        self.done = threading.Event()
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        self.sent.append(("message", text))
+        if text.startswith("Ready") or text.startswith("Sorry") or text.startswith("Something"):
+            self.done.set()
+
+    def send_photo(self, chat_id: int, photo: bytes, caption: str = None):
+        self.sent.append(("photo", photo))
+
+    def send_document(self, chat_id: int, document: bytes, filename: str = None):
+        self.sent.append(("document", document))
+
+
+@pytest.fixture(scope="module")
+def job_pool():
+    pool = JobPool(workers=1, queue_size=1)
+    yield pool
+    pool.shutdown()
+
+
+def read_picture(name: str) -> bytes:
+    with open(get_test_resource(name), 'rb') as f:
+        return f.read()
+
+
+def test_process_preview():
+    preview_png, centroids, stats = process_preview(read_picture("october.jpg"), Palette.from_predefined("mtnblack"),
+                                                    8, DELTA_E_METRIC, time.time())
+
+    assert max(read_rgb_image(preview_png).shape[:2]) == PREVIEW_SIZE_PIXELS
+    assert centroids.shape == (8, 3)
+    assert "queue_wait" in stats.stages
+
+
+def test_process_preview__no_kmeans():
+    _, centroids, _ = process_preview(read_picture("bliss.jpg"), Palette.from_predefined("mtnblack"),
+                                      0, EUCLIDEAN_METRIC, time.time())
+    assert centroids is None
+
+
+def submit_processing(job_pool: JobPool, store_dir, picture: bytes, kmeans_preset: str) -> SimpleNamespace:
+    context = SimpleNamespace(bot=FakeBot(), user_data={}, bot_data={
+        tgbot.JOB_POOL_KEY: job_pool,
+        tgbot.METRICS_KEY: Metrics(),
+        tgbot.PICTURE_STORE_KEY: PictureStore(1024 * 1024, 60, store_dir)})
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1))
+    tgbot.__set_picture_to_context(context, picture)
+    tgbot.__set_palette_to_context(context, "mtnblack")
+    tgbot.__set_n_colors_to_context(context, 6)
+
+    tgbot.__submit_processing(update, context, kmeans_preset, False)
+    return context
+
+
+@pytest.mark.parametrize("kmeans_preset, warm_start", [("best", True), ("balanced", False)])
+def test_submit_processing__preview_then_result(job_pool, tmp_path, kmeans_preset, warm_start):
+    context = submit_processing(job_pool, tmp_path, read_picture("bliss.jpg"), kmeans_preset)
+    bot, metrics = context.bot, context.bot_data[tgbot.METRICS_KEY]
+
+    # without the warm start the full picture doesn't wait for the preview
+    assert job_pool.pending() == (1 if warm_start else 2)
+    assert context.user_data == {}
+    assert bot.done.wait(timeout=120)
+    kinds = [kind for kind, _ in bot.sent]
+    assert kinds.index("photo") < kinds.index("document")
+    assert bot.sent[-1] == ("message", "Ready! Send another picture to start again.")
+    preview = read_rgb_image(bot.sent[kinds.index("photo")][1])
+    result = read_rgb_image(bot.sent[kinds.index("document")][1])
+    assert max(preview.shape[:2]) == PREVIEW_SIZE_PIXELS
+    assert result.shape[:2] == (1080, 1920)
+    assert len({tuple(c) for c in result.reshape(-1, 3)}) <= 6
+
+    lines = metrics.render().splitlines()
+    assert 'palettizer_jobs_total{result="preview"} 1' in lines
+    assert 'palettizer_jobs_total{result="ok"} 1' in lines
+    # only the stats of the full picture are observed, the warm start is counted when the centroids are used
+    assert ('palettizer_size_count{counter="kmeans_warm_start"} 1' in lines) == warm_start
+
+
+def test_submit_processing__invalid_picture_reported_once(job_pool, tmp_path):
+    context = submit_processing(job_pool, tmp_path, b"x" * (MAX_IMAGE_SIZE_BYTES + 1), "balanced")
+
+    assert context.bot.done.wait(timeout=60)
+    # the preview and the full picture fail both, let the callback of the other one finish
+    time.sleep(1)
+    assert len([text for _, text in context.bot.sent if text.startswith("Sorry")]) == 1
@@ -3,18 +3,36 @@ from . import initlogging
 from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.ext.filters import Filters
 import sys
-from . tgbot import on_start, on_error, on_picture, on_file, on_query, on_text
+from . tgbot import on_start, on_error, on_picture, on_file, on_query, on_text, JOB_POOL_KEY, PICTURE_STORE_KEY, \
+    METRICS_KEY
+from . jobs import JobPool
+from . sessions import PictureStore
+from . metrics import Metrics
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+PICTURE_EXPIRATION_INTERVAL_SECONDS = 60
+
 
 def main():
     token = sys.argv[1]
 
     updater = Updater(token=token, use_context=True)
     dispatcher = updater.dispatcher
+    # quantization runs in worker processes, so the handlers only queue the jobs and stay responsive
+    job_pool = JobPool.from_env()
+    dispatcher.bot_data[JOB_POOL_KEY] = job_pool
+    # uploaded pictures are kept in a store with limited memory, the abandoned ones expire
+    picture_store = PictureStore.from_env()
+    dispatcher.bot_data[PICTURE_STORE_KEY] = picture_store
+    updater.job_queue.run_repeating(lambda _: picture_store.expire(), interval=PICTURE_EXPIRATION_INTERVAL_SECONDS)
+    # stages durations and sizes of the processed pictures are served on a local endpoint
+    metrics, metrics_server = Metrics.from_env()
+    metrics.add_gauge("pending_jobs", job_pool.pending)
+    metrics.add_gauge("stored_pictures_bytes", lambda: picture_store.footprint()["memory_bytes"])
+    dispatcher.bot_data[METRICS_KEY] = metrics
 
     dispatcher.add_error_handler(on_error)
 
@@ -40,6 +58,10 @@ def main():
     updater.start_polling()
     logger.info("Message polling for Telegram bot has started")
     updater.idle()
+    job_pool.shutdown()
+    picture_store.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 
 if __name__ == '__main__':
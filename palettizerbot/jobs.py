@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from multiprocessing import get_context
+from typing import Callable, Optional, Union
+import numpy as np
+from palettizer.palette import Palette
+from palettizer.quantize import quantize
+from palettizer.htmlview import render_outputs
+from palettizer.cache import QuantizationCache
+from palettizer.batch import limit_native_threads
+from palettizer.stats import ProcessingStats, collect_stats, count, log_stats
+
+logger = logging.getLogger(__name__)
+
+WORKERS_ENV = "PALETTIZER_WORKERS"
+QUEUE_SIZE_ENV = "PALETTIZER_QUEUE_SIZE"
+THREADS_PER_WORKER_ENV = "PALETTIZER_THREADS_PER_WORKER"
+JOB_MEMORY_ENV = "PALETTIZER_JOB_MEMORY_MB"
+DEFAULT_THREADS_PER_WORKER = 1
+# the results are cached in memory of every worker and on disk shared by all workers
+WORKER_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+# the preview is sent to the chat in a few seconds, while the full picture is being processed
+PREVIEW_SIZE_PIXELS = 400
+PREVIEW_KMEANS_PRESET = "fast"
+
+__RESULTS_CACHE = None
+
+
+class QueueFullException(Exception):
+    pass
+
+
+class JobPool:
+    """Runs the quantization jobs in a pool of worker processes.
+
+    At most workers + queue_size jobs are accepted at once, the rest are rejected with QueueFullException.
+    The results are handled by the callbacks in threads of their own, so a slow upload of one result
+    doesn't delay the others and the pool keeps handing out the queued jobs meanwhile.
+    """
+
+    def __init__(self, workers: int, queue_size: int, threads_per_worker=DEFAULT_THREADS_PER_WORKER,
+                 memory_budget_bytes: int = None):
+        self.workers = workers
+        self.queue_size = queue_size
+        # peak memory a single job should take, the pictures are downscaled to fit into it
+        self.memory_budget_bytes = memory_budget_bytes
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__executor = ProcessPoolExecutor(max_workers=workers,
+                                              mp_context=get_context("spawn"),
+                                              initializer=init_worker,
+                                              initargs=(threads_per_worker,))
+        # a callback per accepted job can run at once, they mostly wait for the network
+        self.__callbacks = ThreadPoolExecutor(max_workers=workers + queue_size, thread_name_prefix="job-callback")
+
+    @staticmethod
+    def from_env():
+        workers = int(os.environ.get(WORKERS_ENV, os.cpu_count() or 1))
+        queue_size = int(os.environ.get(QUEUE_SIZE_ENV, 2 * workers))
+        threads_per_worker = int(os.environ.get(THREADS_PER_WORKER_ENV, DEFAULT_THREADS_PER_WORKER))
+        job_memory_mb = os.environ.get(JOB_MEMORY_ENV)
+        memory_budget_bytes = int(job_memory_mb) * 1024 * 1024 if job_memory_mb else None
+        logger.info("Starting {} workers with {} threads each, queue size is {}, memory per job is {}"
+                    .format(workers, threads_per_worker, queue_size,
+                            "{} MB".format(job_memory_mb) if job_memory_mb else "not limited"))
+        return JobPool(workers, queue_size, threads_per_worker, memory_budget_bytes)
+
+    def submit(self, on_done: Callable[[Future], None], fn: Callable, *args, force=False) -> int:
+        """Submit a job and return the number of jobs accepted before it and not finished yet.
+
+        on_done is called with the future of the job in a callback thread when the job is finished.
+        A forced job is accepted even if the queue is full, it is used to continue a job which was accepted.
+        """
+        with self.__lock:
+            if not force and self.__pending >= self.workers + self.queue_size:
+                raise QueueFullException("Too many pictures are being processed, please try again later")
+            position = self.__pending
+            self.__pending += 1
+        try:
+            future = self.__executor.submit(fn, *args)
+        except Exception:
+            self.__finish()
+            raise
+        future.add_done_callback(lambda f: self.__on_done(f, on_done))
+        return position
+
+    def pending(self) -> int:
+        with self.__lock:
+            return self.__pending
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=True, cancel_futures=True)
+        self.__callbacks.shutdown(wait=True)
+
+    def __on_done(self, future: Future, on_done: Callable[[Future], None]):
+        self.__finish()
+        # the done callbacks of the futures are run by the single thread which manages the worker processes,
+        # so the result is handled in another thread
+        self.__callbacks.submit(JobPool.__handle_result, future, on_done)
+
+    @staticmethod
+    def __handle_result(future: Future, on_done: Callable[[Future], None]):
+        try:
+            on_done(future)
+        except Exception as e:
+            logger.error(msg="Failed to handle the result of a job", exc_info=e)
+
+    def __finish(self):
+        with self.__lock:
+            self.__pending -= 1
+
+
+def init_worker(threads: int):
+    """Limit the threads of the native libraries, so the workers together don't oversubscribe the CPU"""
+    limit_native_threads(threads)
+
+
+def process_picture(picture: Union[bytes, bytearray],
+                    palette: Palette,
+                    n_colors: int,
+                    metric: str,
+                    kmeans_preset: str,
+                    submitted_at: float,
+                    memory_budget_bytes: int = None,
+                    dither=False,
+                    init_centroids: np.ndarray = None) -> tuple[bytes, str, ProcessingStats]:
+    """Quantize the picture and return the result as PNG, HTML report and the processing stats,
+    runs in a worker process, submitted_at is time.time() when the job was submitted.
+    init_centroids are the K-means centroids of the preview, see process_preview()"""
+    global __RESULTS_CACHE
+    with collect_stats() as stats:
+        stats.add_stage("queue_wait", max(time.time() - submitted_at, 0.0))
+        if __RESULTS_CACHE is None:
+            # users often send the same picture again with the same options
+            __RESULTS_CACHE = QuantizationCache.on_disk(max_memory_bytes=WORKER_CACHE_MEMORY_BYTES)
+        q_image = __RESULTS_CACHE.quantize(img=picture, palette=palette, n_colors=n_colors,
+                                           metric=metric, kmeans_preset=kmeans_preset,
+                                           memory_budget_bytes=memory_budget_bytes, dither=dither,
+                                           init_centroids=init_centroids)
+        logger.info("Results cache stats: {}".format(__RESULTS_CACHE.stats()))
+        # palette-indexed PNG is several times smaller, so it is uploaded to the chat faster
+        image_png, response_html = render_outputs(q_image, indexed_png=True)
+        count("png_bytes", len(image_png))
+        log_stats("Picture processing stats", stats)
+    return image_png, response_html, stats
+
+
+def process_preview(picture: Union[bytes, bytearray],
+                    palette: Palette,
+                    n_colors: int,
+                    metric: str,
+                    submitted_at: float,
+                    dither=False) -> tuple[bytes, Optional[np.ndarray], ProcessingStats]:
+    """Quickly quantize a small copy of the picture and return it as PNG, the K-means centroids to warm-start
+    process_picture() from and the processing stats, runs in a worker process"""
+    with collect_stats() as stats:
+        stats.add_stage("queue_wait", max(time.time() - submitted_at, 0.0))
+        q_image = quantize(picture, palette, n_colors, metric, kmeans_preset=PREVIEW_KMEANS_PRESET,
+                           dither=dither, max_image_size=PREVIEW_SIZE_PIXELS)
+        image_png = q_image.to_bytes(indexed=True)
+        count("png_bytes", len(image_png))
+        log_stats("Preview processing stats", stats)
+    return image_png, q_image.centroids, stats
@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional
+from palettizer.stats import ProcessingStats
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT_ENV = "PALETTIZER_METRICS_PORT"
+DEFAULT_METRICS_PORT = 9464
+METRICS_HOST = "127.0.0.1"
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Histograms of the stages durations and of the counters of the processed pictures,
+    rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stages: dict[str, Histogram] = {}
+        self.__counters: dict[str, Histogram] = {}
+        self.__jobs: dict[str, int] = {}
+        self.__gauges: dict[str, Callable[[], float]] = {}
+
+    def observe(self, stats: ProcessingStats):
+        with self.__lock:
+            for name, seconds in stats.stages.items():
+                self.__stages.setdefault(name, Histogram(SECONDS_BUCKETS)).observe(seconds)
+            self.__stages.setdefault("total", Histogram(SECONDS_BUCKETS)).observe(stats.total_seconds())
+            for name, value in stats.counters.items():
+                self.__counters.setdefault(name, Histogram(SIZE_BUCKETS)).observe(value)
+
+    def count_job(self, result: str):
+        with self.__lock:
+            self.__jobs[result] = self.__jobs.get(result, 0) + 1
+
+    def add_gauge(self, name: str, get_value: Callable[[], float]):
+        """The value of the gauge is read when the metrics are rendered"""
+        with self.__lock:
+            self.__gauges[name] = get_value
+
+    def render(self) -> str:
+        lines = []
+        with self.__lock:
+            lines.append("# TYPE palettizer_jobs_total counter")
+            for result, value in sorted(self.__jobs.items()):
+                lines.append('palettizer_jobs_total{{result="{}"}} {}'.format(result, value))
+            Metrics.__render_histograms(lines, "palettizer_stage_seconds", "stage", self.__stages)
+            Metrics.__render_histograms(lines, "palettizer_size", "counter", self.__counters)
+            gauges = list(self.__gauges.items())
+        for name, get_value in gauges:
+            lines.append("# TYPE palettizer_{} gauge".format(name))
+            lines.append("palettizer_{} {}".format(name, get_value()))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host=METRICS_HOST) -> ThreadingHTTPServer:
+        """Serve the metrics on http://host:port/metrics in a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on http://{}:{}/metrics".format(host, server.server_port))
+        return server
+
+    @staticmethod
+    def from_env() -> tuple:
+        """Create the metrics and serve them on $PALETTIZER_METRICS_PORT, 0 disables the endpoint.
+
+        Returns the metrics and the server, None if the endpoint is disabled or the port can't be bound.
+        """
+        metrics = Metrics()
+        port = int(os.environ.get(METRICS_PORT_ENV, DEFAULT_METRICS_PORT))
+        server: Optional[ThreadingHTTPServer] = None
+        if port > 0:
+            try:
+                server = metrics.serve(port)
+            except OSError as e:
+                # the metrics are optional, so the bot runs without the endpoint
+                logger.warning("Failed to serve the metrics on port {}: {}".format(port, e))
+        return metrics, server
+
+    @staticmethod
+    def __render_histograms(lines: list, metric: str, label: str, histograms: dict):
+        lines.append("# TYPE {} histogram".format(metric))
+        for name, histogram in sorted(histograms.items()):
+            for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, name, bound, bucket_count))
+            lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}'.format(metric, label, name, histogram.count))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label, name, histogram.sum))
+            lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, name, histogram.count))
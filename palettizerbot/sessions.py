@@ -0,0 +1,152 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+MEMORY_MB_ENV = "PALETTIZER_SESSION_MEMORY_MB"
+TTL_MINUTES_ENV = "PALETTIZER_SESSION_TTL_MINUTES"
+DIR_ENV = "PALETTIZER_SESSION_DIR"
+DEFAULT_MEMORY_MB = 256
+DEFAULT_TTL_MINUTES = 60
+# the spilled pictures are named by their keys
+PICTURE_FILE_NAME = re.compile("[0-9a-f]{32}")
+
+
+class PictureStore:
+    """Pictures uploaded by the users and waiting for processing.
+
+    Up to max_memory_bytes of pictures are kept in memory, the least recently used ones are spilled
+    to files in the directory. A picture is removed when it isn't used for ttl_seconds.
+    The pictures spilled by a previous run can't be used anymore, so they are removed on start,
+    and the directory itself is removed by close() if it is owned by the store.
+    """
+
+    def __init__(self, max_memory_bytes: int, ttl_seconds: float, directory: Union[str, Path],
+                 owns_directory=False):
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.directory = Path(directory)
+        self.owns_directory = owns_directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.__remove_stale_files()
+        self.__lock = threading.Lock()
+        # key -> (picture or None if spilled to disk, size, expiration time)
+        self.__pictures: OrderedDict = OrderedDict()
+        self.__memory_bytes = 0
+        self.__disk_bytes = 0
+
+    @staticmethod
+    def from_env():
+        max_memory_bytes = int(os.environ.get(MEMORY_MB_ENV, DEFAULT_MEMORY_MB)) * 1024 * 1024
+        ttl_seconds = float(os.environ.get(TTL_MINUTES_ENV, DEFAULT_TTL_MINUTES)) * 60
+        directory = os.environ.get(DIR_ENV)
+        owns_directory = not directory
+        if owns_directory:
+            directory = tempfile.mkdtemp(prefix="palettizer-sessions-")
+        logger.info("Keeping up to {} MB of pictures in memory for {} minutes, spilling them to {}"
+                    .format(max_memory_bytes // (1024 * 1024), ttl_seconds / 60, directory))
+        return PictureStore(max_memory_bytes, ttl_seconds, directory, owns_directory)
+
+    def put(self, picture: Union[bytes, bytearray]) -> str:
+        key = uuid.uuid4().hex
+        picture = bytes(picture)
+        with self.__lock:
+            self.__pictures[key] = (picture, len(picture), time.monotonic() + self.ttl_seconds)
+            self.__memory_bytes += len(picture)
+            self.__spill()
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.__lock:
+            self.__expire()
+            if key not in self.__pictures:
+                return None
+            picture, size, _ = self.__pictures.pop(key)
+            self.__pictures[key] = (picture, size, time.monotonic() + self.ttl_seconds)
+            if picture is not None:
+                return picture
+            path = self.__get_path(key)
+        # the file is read without holding the lock, it is written only once
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def remove(self, key: str):
+        with self.__lock:
+            self.__remove(key)
+
+    def expire(self):
+        with self.__lock:
+            self.__expire()
+
+    def close(self):
+        """Remove all the pictures, and the directory if it is owned by the store"""
+        with self.__lock:
+            for key in list(self.__pictures.keys()):
+                self.__remove(key)
+            if self.owns_directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+
+    def footprint(self) -> dict:
+        with self.__lock:
+            return {
+                "pictures": len(self.__pictures),
+                "memory_bytes": self.__memory_bytes,
+                "disk_bytes": self.__disk_bytes
+            }
+
+    def __get_path(self, key: str) -> Path:
+        return self.directory.joinpath(key)
+
+    def __remove(self, key: str):
+        if key not in self.__pictures:
+            return
+        picture, size, _ = self.__pictures.pop(key)
+        if picture is not None:
+            self.__memory_bytes -= size
+        else:
+            self.__disk_bytes -= size
+            self.__get_path(key).unlink(missing_ok=True)
+
+    def __remove_stale_files(self):
+        # only the files named like the pictures, the directory may be shared with other files
+        stale = [p for p in self.directory.iterdir() if p.is_file() and PICTURE_FILE_NAME.fullmatch(p.name)]
+        for path in stale:
+            path.unlink(missing_ok=True)
+        if stale:
+            logger.info("Removed {} pictures left in {} by a previous run".format(len(stale), self.directory))
+
+    def __expire(self):
+        now = time.monotonic()
+        # the pictures are ordered by the last access, so the expired ones are at the beginning
+        expired = []
+        for key, (_, _, expires_at) in self.__pictures.items():
+            if expires_at > now:
+                break
+            expired.append(key)
+        for key in expired:
+            self.__remove(key)
+        if expired:
+            logger.info("{} pictures expired".format(len(expired)))
+
+    def __spill(self):
+        for key in list(self.__pictures.keys()):
+            if self.__memory_bytes <= self.max_memory_bytes:
+                break
+            picture, size, expires_at = self.__pictures[key]
+            if picture is None:
+                continue
+            self.__get_path(key).write_bytes(picture)
+            self.__pictures[key] = (None, size, expires_at)
+            self.__memory_bytes -= size
+            self.__disk_bytes += size
@@ -2,14 +2,24 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Callbac
 from telegram.ext import CallbackContext
 import logging
 import os
-from typing import Optional, Union
+import threading
+import time
+from typing import Callable, Optional, Union
+import numpy as np
 from palettizer.palette import Palette
-from palettizer.quantize import quantize, InvalidImageException, MAX_IMAGE_SIZE_BYTES, MAX_IMAGE_SIZE_MB, DELTA_E_METRIC, EUCLIDEAN_METRIC
-from palettizer.htmlview import image_and_palette_as_html
-from palettizer.imgutils import image_to_bytes
+from palettizer.quantize import InvalidImageException, MAX_IMAGE_SIZE_BYTES, MAX_IMAGE_SIZE_MB, DELTA_E_METRIC, EUCLIDEAN_METRIC
+from palettizer.quantize import KMEANS_PRESETS, DEFAULT_KMEANS_PRESET, get_kmeans_preset
+from concurrent.futures import Future
+from . jobs import JobPool, QueueFullException, process_picture, process_preview
+from . sessions import PictureStore
+from . metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
+JOB_POOL_KEY = "job_pool"
+METRICS_KEY = "metrics"
+PICTURE_STORE_KEY = "picture_store"
+
 
 def on_error(update: object, context: CallbackContext) -> None:
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -55,9 +65,8 @@ def on_query(update: Update, context: CallbackContext):
         __set_n_colors_to_context(context, 0)
         __send_start_processing_message(update, context)
     elif tokens[0] == "processing":
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Processing is in progress, please wait. It might take a few minutes.")
-        __do_processing_and_send_result(update, context)
+        kmeans_preset = tokens[1] if len(tokens) >= 2 and tokens[1] in KMEANS_PRESETS else DEFAULT_KMEANS_PRESET
+        __submit_processing(update, context, kmeans_preset, "dither" in tokens[1:])
     else:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Unexpected data, lease type /start")
@@ -109,65 +118,157 @@ def __send_start_processing_message(update: Update, context: CallbackContext):
     palette_name = "not set" if not palette else palette.name
 
     n_colors = __get_n_colors_from_context(context)
-    n_colors = "unlimited" if n_colors <= 0 else "up to {}".format(n_colors)
+    n_colors_text = "unlimited" if n_colors <= 0 else "up to {}".format(n_colors)
 
     text = """Your choice:
     Palette: {}
-    Colors: {}""".format(palette_name, n_colors)
-    markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton(text="Get result!", callback_data="processing")]
-    ])
+    Colors: {}""".format(palette_name, n_colors_text)
+    if palette and n_colors <= 0:
+        # all colors of the palette are used, K-Means is not applied so there is nothing to choose from
+        buttons = [InlineKeyboardButton(text="Get result!", callback_data="processing")]
+        dither_data = "processing dither"
+    else:
+        buttons = [
+            InlineKeyboardButton(text="Fast", callback_data="processing fast"),
+            InlineKeyboardButton(text="Get result!", callback_data="processing " + DEFAULT_KMEANS_PRESET),
+            InlineKeyboardButton(text="Best quality", callback_data="processing best")
+        ]
+        dither_data = "processing {} dither".format(DEFAULT_KMEANS_PRESET)
+    # dithering draws smooth gradients by a pattern of the palette colors instead of bands
+    markup = InlineKeyboardMarkup([buttons, [InlineKeyboardButton(text="Dithered", callback_data=dither_data)]])
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=text,
                              reply_markup=markup)
 
 
-def __do_processing_and_send_result(update: Update, context: CallbackContext):
+def __submit_processing(update: Update, context: CallbackContext, kmeans_preset: str, dither: bool):
     picture: bytes = __get_picture_from_context(context)
     palette: Palette = __get_palette_from_context(context)
     n_colors: int = __get_n_colors_from_context(context)
+    if picture is None or n_colors is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Please, send a picture first")
+        return
+
+    job_pool: JobPool = context.bot_data[JOB_POOL_KEY]
+    chat_id = update.effective_chat.id
+    metric = DELTA_E_METRIC if n_colors > 0 else EUCLIDEAN_METRIC
+    # starting from the colors of the preview saves the restarts of K-means, a single run takes about as long,
+    # so without the restarts the full picture is processed alongside the preview
+    warm_start = get_kmeans_preset(kmeans_preset).nredo > 1
+    result_started = threading.Event()
+
+    def send_result(future: Future):
+        result_started.set()
+        __send_result(future, chat_id, context)
+
+    def submit_picture(init_centroids: Optional[np.ndarray]):
+        # it continues the accepted request, so it is not rejected even if the queue has filled up meanwhile
+        logger.info("Submitting image file from the message for processing")
+        job_pool.submit(send_result, process_picture, picture, palette, n_colors, metric, kmeans_preset, time.time(),
+                        job_pool.memory_budget_bytes, dither, init_centroids, force=True)
+
+    try:
+        logger.info("Submitting image file from the message for the preview")
+        position = job_pool.submit(
+            lambda f: __send_preview(f, chat_id, context, submit_picture if warm_start else None, result_started),
+            process_preview, picture, palette, n_colors, metric, time.time(), dither)
+    except QueueFullException as e:
+        context.bot.send_message(chat_id=chat_id, text="Sorry, " + str(e))
+        return
+    if not warm_start:
+        submit_picture(None)
+
+    # the job has its own copy of the data, so the user can send the next picture right away
+    __cleanup_context(context)
+    if position < job_pool.workers:
+        text = "Processing is in progress, please wait. It might take a few minutes."
+    else:
+        text = "Your picture is number {} in the queue, please wait. It might take a few minutes." \
+            .format(position - job_pool.workers + 1)
+    context.bot.send_message(chat_id=chat_id, text=text)
+
 
+def __send_preview(future: Future, chat_id: int, context: CallbackContext,
+                   submit_picture: Optional[Callable[[Optional[np.ndarray]], None]], result_started: threading.Event):
+    """Send the preview and submit the full picture starting from its colors, unless submit_picture is None
+    and the full picture is processed already"""
+    metrics: Metrics = context.bot_data[METRICS_KEY]
     try:
-        logger.info("Processing image file from the message")
-        q_image = quantize(img=picture, palette=palette, n_colors=n_colors,
-                           metric=(DELTA_E_METRIC if n_colors > 0 else EUCLIDEAN_METRIC))
+        preview_png, centroids, _ = future.result()
     except InvalidImageException as e:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Sorry, your request can't be processed: " + str(e))
+        if submit_picture is None:
+            # the error is reported with the result of the full picture
+            return
+        metrics.count_job("invalid")
+        context.bot.send_message(chat_id=chat_id, text="Sorry, your request can't be processed: " + str(e))
+        return
+    except Exception as e:
+        # the full picture can still be processed without the preview
+        logger.error(msg="Preview failed", exc_info=e)
+        preview_png, centroids = None, None
+    if preview_png is not None:
+        metrics.count_job("preview")
+
+    if submit_picture is not None:
+        submit_picture(centroids)
+    # a preview after the result would only confuse
+    if preview_png is None or result_started.is_set():
+        return
+    try:
+        context.bot.send_photo(chat_id=chat_id, photo=preview_png,
+                               caption="Preview. The full result is on its way, please wait.")
+    except Exception as e:
+        raise Exception("Failed to send the preview to the chat") from e
+
+
+def __send_result(future: Future, chat_id: int, context: CallbackContext):
+    metrics: Metrics = context.bot_data[METRICS_KEY]
+    try:
+        image_png, response_html, stats = future.result()
+    except InvalidImageException as e:
+        metrics.count_job("invalid")
+        context.bot.send_message(chat_id=chat_id, text="Sorry, your request can't be processed: " + str(e))
         return
     except Exception as e:
-        raise Exception("Image quantization failed") from e
+        metrics.count_job("error")
+        logger.error(msg="Image quantization failed", exc_info=e)
+        context.bot.send_message(chat_id=chat_id, text="Something has gone wrong, please contact support @aleave")
+        return
+    metrics.count_job("ok")
+    metrics.observe(stats)
 
     try:
         logger.info("Processing finished, sending the result to the chat")
-        context.bot.send_document(chat_id=update.effective_chat.id,
-                                  document=image_to_bytes(q_image.image))
-        response_html = image_and_palette_as_html(q_image)
-        context.bot.send_document(chat_id=update.effective_chat.id,
+        context.bot.send_document(chat_id=chat_id, document=image_png)
+        context.bot.send_document(chat_id=chat_id,
                                   document=str.encode(response_html),
                                   filename="result.html")
-        __cleanup_context(context)
-        context.bot.send_message(chat_id=update.effective_chat.id,
+        context.bot.send_message(chat_id=chat_id,
                                  text="Ready! Send another picture to start again.")
     except Exception as e:
         raise Exception("Failed to send the results to the chat") from e
 
 
-def __get_picture_from_context(context: CallbackContext) -> Optional[Union[bytes, bytearray]]:
+def __get_picture_from_context(context: CallbackContext) -> Optional[bytes]:
     if "picture" not in context.user_data:
         return None
-    picture = context.user_data["picture"]
-    if not isinstance(picture, bytes) and not isinstance(picture, bytearray):
+    picture_key = context.user_data["picture"]
+    if not isinstance(picture_key, str):
         raise Exception("Can't get the picture from the context")
-    return picture
+    picture_store: PictureStore = context.bot_data[PICTURE_STORE_KEY]
+    # None if the picture has expired
+    return picture_store.get(picture_key)
 
 
 def __set_picture_to_context(context: CallbackContext, picture: Union[bytes, bytearray, None]):
+    # the pictures are kept in the store, the context only refers to them by key
+    picture_store: PictureStore = context.bot_data[PICTURE_STORE_KEY]
+    if "picture" in context.user_data:
+        picture_store.remove(context.user_data.pop("picture"))
     if picture is None:
-        if "picture" in context.user_data:
-            context.user_data.pop("picture")
         return
-    context.user_data["picture"] = picture
+    context.user_data["picture"] = picture_store.put(picture)
+    logger.info("Pictures store footprint: {}".format(picture_store.footprint()))
 
 
 def __get_palette_from_context(context: CallbackContext):